@@ -0,0 +1,153 @@
+__author__ = 'dsteinkraus'
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+import util as u
+
+#===================== class ActionCache =========================================================
+
+# content-addressed cache of files made by expensive plugin actions (ImageMagick, Panoply...).
+# A plugin computes a key from everything that determines its output - plugin name and
+# version, args other than the dest path, md5s of the input files - and asks for it before
+# running its tool. On a hit, the output is materialized at dest by hardlink (or copy, if
+# that fails) along with whatever metadata the plugin stored with it, e.g. width/height.
+# Stored files are kept under objects/, named by their own md5, so identical outputs are
+# stored once. Total size is capped; least recently used entries are evicted first.
+# NOTE: like HashCache, this is owned by Config so it logs directly.
+class ActionCache(object):
+    def __init__(self, config):
+        self.config = config
+        self.root = config.get('local', 'action_cache_root', return_none=True)
+        if not self.root:
+            self.root = config.admin + '/action_cache'
+        self._objects = self.root + '/objects'
+        u.ensure_path(self._objects)
+        self._index_file = self.root + '/index.txt'
+        self._max_bytes = config.get_int('local', 'action_cache_max_mb', default=2048) * 1024 * 1024
+        # key is action key, value is dict with md5, size, meta, used (timestamp)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._changed = False
+        self.hits = 0
+        self.misses = 0
+        self.read()
+
+    # key for an action result. args is a dict of the args that affect the output
+    # (i.e. not the dest path); input_md5s is a list of the input files' md5s.
+    @staticmethod
+    def key(plugin_name, version, args, input_md5s):
+        text = json.dumps([plugin_name, version, args, input_md5s], sort_keys=True)
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    def _object_file(self, md5):
+        return self._objects + '/' + md5[:2] + '/' + md5
+
+    # if key is cached, put its file at dest and return its metadata (a dict, possibly
+    # empty); otherwise return None, and the caller should produce dest and call store().
+    def fetch(self, key, dest):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                entry['used'] = time.time()
+                self._changed = True
+        obj = self._object_file(entry['md5']) if entry else None
+        # stat-keyed hash cache makes this cheap; it catches an object that was
+        # changed through a hardlink
+        if entry and (not os.path.isfile(obj) or u.md5(obj) != entry['md5']):
+            logging.warning("action cache: dropping bad object '%s'" % obj)
+            u.remove_if_exists(obj)
+            with self._lock:
+                self._entries.pop(key, None)
+            entry = None
+        if not entry:
+            with self._lock:
+                self.misses += 1
+            # don't write through a link to a cached object
+            u.remove_if_exists(dest)
+            return None
+        u.ensure_path_for_file(dest)
+        u.remove_if_exists(dest)
+        try:
+            os.link(obj, dest)
+        except OSError:
+            shutil.copyfile(obj, dest)
+        with self._lock:
+            self.hits += 1
+        return dict(entry['meta'])
+
+    # add file src (just produced by the action) to the cache under key
+    def store(self, key, src, meta=None):
+        md5 = u.md5(src)
+        obj = self._object_file(md5)
+        if not os.path.isfile(obj):
+            u.ensure_path_for_file(obj)
+            tmp = obj + '.tmp%i' % threading.get_ident()
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, obj)
+        with self._lock:
+            self._entries[key] = {
+                'md5': md5,
+                'size': os.path.getsize(obj),
+                'meta': meta or {},
+                'used': time.time()
+            }
+            self._changed = True
+
+    # remove least recently used entries until the objects still referred to
+    # fit under the size limit
+    def _evict(self):
+        # objects can be shared, so count references
+        refs = {}
+        sizes = {}
+        for entry in self._entries.values():
+            refs[entry['md5']] = refs.get(entry['md5'], 0) + 1
+            sizes[entry['md5']] = entry['size']
+        total = sum(sizes.values())
+        if total <= self._max_bytes:
+            return
+        evicted = 0
+        for key, entry in sorted(self._entries.items(), key=lambda item: item[1]['used']):
+            if total <= self._max_bytes:
+                break
+            del self._entries[key]
+            evicted += 1
+            md5 = entry['md5']
+            refs[md5] -= 1
+            if not refs[md5]:
+                total -= sizes[md5]
+                u.remove_if_exists(self._object_file(md5))
+        logging.info("action cache: evicted %i entries, now %i bytes" % (evicted, total))
+
+    def read(self):
+        self._entries.clear()
+        try:
+            with open(self._index_file) as fh:
+                for line in fh:
+                    key, entry = json.loads(line)
+                    self._entries[key] = entry
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            # objects are still there; entries will be remade as actions run
+            logging.warning("ignoring error '%s' reading action cache index '%s'" % (str(exc), self._index_file))
+            self._entries.clear()
+        self._changed = False
+
+    def write(self):
+        if not self._changed:
+            return
+        tmp_file = self._index_file + '.tmp'
+        with self._lock:
+            self._evict()
+            with open(tmp_file, 'w') as fh:
+                for key, entry in self._entries.items():
+                    fh.write(json.dumps([key, entry]) + '\n')
+            os.replace(tmp_file, self._index_file)
+            self._changed = False
+        logging.info("action cache written, %i hits, %i misses this run" % (self.hits, self.misses))
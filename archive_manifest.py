@@ -0,0 +1,165 @@
+__author__ = 'dsteinkraus'
+
+import os
+import bisect
+import logging
+
+from config import Config
+import util as u
+
+#===================== class ArchiveManifest =========================================================
+
+# sorted list of the paths (relative to archive_root/output) of files in the archive, so
+# restore_from_archive can find what it wants without walking years of archive. It's
+# updated by TreeProcessor.archive() with what was just copied there; if it's missing,
+# it's rebuilt by walking the archive once.
+# Archiving never deletes, so the manifest only grows; a path whose file was removed from
+# the archive by hand is just reported when it can't be restored. (archive with the
+# delete option does remove files, so the manifest is rebuilt then.)
+# With archiver = native, the manifest also has the md5 of each path, and file content
+# is stored once, in objects/ (named by md5, next to output/), with the paths under
+# output/ hardlinked to it; see TreeProcessor._archive_native.
+class ArchiveManifest(object):
+    def __init__(self, config, archive_output):
+        self.config = config
+        self.root = archive_output
+        self.objects = os.path.dirname(archive_output) + '/objects'
+        self._file = config.admin + '/_archive_manifest.txt'
+        self._paths = None  # loaded on first use
+        self._path_set = None  # made when needed, for set()
+        self._md5s = {}  # path -> md5, for paths put there by the native archiver
+        self._added = []  # paths set() since the list was last sorted
+        self._changed = False
+
+    def _load(self):
+        if self._paths is not None:
+            return
+        try:
+            with open(self._file) as fh:
+                self._paths = []
+                for line in fh:
+                    # 'path' or 'path<tab>md5'
+                    path, _, md5 = line.rstrip('\n').rpartition('\t')
+                    if path:
+                        self._md5s[path] = md5
+                    else:
+                        path = md5
+                    self._paths.append(path)
+            return
+        except FileNotFoundError:
+            pass
+        self.rebuild()
+
+    # remake the manifest from the archive itself
+    def rebuild(self):
+        Config.log(self.root, tag='ARCHIVE_MANIFEST_REBUILD')
+        self._paths = sorted(self._walk(self.root))
+        self._path_set = None
+        self._md5s.clear()
+        self._added = []
+        self._changed = True
+        self.write()
+
+    @staticmethod
+    def _walk(root):
+        for dir_name, subdirs, files in os.walk(root):
+            rel_path = u.make_rel_path(root, dir_name, no_leading_slash=True)
+            for file_name in files:
+                yield u.make_key(rel_path, file_name)
+
+    # add the files of local tree src_root, which has just been copied to the archive
+    def add_tree(self, src_root):
+        self._load()
+        new = 0
+        for path in self._walk(src_root):
+            # rsync may have replaced it, so its md5 is unknown now
+            self._md5s.pop(path, None)
+            new += self._add(path)
+        self._changed = True
+        if new:
+            Config.log("%i paths added, %i total" % (new, len(self._paths) + len(self._added)), tag='ARCHIVE_MANIFEST')
+        self.write()
+
+    def _add(self, path):
+        if self._path_set is None:
+            self._path_set = set(self._paths)
+        if path in self._path_set:
+            return False
+        self._path_set.add(path)
+        self._added.append(path)
+        return True
+
+    def _sort(self):
+        if self._added:
+            self._paths = sorted(self._paths + self._added)
+            self._added = []
+
+    # md5 of the archived file at path, if the native archiver put it there
+    def md5(self, path):
+        self._load()
+        return self._md5s.get(path)
+
+    # set of the md5s of paths the native archiver put there, i.e. objects in use
+    def md5s(self):
+        self._load()
+        return set(self._md5s.values())
+
+    def object_file(self, md5):
+        return self.objects + '/' + md5[:2] + '/' + md5
+
+    # record that path is now a link to the object for md5
+    def set(self, path, md5):
+        self._load()
+        self._add(path)
+        self._md5s[path] = md5
+        self._changed = True
+
+    # forget the given paths (a set)
+    def remove(self, paths):
+        self._load()
+        self._sort()
+        self._paths = [path for path in self._paths if path not in paths]
+        self._path_set = None
+        for path in paths:
+            self._md5s.pop(path, None)
+        self._changed = True
+
+    def paths(self):
+        self._load()
+        self._sort()
+        return self._paths
+
+    # generate full paths of archived files that regex (compiled) matches, searched as
+    # re.search would on the full path. If the pattern has a literal prefix, only that
+    # slice of the manifest is looked at (anchored), or it's used as a quick pre-test.
+    def query(self, regex):
+        paths = self.paths()
+        prefix, prefix_anchored, suffix, _ = u.regex_literal_affixes(regex.pattern)
+        root = self.root + '/'
+        if prefix_anchored and len(prefix) > len(root) and prefix.startswith(root):
+            rel_prefix = prefix[len(root):]
+            start = bisect.bisect_left(paths, rel_prefix)
+            end = bisect.bisect_left(paths, rel_prefix + '\U0010ffff', lo=start)
+            paths = paths[start:end]
+        elif prefix_anchored and not root.startswith(prefix):
+            return  # can't match anything in the archive
+        literal = prefix if len(prefix) >= len(suffix) else suffix
+        for path in paths:
+            full = root + path
+            if literal and literal not in full:
+                continue
+            if regex.search(full):
+                yield full
+
+    def write(self):
+        if not self._changed:
+            return
+        self._sort()
+        tmp_file = self._file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            for path in self._paths:
+                md5 = self._md5s.get(path)
+                fh.write(path + '\t' + md5 + '\n' if md5 else path + '\n')
+        os.replace(tmp_file, self._file)
+        self._changed = False
+        logging.info("archive manifest written, %i paths" % len(self._paths))
@@ -5,23 +5,54 @@ import sys
 import re
 import configparser
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
 import time
 from datetime import datetime
 
 import util as u
+from hash_cache import HashCache
+from action_cache import ActionCache
+from profiler import Profiler
+from snapshot_cache import SnapshotCache
+
+
+#===================== class JsonLinesFormatter =========================================================
+
+# one JSON object per log record, for the [local] log_json sink. Config.log records
+# have their tag, untagged message and iteration; other records just the message.
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'tag': getattr(record, 'tag', None),
+            'iteration': getattr(record, 'iteration', None),
+            'message': getattr(record, 'text', None)
+        }
+        if entry['message'] is None:
+            entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
 
 #===================== class Config =========================================================
 
 class Config(object):
     main = None # singleton instance
+    _log_listener = None  # see _start_log_sinks
 
+    # if args is given, message is a format string, only filled in (message % args) if
+    # the tag is wanted. Use this in hot paths.
     @classmethod
-    def log(cls, message, tag=None):
+    def log(cls, message, tag=None, args=None):
         if not Config.main:
             raise Exception("Config.main not set")
-        Config.main.ilog(message, tag)
+        Config.main.ilog(message, tag, args)
 
     def __init__(self, configFile):
         Config.main = self # singleton
@@ -39,6 +70,8 @@ class Config(object):
         self.symbols = {}
         self._rules_mask = {}
         self._debug_tags = {}
+        self._tag_filter = None  # compiled from _debug_tags
+        self._tag_decisions = {}  # tag -> want_log result
         self._template_extensions = {}
         self.log_to_console = False
         # special modes available on command line, and info about them
@@ -49,6 +82,7 @@ class Config(object):
             'ftp_clear': {},
             'im_meta_from_local': {},
             'restore_from_archive': {},
+            'plan': {},
             'test_deploy_test': {}
         }
         # TODO allow override via config
@@ -94,17 +128,39 @@ class Config(object):
                 format='%(asctime)s %(message)s',
                 datefmt='(%b %d %Y %H:%M:%S)',
                 level=loglevel)
+        self._start_log_sinks()
         logging.info("starting at %s" % self.display_times(self.start_time))
         logging.info("configFile is %s" % self.configFile)
         logging.info("working directory is %s" % os.getcwd())
         if self.is_true('local', 'log_config', absent_means_no=True):
             self.log_config()
+
+        # persistent content-hash cache, used by every u.md5 call
+        self.hash_cache = None
+        if self.is_true('local', 'use_hash_cache', absent_means_yes=True):
+            self.hash_cache = HashCache(self)
+        u.set_hash_cache(self.hash_cache)
+        # parsed symbol and rule files from earlier runs (see SnapshotCache)
+        self.snapshots = None
+        if self.is_true('local', 'use_snapshots', absent_means_yes=True):
+            self.snapshots = SnapshotCache(self)
+
         self._load_symbols()
         self._load_rules_to_run()
         self._load_debug_tags()
         self._load_template_extensions()
         self.log_to_console = self.is_true('local', 'log_to_console', absent_means_no=True)
 
+        # cache of plugin action outputs, used by plugins that support it
+        self.action_cache = None
+        if self.is_true('process', 'action_cache', absent_means_no=True):
+            self.action_cache = ActionCache(self)
+        # per-rule and per-action resource use, reported at end of run
+        self.profiler = None
+        if self.is_true('local', 'profile', absent_means_no=True):
+            self.profiler = Profiler(self)
+        u.set_profiler(self.profiler)
+
         # allow user to bail out on run by creating a signal file
         self._signal_file = self.get('actions', 'signal_file', return_none=True)
         if self._signal_file:
@@ -135,24 +191,37 @@ class Config(object):
                 raise Exception("TODO handle .py symbol files")
             sym_fname = self.admin + '/symbols/' + value
             try:
-                with open(sym_fname) as fh:
-                    for line in fh:
-                        if self._re['comment'].search(line):
-                            continue
-                        ar = re.split(self._re['symbol'], line.rstrip(), 1)
-                        if len(ar) == 2:
-                            if len(ar[0]):
-                                # value can be plain string, or JSON
-                                if ar[1].startswith('{'):
-                                    self.symbols[name][ar[0]] = json.loads(ar[1])
-                                else:
-                                    self.symbols[name][ar[0]] = ar[1]
-                        else:
-                            logging.error("bad line '%s' in symbol file '%s', ignoring" % (line, sym_fname))
+                if self.snapshots:
+                    symbols = self.snapshots.get('symbols_' + name, [sym_fname],
+                                                 lambda: self._read_symbol_file(sym_fname))
+                else:
+                    symbols = self._read_symbol_file(sym_fname)
+                if self.symbols[name]:
+                    self.symbols[name].update(symbols)
+                else:
+                    self.symbols[name] = symbols
             except Exception as exc:
                 logging.error("error reading symbol file '%s', ignoring" % sym_fname)
                 continue
 
+    def _read_symbol_file(self, sym_fname):
+        ret = {}
+        with open(sym_fname) as fh:
+            for line in fh:
+                if self._re['comment'].search(line):
+                    continue
+                ar = re.split(self._re['symbol'], line.rstrip(), 1)
+                if len(ar) == 2:
+                    if len(ar[0]):
+                        # value can be plain string, or JSON
+                        if ar[1].startswith('{'):
+                            ret[ar[0]] = json.loads(ar[1])
+                        else:
+                            ret[ar[0]] = ar[1]
+                else:
+                    logging.error("bad line '%s' in symbol file '%s', ignoring" % (line, sym_fname))
+        return ret
+
     def _load_rules_to_run(self):
         self._rules_mask.clear()
         val = self.get('actions', 'rules_to_run', return_none=True)
@@ -165,6 +234,10 @@ class Config(object):
         tags = self.get_multi('local', 'debug_tags')
         for tag in tags:
             self._debug_tags[tag] = True
+        self._tag_filter = None
+        if self._debug_tags:
+            self._tag_filter = re.compile('|'.join(re.escape(tag) for tag in self._debug_tags))
+        self._tag_decisions.clear()
 
     def _load_template_extensions(self):
         self._template_extensions.clear()
@@ -297,34 +370,87 @@ class Config(object):
         logging.info("\n".join(lines))
         logging.info("-----------------")
 
+    # persist caches that outlive the run. safe to call more than once.
+    def write_caches(self):
+        if self.hash_cache:
+            self.hash_cache.write()
+        if self.action_cache:
+            self.action_cache.write()
+
+    # add cache stats for the whole run (so no iteration number) to the final summary
+    def summarize_caches(self):
+        if self.action_cache:
+            self.final_summary += "action cache: %i hits, %i misses\n" % (
+                self.action_cache.hits, self.action_cache.misses)
+
     def add_to_final_summary(self, msg):
         if self.iteration is not None:
             self.final_summary += "(iter %i)" % self.iteration
         self.final_summary += msg + '\n'
 
+    # add the JSON-lines sink ([local] log_json, a file name in admin/logs) if configured,
+    # then, unless [local] log_async is false, put the log handlers behind a queue, so
+    # threads that log don't wait for the disk. The queue is drained by a background
+    # thread, stopped (after writing everything queued) at exit.
+    def _start_log_sinks(self):
+        Config._stop_log_queue()
+        root = logging.getLogger()
+        json_file = self.get('local', 'log_json', return_none=True)
+        if json_file:
+            log_dir = self.admin + '/logs'
+            u.ensure_path(log_dir)
+            full = log_dir + '/' + json_file
+            u.age_file(full, log_dir, move=True)
+            handler = logging.FileHandler(full, mode='w')
+            handler.setFormatter(JsonLinesFormatter())
+            root.addHandler(handler)
+        if not root.handlers or not self.is_true('local', 'log_async', absent_means_yes=True):
+            return
+        handlers = root.handlers[:]
+        for handler in handlers:
+            root.removeHandler(handler)
+        log_queue = queue.SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        Config._log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        Config._log_listener.start()
+
+    # write out queued log records, and go back to logging directly
+    @classmethod
+    def _stop_log_queue(cls):
+        if not cls._log_listener:
+            return
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            if isinstance(handler, logging.handlers.QueueHandler):
+                root.removeHandler(handler)
+        cls._log_listener.stop()
+        for handler in cls._log_listener.handlers:
+            root.addHandler(handler)
+        cls._log_listener = None
+
     # REVIEW - this matches prefixes so you can specify multiple
     # tags you want with one line in config. Could be extended to
     # regexes, include/exclude rules, etc. if needed.
+    # The answer for each tag is cached, since the same few tags are logged over and over.
     def want_log(self, tag):
-        if 'ALL' in self._debug_tags:
-            return True
-        for tag_prefix in self._debug_tags:
-            if tag.startswith(tag_prefix):
-                return True
-        return False
+        want = self._tag_decisions.get(tag)
+        if want is None:
+            want = 'ALL' in self._debug_tags or bool(self._tag_filter and self._tag_filter.match(tag))
+            self._tag_decisions[tag] = want
+        return want
 
     # most logging is done via class method. Only need this if you have
     # multiple config instances.
-    def ilog(self, message, tag=None):
-        if tag is None:
-            logging.info(message)
-            if self.log_to_console:
-                print(message)
-        elif self.want_log(tag):
-            msg = "<%s> %s" % (tag, message)
-            logging.info(msg)
-            if self.log_to_console:
-                print(msg)
+    def ilog(self, message, tag=None, args=None):
+        if tag is not None and not self.want_log(tag):
+            return
+        if args is not None:
+            message = message % args
+        msg = message if tag is None else "<%s> %s" % (tag, message)
+        # (extra is for the JSON-lines sink)
+        logging.info(msg, extra={'tag': tag, 'text': message, 'iteration': self.iteration})
+        if self.log_to_console:
+            print(msg)
 
     # return true if extension indicates file that can be templatized
     def is_template_type(self, file_name):
@@ -352,4 +478,7 @@ class Config(object):
         ret = self.get('process', 'default_page_wl_name', return_none=True)
         if not ret:
             ret = 'page_wl'
-        return ret
\ No newline at end of file
+        return ret
+
+# flush the log queue on the way out
+atexit.register(Config._stop_log_queue)
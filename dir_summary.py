@@ -0,0 +1,168 @@
+__author__ = 'dsteinkraus'
+
+import os
+import json
+import hashlib
+import logging
+
+#===================== class DirSummary =========================================================
+
+# per-directory summary of a file tree: for each directory, its files' count, total size and
+# max mtime, plus a hash of their (name, size, mtime_ns) entries, and the same rolled up over
+# the whole subtree, with a subtree hash combining the directory's own hash with its subdirs'.
+# Comparing a new scan to the saved one says which directories changed; a subtree whose hash
+# matches is unchanged all the way down, so callers can skip it (e.g. old dated folders).
+# Keys are paths relative to root with no leading slash, '' for root itself, matching the
+# path part of FileDest keys.
+# With trust_dir_mtime, a directory whose own mtime hasn't changed isn't listed and its files
+# aren't stat'ed again. That only notices files added, removed or renamed, not rewritten in
+# place, so only use it for trees that nothing outside floe rewrites.
+# context is anything else the saved summary is only good for (e.g. options); a saved
+# summary with a different root or context is ignored.
+# NOTE: this can't import Config (FileDest imports it before Config is set up), so it logs directly.
+class DirSummary(object):
+    def __init__(self, root, summary_file, trust_dir_mtime=False, context=None):
+        self.root = root
+        self.summary_file = summary_file
+        self.trust_dir_mtime = trust_dir_mtime
+        self.context = context
+        self.dirs = {}
+
+    def read(self):
+        self.dirs = {}
+        try:
+            with open(self.summary_file) as fh:
+                saved = json.load(fh)
+            if saved['root'] == self.root and saved.get('context') == self.context:
+                self.dirs = saved['dirs']
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            logging.warning("ignoring bad dir summary '%s': %s" % (self.summary_file, str(exc)))
+
+    def write(self):
+        tmp_file = self.summary_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump({'root': self.root, 'context': self.context, 'dirs': self.dirs}, fh)
+        os.replace(tmp_file, self.summary_file)
+
+    # return a new DirSummary for the tree as it is now (self is the previous one, used
+    # for trust_dir_mtime). The new one isn't saved; call write() when it's wanted.
+    def scan(self):
+        ret = DirSummary(self.root, self.summary_file, self.trust_dir_mtime, self.context)
+        if os.path.isdir(self.root):
+            self._scan_dir('', self.root, ret.dirs)
+        return ret
+
+    def _scan_dir(self, rel, full, out):
+        st = os.stat(full)
+        old = self.dirs.get(rel)
+        if self.trust_dir_mtime and old and old['dir_mtime_ns'] == st.st_mtime_ns:
+            rec = dict(old)
+        else:
+            entries = []
+            subdirs = []
+            size = 0
+            mtime = 0
+            with os.scandir(full) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        # like os.walk, don't follow links to directories
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+                    est = entry.stat()
+                    entries.append((entry.name, est.st_size, est.st_mtime_ns))
+                    size += est.st_size
+                    mtime = max(mtime, est.st_mtime)
+            entries.sort()
+            subdirs.sort()
+            rec = {
+                'dir_mtime_ns': st.st_mtime_ns,
+                'files': len(entries),
+                'size': size,
+                'mtime': mtime,
+                'entries_hash': hashlib.md5(json.dumps(entries).encode('utf-8')).hexdigest(),
+                'subdirs': subdirs
+            }
+        count = rec['files']
+        total_size = rec['size']
+        max_mtime = rec['mtime']
+        tree_hash = hashlib.md5(rec['entries_hash'].encode('utf-8'))
+        found_subdirs = []
+        for name in rec['subdirs']:
+            sub_rel = rel + '/' + name if rel else name
+            try:
+                sub = self._scan_dir(sub_rel, full + '/' + name, out)
+            except FileNotFoundError:
+                continue  # removed while we were looking
+            found_subdirs.append(name)
+            count += sub['tree_files']
+            total_size += sub['tree_size']
+            max_mtime = max(max_mtime, sub['tree_mtime'])
+            tree_hash.update(('%s\0%s\n' % (name, sub['tree_hash'])).encode('utf-8'))
+        rec['subdirs'] = found_subdirs
+        rec['tree_files'] = count
+        rec['tree_size'] = total_size
+        rec['tree_mtime'] = max_mtime
+        rec['tree_hash'] = tree_hash.hexdigest()
+        out[rel] = rec
+        return rec
+
+    # latest file mtime in the tree (0 if empty), as util.dir_last_modified would say
+    def max_mtime(self):
+        if '' in self.dirs:
+            return self.dirs['']['tree_mtime']
+        return 0
+
+    def tree_hash(self):
+        if '' in self.dirs:
+            return self.dirs['']['tree_hash']
+        return None
+
+    # set of directories whose own files differ from old's, or that are only in old.
+    # subtrees with matching hashes aren't looked at.
+    def changed_dirs(self, old):
+        ret = set()
+        self._changed('', old, ret)
+        return ret
+
+    def _changed(self, rel, old, ret):
+        rec = self.dirs.get(rel)
+        old_rec = old.dirs.get(rel)
+        if rec and old_rec and rec['tree_hash'] == old_rec['tree_hash']:
+            return
+        if not rec:
+            # gone: it and everything under it
+            if old_rec:
+                ret.update(d for d in old.dirs if d == rel or _is_under(d, rel))
+            return
+        if not old_rec or rec['entries_hash'] != old_rec['entries_hash']:
+            ret.add(rel)
+        names = set(rec['subdirs'])
+        if old_rec:
+            names.update(old_rec['subdirs'])
+        for name in names:
+            self._changed(rel + '/' + name if rel else name, old, ret)
+
+    # set of the topmost directories whose subtrees match old's, and contain none of
+    # the directories in exclude
+    def unchanged_subtrees(self, old, exclude=()):
+        ret = set()
+        self._unchanged('', old, exclude, ret)
+        return ret
+
+    def _unchanged(self, rel, old, exclude, ret):
+        rec = self.dirs.get(rel)
+        if not rec:
+            return
+        old_rec = old.dirs.get(rel)
+        if old_rec and rec['tree_hash'] == old_rec['tree_hash'] and \
+                not any(d == rel or _is_under(d, rel) for d in exclude):
+            ret.add(rel)
+            return
+        for name in rec['subdirs']:
+            self._unchanged(rel + '/' + name if rel else name, old, exclude, ret)
+
+def _is_under(path, rel):
+    return not rel or path.startswith(rel + '/')
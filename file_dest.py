@@ -4,12 +4,15 @@ import os
 import io
 import logging
 import re
-import copy
 import json
 import shutil
 import mimetypes
+import threading
+import concurrent.futures
 
 from config import Config
+from file_info import FileInfo
+from dir_summary import DirSummary
 import util as u
 
 #===================== class FileDest =========================================================
@@ -22,6 +25,8 @@ class FileDest(object):
         self.config_section = config_section
         self._file_dest_root = self.config.get(config_section, 'file_dest_root')
         self.tree_info = {}
+        # keys whose info changed since TreeProcessor.dest_process last looked (it clears this)
+        self.dirty_keys = set()
         self._tree_last_modified = 1e99
         # TODO REVIEW - config_section is not sufficient uniquifier, need to verify that
         # no other FileDest instance is using same uniquifier. (still true after postgres btw)
@@ -36,6 +41,37 @@ class FileDest(object):
             self._default_sync_options['refresh_dest_meta'] = True
         if config.is_true(self.config_section, 'skip_refresh_if_tree_unchanged', absent_means_no=True):
             self._default_sync_options['skip_refresh_if_tree_unchanged'] = True
+        # a refresh normally re-hashes only files whose size or mtime changed; paranoid hashes them all
+        if config.is_true(self.config_section, 'paranoid_refresh', absent_means_no=True):
+            self._default_sync_options['paranoid'] = True
+        self._refresh_workers = config.get_int(self.config_section, 'refresh_workers', default=4)
+        self._upload_workers = config.get_int(self.config_section, 'upload_workers', default=4)
+        # for sync_to_upstream_dest_mgr: how to make unchanged (non-template) files, and how many at once.
+        # copy by default; reflink shares data copy-on-write, so is as safe. hardlink (or auto,
+        # where reflink isn't supported) shares the file itself with upstream, so only use it if
+        # nothing rewrites upstream's files in place (floe's own writers unshare them first, see
+        # u.prepare_overwrite), or a change there shows up here too.
+        self._sync_copy_mode = config.get(self.config_section, 'sync_copy_mode', return_none=True) or 'copy'
+        if self._sync_copy_mode not in u.COPY_MODES:
+            raise Exception("%s: bad sync_copy_mode '%s', must be one of %s" %
+                            (self.config_section, self._sync_copy_mode, ', '.join(u.COPY_MODES)))
+        self._sync_workers = config.get_int(self.config_section, 'sync_workers', default=4)
+        # if > 0, sync_to_upstream_dest_mgr publishes each sync as a new generation of the tree,
+        # keeping this many (see _start_generation)
+        self._publish_generations = config.get_int(self.config_section, 'publish_generations', default=0)
+        if self._publish_generations > 0:
+            self._file_dest_root = self._file_dest_root.rstrip('/')
+        self._generations_root = self._file_dest_root + '.generations'
+        # tree info as of each generation, for rollback
+        self._generation_info_root = config.admin + '/_' + config_section + '_generations'
+        # per-directory summaries of the dest tree as of the last write_tree_info, and of the
+        # output tree as of the last upload_tree, so unchanged directories can be skipped
+        self._trust_dir_mtime = config.is_true(self.config_section, 'trust_dir_mtime', absent_means_no=True)
+        self._dir_summary = DirSummary(self._file_dest_root,
+                                       config.admin + '/_' + config_section + '_file_dest_dir_summary.json',
+                                       trust_dir_mtime=self._trust_dir_mtime)
+        # dest directories the last refresh found changed, or None if unknown (all may have)
+        self._changed_dest_dirs = None
 
     # upload a file with bare name srcName, in folder srcPath, to the destination.
     # this internal method does not deal with tree metadata
@@ -48,12 +84,38 @@ class FileDest(object):
                 }
             }
         if not content_type:
-            content_type = mimetypes.MimeTypes().guess_type(src_name)[0]
+            content_type = mimetypes.guess_type(src_name)[0]
             extra_args['ContentType'] = content_type
         dest_full = self._file_dest_root + '/' + key
         dest_dir, dest_name = os.path.split(dest_full)
         u.ensure_path(dest_dir)
-        shutil.copyfile(full, dest_full)
+        self._copy_into_place(full, dest_full)
+
+    # copy src to dest_full by way of a temp name in the same folder, so a reader of the
+    # dest (e.g. a web server) never sees a partly written file. mode is as for u.copy_file.
+    # Returns the mode used, and if want_md5 and the data was really copied, its md5
+    # (computed while copying), else None.
+    @staticmethod
+    def _copy_into_place(src, dest_full, mode='reflink', want_md5=False):
+        dest_dir, dest_name = os.path.split(dest_full)
+        tmp = '%s/.%s.upload%i' % (dest_dir, dest_name, threading.get_ident())
+        md5 = None
+        try:
+            u.remove_if_exists(tmp)
+            used = u.link_file(src, tmp, mode)
+            if not used:
+                if want_md5:
+                    md5 = u.copy_file_md5(src, tmp)
+                    used = 'copy'
+                else:
+                    used = u.copy_file(src, tmp, 'copy')
+            os.replace(tmp, dest_full)
+        except Exception:
+            u.remove_if_exists(tmp)
+            raise
+        if md5:
+            u.remember_md5(dest_full, md5)
+        return used, md5
 
     # use this to upload a file AND update local metadata
     def upload_finfo(self, finfo, content_type=None, extra_args=None):
@@ -66,7 +128,7 @@ class FileDest(object):
                 }
             }
         if not content_type:
-            content_type = mimetypes.MimeTypes().guess_type(finfo['name'])[0]
+            content_type = mimetypes.guess_type(finfo['name'])[0]
             extra_args['ContentType'] = content_type
         dest_full = self._file_dest_root + '/' + key
         dest_dir, dest_name = os.path.split(dest_full)
@@ -81,9 +143,11 @@ class FileDest(object):
         }
         # transfer other metadata
         self.transfer_metadata(finfo, local_root=self.local_root, dest=info)
-        self.tree_info[key] = info
+        self.tree_info[key] = FileInfo(info)
+        self.dirty_keys.add(key)
         u.ensure_path(dest_dir)
-        shutil.copyfile(finfo['full'], dest_full)
+        self._copy_into_place(finfo['full'], dest_full)
+        self._note_dest_stat(key)
 
     # upload some bytes as a new object in bucket
     def upload_obj(self, key, objBytes, contentType, bucket=None):
@@ -116,19 +180,44 @@ class FileDest(object):
         self._upload_count = 0
         # refresh and save data for files already on dest
         self.sync_tree_info(options=self._default_sync_options)
+        # output directories unchanged since the last upload_tree don't need their files looked
+        # at again, unless the dest changed under them or has files pending there
+        old_summary = DirSummary(local_root, self.config.admin + '/_' + self.config_section + '_upload_dir_summary.json',
+                                 trust_dir_mtime=self._trust_dir_mtime,
+                                 context={'max_upload_size': self._max_upload_size})
+        old_summary.read()
+        summary = old_summary.scan()
+        skip_trees = set()
+        skip_dirs = set()
+        if 'use_md5' in options and self._changed_dest_dirs is not None:
+            exclude = set(self._changed_dest_dirs)
+            exclude.update(key.rpartition('/')[0] for key in self.tree_info if self.is_pending(key))
+            skip_trees = summary.unchanged_subtrees(old_summary, exclude=exclude)
+            skip_dirs = set(summary.dirs) - summary.changed_dirs(old_summary) - exclude
+            Config.log("%i of %i output dirs unchanged since last upload", tag='FILE_DEST_UPLOAD_SKIP_DIRS',
+                       args=(len(skip_dirs), len(summary.dirs)))
 
+        # decide what to upload, then do the copies (see _upload_files)
+        uploads = []
         for dir_name, subdirs, files in os.walk(local_root):
             rel_path = u.make_rel_path(local_root, dir_name)
+            if rel_path.lstrip('/') in skip_trees:
+                subdirs[:] = []
+                continue
+            if rel_path.lstrip('/') in skip_dirs:
+                continue
             if not rel_path.startswith('/tmp'):
                 for file_name in files:
                     local_file = dir_name + '/' + file_name
                     key = u.make_key(rel_path, file_name)
-                    local_md5 = u.md5(local_file)
                     local_meta = None
                     if local_tree_meta and local_file in local_tree_meta:
                         local_meta = local_tree_meta[local_file]
                     else:
                         local_meta = u.local_metadata(dir_name, file_name)
+                    # the hash cache already knows the md5 of files TreeProcessor made or hashed,
+                    # keyed by their exact stat, so unchanged files aren't read again
+                    local_md5 = u.md5(local_file)
                     size = local_meta['size']
                     cached_info = None
                     if key in self.tree_info:
@@ -149,41 +238,73 @@ class FileDest(object):
                                           (key, size, self._max_upload_size))
                             do_upload = False
                     if do_upload:
-                        extra_args = {
-                            'Metadata': {'md5': local_md5}
-                        }
-                        logging.debug("FileDest object upload starting, key = '%s', %i bytes" %
-                                      (key, size))
-                        start = u.timestamp_now()
-                        self._upload(dir_name, file_name, key, extra_args=extra_args)
-                        rate = size / (u.timestamp_now() - start)
-                        Config.log("key = '%s', %f bytes/sec" % (key, rate), tag='FILE_DEST_UPLOAD_OK')
-                        # add metadata to our repos
-                        info = {
-                            'new': True,
-                            'name': file_name,
-                            'rel_path': rel_path,
-                            'key': key,
-                            'size': local_meta['size'],
-                            'modified': local_meta['modified'],
-                            # 'mod_dt': last_mod,
-                            # 'e_tag': obj.e_tag,
-                            'md5': local_md5
-                        }
-                        # transfer meta (e.g. thumbnail info) if exists
-                        if local_tree_meta and local_file in local_tree_meta:
-                            self.transfer_metadata(local_tree_meta[local_file], local_root=self.local_root, dest=info)
-
-                        self.tree_info[key] = info
-                        self._upload_count += 1
+                        uploads.append((dir_name, file_name, rel_path, key, local_meta, local_md5))
                     else:
-                        Config.log("key = '%s'" % key, tag='FILE_DEST_UPLOAD_NO_CHANGE')
+                        Config.log("key = '%s'", tag='FILE_DEST_UPLOAD_NO_CHANGE', args=(key,))
+        self._upload_files(uploads, local_tree_meta)
         self.write_tree_info()
+        summary.write()
         elapsed = u.timestamp_now() - start
         logging.info("FileDest.upload_tree finished in %f seconds, uploaded %i files" %
                      (elapsed, self._upload_count))
         return self._upload_count
 
+    # copy the files upload_tree decided on (list of (dir_name, file_name, rel_path, key,
+    # local_meta, md5)), upload_workers at a time, and record them in tree_info as they finish.
+    def _upload_files(self, uploads, local_tree_meta):
+        # worker name -> [files, bytes, seconds busy]
+        worker_stats = {}
+
+        def upload_one(job):
+            dir_name, file_name, rel_path, key, local_meta, local_md5 = job
+            logging.debug("FileDest object upload starting, key = '%s', %i bytes" % (key, local_meta['size']))
+            start = u.timestamp_now()
+            self._upload(dir_name, file_name, key, extra_args={'Metadata': {'md5': local_md5}})
+            return threading.current_thread().name, u.timestamp_now() - start
+
+        def finish(job, worker, elapsed):
+            dir_name, file_name, rel_path, key, local_meta, local_md5 = job
+            size = local_meta['size']
+            stats = worker_stats.setdefault(worker, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += elapsed
+            Config.log("key = '%s', worker %s, %f bytes/sec", tag='FILE_DEST_UPLOAD_OK',
+                       args=(key, worker, size / max(elapsed, 1e-6)))
+            # add metadata to our repos
+            info = {
+                'new': True,
+                'name': file_name,
+                'rel_path': rel_path,
+                'key': key,
+                'size': local_meta['size'],
+                'modified': local_meta['modified'],
+                # 'mod_dt': last_mod,
+                # 'e_tag': obj.e_tag,
+                'md5': local_md5
+            }
+            # transfer meta (e.g. thumbnail info) if exists
+            local_file = dir_name + '/' + file_name
+            if local_tree_meta and local_file in local_tree_meta:
+                self.transfer_metadata(local_tree_meta[local_file], local_root=self.local_root, dest=info)
+            self.tree_info[key] = FileInfo(info)
+            self._note_dest_stat(key)
+            self.dirty_keys.add(key)
+            self._upload_count += 1
+
+        if self._upload_workers > 1 and len(uploads) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._upload_workers,
+                                                       thread_name_prefix='upload') as pool:
+                # results come back in order; tree_info is only touched here, on this thread
+                for job, (worker, elapsed) in zip(uploads, pool.map(upload_one, uploads)):
+                    finish(job, worker, elapsed)
+        else:
+            for job in uploads:
+                finish(job, *upload_one(job))
+        for worker, (count, size, elapsed) in sorted(worker_stats.items()):
+            Config.log("worker %s: %i files, %i bytes in %f seconds, %f bytes/sec", tag='FILE_DEST_UPLOAD_OK_WORKER',
+                       args=(worker, count, size, elapsed, size / max(elapsed, 1e-6)))
+
     # walk the FileDest tree and get/store metadata for all objects
     def get_tree_info(self, bucket=None, remote_root=''):
             self.tree_info.clear()
@@ -200,20 +321,23 @@ class FileDest(object):
                     del local_meta['full']
                     del local_meta['path']
 
-                    self.tree_info[local_meta['key']] = local_meta
+                    self.tree_info[local_meta['key']] = FileInfo(local_meta)
 
     # return iterator for current tree_info
     def tree_info_items(self):
         self.sync_tree_info()
         return self.tree_info.items()
 
-    def write_tree_info(self):
+    # summary: a DirSummary of the dest tree as it is now, if the caller already has one
+    def write_tree_info(self, summary=None):
         try:
             shutil.copyfile(self._tree_info_file, self._tree_info_file + '.bak')
         except Exception as exc:
             logging.warning("ignoring exception '%s' persisting FileDest tree info" % str(exc))
         try:
-            self._tree_last_modified = u.dir_last_modified(self._file_dest_root)
+            if summary is None:
+                summary = self._dir_summary.scan()
+            self._tree_last_modified = summary.max_mtime()
             with open(self._tree_info_file, 'w') as fh:
                 fh.write('tree_last_modified ' + str(self._tree_last_modified) + '\n')
                 for key in self.tree_info:
@@ -221,7 +345,10 @@ class FileDest(object):
                     # clean out stuff we shouldn't persist
                     if 'groups' in finfo:
                         del finfo['groups']
-                    fh.write(json.dumps(finfo, cls=u.DateTimeEncoder) + '\n')
+                    fh.write(json.dumps(dict(finfo), cls=u.DateTimeEncoder) + '\n')
+            # the summary has to describe the same tree as the tree info just written
+            self._dir_summary = summary
+            summary.write()
         except Exception as exc:
             logging.info("writing file '%s, error %s" % (self._tree_info_file, str(exc)))
             raise
@@ -231,6 +358,8 @@ class FileDest(object):
         if dest is None:  # as opposed to falsy, like an empty dict
             dest = self.tree_info
         dest.clear()
+        if dest is self.tree_info:
+            self._dir_summary.read()
         try:
             with open(self._tree_info_file) as fh:
                 for line in fh:
@@ -239,7 +368,7 @@ class FileDest(object):
                         self._tree_last_modified = float(re.split(r'\s+', line)[1])
                         continue
                     info = json.loads(line, cls=u.DateTimeDecoder)
-                    dest[info['key']] = info
+                    dest[info['key']] = FileInfo(info)
         except Exception as exc:
             msg = "reading file '%s, error '%s'" % (self._tree_info_file, str(exc))
             Config.log(msg, tag='FILE_DEST_META_FILE_ERROR')
@@ -266,78 +395,165 @@ class FileDest(object):
         do_full_refresh = False
         if 'refresh_dest_meta' in options:
             do_full_refresh = options['refresh_dest_meta']
-        # computing all those md5s takes a long time, so optionally skip it if the most
-        # recent modification time for _file_dest_root is unchanged since we last did it
+        # explicit options (e.g. from sync_to_upstream_dest_mgr) don't turn off a configured paranoid_refresh
+        paranoid = options.get('paranoid', False) or self._default_sync_options.get('paranoid', False)
+        summary = None
+        # computing all those md5s takes a long time, so optionally skip it if the tree is
+        # unchanged since we last did it (same latest mtime and same directory summary)
         if 'skip_refresh_if_tree_unchanged' in options:
-            last_mod = u.dir_last_modified(self._file_dest_root)
+            summary = self._dir_summary.scan()
+            last_mod = summary.max_mtime()
             expected_last_mod = self._tree_last_modified
-            do_full_refresh = last_mod != expected_last_mod
+            do_full_refresh = last_mod != expected_last_mod or summary.tree_hash() != self._dir_summary.tree_hash()
             msg = "last_mod do_full_refresh = '%s', last_mod = '%f', expected_last_mod = '%f'" % (
                 do_full_refresh, last_mod, expected_last_mod)
             Config.log(msg, tag='FILE_DEST_META_TREE_UNCHANGED_TEST')
 
         if do_full_refresh:
-            # physically walk the tree as it might not match persisted data
-            for dir_name, subdirs, files in os.walk(self._file_dest_root):
-                for file_name in files:
-                    full_src = dir_name + '/' + file_name
-                    setit = False
+            # physically walk the tree as it might not match persisted data. Unless paranoid, only
+            # directories that changed since the tree info was written (see _changed_dirs)
+            if paranoid:
+                changed = None
+                found = []
+                for dir_name, subdirs, files in os.walk(self._file_dest_root):
                     rel_path = u.make_rel_path(self._file_dest_root, dir_name, strict=False, no_leading_slash=True)
-                    key = u.make_key(rel_path, file_name)
-                    local_meta = u.local_metadata(dir_name, file_name)
-                    local_meta['md5'] = u.md5(full_src)
-                    if key in self.tree_info:
-                        saved_meta = self.tree_info[key]
-                        if 'md5' not in saved_meta:
-                            saved_meta['md5'] = 'ERROR! md5 MISSING FROM tree_info!'
-                        if local_meta['md5'] == saved_meta['md5']:
-                            # sanity check
-                            if local_meta['size'] != saved_meta['size']:
-                                msg = "key '%s', saved: size %i, read: size %i" % (
-                                    key, saved_meta['size'], local_meta['size'])
-                                Config.log(msg, tag='FILE_DEST_META_ERROR_NONFATAL')
-                            # otherwise file is perfect, continue
-                        else:
-                            msg = "key '%s', md5 mismatch. saved: '%s', read: '%s'" % (
-                                    key, saved_meta['md5'], local_meta['md5'])
-                            Config.log(msg, tag='FILE_DEST_META_ERROR_FATAL')
-                            setit = True
+                    for file_name in files:
+                        st = os.stat(dir_name + '/' + file_name)
+                        found.append((u.make_key(rel_path, file_name), dir_name, file_name, st))
+            else:
+                if summary is None:
+                    summary = self._dir_summary.scan()
+                changed = self._changed_dirs(summary)
+                found = self._files_in_dirs(changed)
+                msg = "%i of %i dirs changed" % (len(changed), len(summary.dirs))
+                Config.log(msg, tag='FILE_DEST_META_CHANGED_DIRS')
+            md5s = self._refresh_md5s(found, paranoid=paranoid)
+            for key, dir_name, file_name, st in found:
+                setit = False
+                local_meta = u.local_metadata(dir_name, file_name, st=st)
+                local_meta['md5'] = md5s[key]
+                if key in self.tree_info:
+                    saved_meta = self.tree_info[key]
+                    if 'md5' not in saved_meta:
+                        saved_meta['md5'] = 'ERROR! md5 MISSING FROM tree_info!'
+                    if local_meta['md5'] == saved_meta['md5']:
+                        # sanity check
+                        if local_meta['size'] != saved_meta['size']:
+                            msg = "key '%s', saved: size %i, read: size %i" % (
+                                key, saved_meta['size'], local_meta['size'])
+                            Config.log(msg, tag='FILE_DEST_META_ERROR_NONFATAL')
+                        # otherwise file is perfect, continue
                     else:
-                        msg = "key '%s' not found in saved, adding" % key
-                        Config.log(msg, tag='FILE_DEST_META_NEW_FILE')
+                        msg = "key '%s', md5 mismatch. saved: '%s', read: '%s'" % (
+                                key, saved_meta['md5'], local_meta['md5'])
+                        Config.log(msg, tag='FILE_DEST_META_ERROR_FATAL')
                         setit = True
+                else:
+                    msg = "key '%s' not found in saved, adding" % key
+                    Config.log(msg, tag='FILE_DEST_META_NEW_FILE')
+                    setit = True
 
-                    if setit:
-                        local_meta['key'] = key
-                        self.tree_info[key] = local_meta
-                        # important: must never expose 'full' outside this class - it's a private
-                        # implementation detail. Same for 'path'. Only 'key' is public
-                        del local_meta['full']
-                        del local_meta['path']
-                        self.tree_info[key] = local_meta
-                    self.tree_info[key]['_found_file_'] = True
+                if setit:
+                    local_meta['key'] = key
+                    # important: must never expose 'full' outside this class - it's a private
+                    # implementation detail. Same for 'path'. Only 'key' is public
+                    del local_meta['full']
+                    del local_meta['path']
+                    self.tree_info[key] = FileInfo(local_meta)
+                    self.dirty_keys.add(key)
+                self.tree_info[key]['_found_file_'] = True
+                self.tree_info[key]['_dest_stat'] = [st.st_size, st.st_mtime_ns]
 
             missing = []
             for key in self.tree_info:
                 if '_found_file_' in self.tree_info[key]:
                     del self.tree_info[key]['_found_file_']
+                elif changed is not None and key.rpartition('/')[0] in summary.dirs and \
+                        key.rpartition('/')[0] not in changed:
+                    pass  # in an unchanged directory
                 else:
                     missing.append(key)
                     msg = "no file matching key '%s', deleting" % key
                     Config.log(msg, tag='FILE_DEST_META_MISSING')
             for key in missing:
                 del self.tree_info[key]
+                self.dirty_keys.discard(key)
 
-            self.write_tree_info()
+            # nothing on disk has changed since the scan, so the summary still holds
+            self.write_tree_info(summary=summary)
+            self._changed_dest_dirs = changed
             act = "completed"
         else:
             # trust the persisted file (faster)
+            self._changed_dest_dirs = set()
             act = "bypassed"
         elapsed = u.timestamp_now() - start
         msg = "%s confirmation of tree info in %f seconds" % (act, elapsed)
         Config.log(msg, tag='FILE_DEST_SYNC')
         self._synced_tree_info = True
 
+    # directories in summary (a fresh scan of the tree) whose files need looking at: those
+    # that changed since the tree info was written, and those whose tree info doesn't account
+    # for exactly the files there (e.g. entries pending, or not seen by a refresh yet).
+    def _changed_dirs(self, summary):
+        ret = summary.changed_dirs(self._dir_summary)
+        by_dir = {}
+        for key, finfo in self.tree_info.items():
+            by_dir.setdefault(key.rpartition('/')[0], []).append(finfo)
+        for rel, rec in summary.dirs.items():
+            if rel in ret:
+                continue
+            finfos = by_dir.get(rel, [])
+            if len(finfos) != rec['files'] or not all('_dest_stat' in finfo for finfo in finfos):
+                ret.add(rel)
+        return ret
+
+    # list of (key, dir_name, file_name, stat) for files directly in the dirs in rel_dirs
+    def _files_in_dirs(self, rel_dirs):
+        ret = []
+        for rel in sorted(rel_dirs):
+            dir_name = self._file_dest_root + '/' + rel if rel else self._file_dest_root
+            try:
+                with os.scandir(dir_name) as it:
+                    for entry in it:
+                        if not entry.is_dir():
+                            ret.append((u.make_key(rel, entry.name), dir_name, entry.name, entry.stat()))
+            except FileNotFoundError:
+                pass  # gone since the last refresh
+        return ret
+
+    # record the stat of the dest file for key, as a refresh would
+    def _note_dest_stat(self, key):
+        st = os.stat(self._file_dest_root + '/' + key)
+        self.tree_info[key]['_dest_stat'] = [st.st_size, st.st_mtime_ns]
+
+    # return {key: md5} for the files found by a refresh (list of (key, dir_name, file_name, stat)).
+    # Unless paranoid, a file whose size and mtime are what they were at the last refresh
+    # ('_dest_stat') keeps its saved md5; only the rest are read, in parallel.
+    def _refresh_md5s(self, found, paranoid=False):
+        ret = {}
+        to_hash = []
+        for key, dir_name, file_name, st in found:
+            saved_meta = self.tree_info.get(key)
+            if not paranoid and saved_meta and 'md5' in saved_meta and \
+                    saved_meta.get('_dest_stat') == [st.st_size, st.st_mtime_ns]:
+                ret[key] = saved_meta['md5']
+            else:
+                to_hash.append((key, dir_name + '/' + file_name))
+        # paranoid means really read the files, so don't take the hash cache's word either
+        use_cache = not paranoid
+        if self._refresh_workers > 1 and len(to_hash) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._refresh_workers) as pool:
+                md5s = pool.map(lambda full: u.md5(full, use_cache=use_cache), [full for key, full in to_hash])
+                ret.update(zip([key for key, full in to_hash], md5s))
+        else:
+            for key, full in to_hash:
+                ret[key] = u.md5(full, use_cache=use_cache)
+        msg = "%i files, %i hashed (paranoid = %s), %i unchanged since last refresh" % (
+            len(found), len(to_hash), paranoid, len(found) - len(to_hash))
+        Config.log(msg, tag='FILE_DEST_META_REFRESH')
+        return ret
+
     def is_pending(self, key):
         return key in self.tree_info and 'pending' in self.tree_info[key] and self.tree_info[key]['pending']
 
@@ -348,8 +564,12 @@ class FileDest(object):
         # don't overwrite info about non-pending (physically present) dest file.
         # exception is metadata, which might be new
         if key in self.tree_info and not self.is_pending(key):
+            before = dict(self.tree_info[key])
             self.transfer_metadata(finfo, local_root=self.local_root, dest=self.tree_info[key])
+            if dict(self.tree_info[key]) != before:
+                self.dirty_keys.add(key)
             return
+        self.dirty_keys.add(key)
         if 'md5' not in finfo:
             msg = "logic error in FileDest.track_file, no md5 for key '%s'" % finfo['key']
             logging.exception(msg)
@@ -365,7 +585,139 @@ class FileDest(object):
             'md5': finfo['md5']
         }
         self.transfer_metadata(finfo, local_root=self.local_root, dest=info)
-        self.tree_info[key] = info
+        self.tree_info[key] = FileInfo(info)
+
+    # Generations: with publish_generations, file_dest_root is a symlink to the current
+    # generation, a complete tree in <file_dest_root>.generations/gNNNNNN. A sync makes the
+    # next generation by hardlinking the files it keeps from the current one, writes only
+    # what changed, then swaps the symlink in one rename, so readers see either the old
+    # tree or the new one. The newest publish_generations are kept for rollback.
+    # (the first publish moves an existing plain directory aside as g000000.)
+
+    # sorted list of (number, path) of existing generations
+    def _generations(self):
+        ret = []
+        try:
+            names = os.listdir(self._generations_root)
+        except FileNotFoundError:
+            return ret
+        for name in names:
+            if re.match(r'^g\d{6}$', name):
+                ret.append((int(name[1:]), self._generations_root + '/' + name))
+        return sorted(ret)
+
+    # make the folder for the next generation, with links to all files of the current tree
+    # except those with keys in skip. returns its path.
+    def _start_generation(self, skip):
+        live_root = self._file_dest_root
+        u.ensure_path(self._generation_info_root)
+        # number of the live generation; a tree not published as generations yet will be g000000
+        current_num = 0
+        if os.path.islink(live_root):
+            current = os.path.realpath(live_root)
+            current_num = None
+            for num, path in self._generations():
+                if os.path.realpath(path) == current:
+                    current_num = num
+            if current_num is None:
+                raise Exception("%s: file_dest_root '%s' is a link, but not to one of its generations in '%s'" %
+                                (self.config_section, live_root, self._generations_root))
+        elif os.path.isdir(live_root):
+            # not published as generations yet; what's there will become g000000
+            self._save_generation_info(self._generations_root + '/g000000')
+        # anything newer than the live one was left by a sync that didn't finish
+        for num, path in self._generations():
+            if num > current_num:
+                self._drop_generation(path)
+        gen_dir = '%s/g%06i' % (self._generations_root, current_num + 1)
+        u.ensure_path(gen_dir)
+        start = u.timestamp_now()
+        linked = 0
+        for dir_name, subdirs, files in os.walk(live_root):
+            rel_path = u.make_rel_path(live_root, dir_name, strict=False, no_leading_slash=True)
+            new_dir = gen_dir + '/' + rel_path if rel_path else gen_dir
+            u.ensure_path(new_dir)
+            for file_name in files:
+                if u.make_key(rel_path, file_name) in skip:
+                    continue
+                os.link(dir_name + '/' + file_name, new_dir + '/' + file_name)
+                linked += 1
+        msg = "'%s', %i files linked from current in %f seconds" % (gen_dir, linked, u.timestamp_now() - start)
+        Config.log(msg, tag='FILE_DEST_GENERATION_START')
+        return gen_dir
+
+    # point file_dest_root at gen_dir, atomically
+    def _point_to(self, gen_dir):
+        live_root = self._file_dest_root
+        tmp_link = live_root + '.publishing'
+        u.remove_if_exists(tmp_link)
+        os.symlink(os.path.relpath(gen_dir, os.path.dirname(live_root)), tmp_link)
+        if os.path.isdir(live_root) and not os.path.islink(live_root):
+            # can't rename a link over a directory. this is the one non-atomic moment, first time only
+            os.rename(live_root, self._generations_root + '/g000000')
+        os.replace(tmp_link, live_root)
+
+    # make gen_dir the live tree and drop the oldest generations beyond publish_generations
+    def _publish(self, gen_dir):
+        self._point_to(gen_dir)
+        Config.log(gen_dir, tag='FILE_DEST_GENERATION_PUBLISHED')
+        current = os.path.realpath(self._file_dest_root)
+        for num, path in self._generations()[:-self._publish_generations]:
+            if os.path.realpath(path) != current:
+                self._drop_generation(path)
+
+    def _drop_generation(self, gen_dir):
+        shutil.rmtree(gen_dir, ignore_errors=True)
+        name = os.path.basename(gen_dir)
+        u.remove_if_exists(self._generation_info_root + '/' + name + '_tree_info.txt')
+        u.remove_if_exists(self._generation_info_root + '/' + name + '_dir_summary.json')
+        Config.log(gen_dir, tag='FILE_DEST_GENERATION_DROPPED')
+
+    # keep copies of the tree info (and dir summary) files describing gen_dir
+    def _save_generation_info(self, gen_dir):
+        name = os.path.basename(gen_dir)
+        if not os.path.exists(self._tree_info_file):
+            return  # nothing known about it, so it can't be rolled back to
+        shutil.copyfile(self._tree_info_file, self._generation_info_root + '/' + name + '_tree_info.txt')
+        if os.path.exists(self._dir_summary.summary_file):
+            shutil.copyfile(self._dir_summary.summary_file,
+                            self._generation_info_root + '/' + name + '_dir_summary.json')
+
+    # with publish_generations, make the generation before the current one live again, with
+    # the tree info it was published with, and drop the current one. returns True if it did.
+    def rollback(self):
+        if self._publish_generations <= 0:
+            Config.log(self.config_section, tag='FILE_DEST_ROLLBACK_NOT_ENABLED')
+            return False
+        gens = self._generations()
+        current = [(num, path) for num, path in gens
+                   if os.path.realpath(path) == os.path.realpath(self._file_dest_root)]
+        older = [path for num, path in gens if current and num < current[0][0]]
+        if not older:
+            Config.log("%s: no earlier generation to roll back to", tag='FILE_DEST_ROLLBACK_NONE',
+                       args=(self.config_section,))
+            return False
+        prev = older[-1]
+        name = os.path.basename(prev)
+        info_file = self._generation_info_root + '/' + name + '_tree_info.txt'
+        if not os.path.exists(info_file):
+            Config.log("%s: no tree info saved for '%s'", tag='FILE_DEST_ROLLBACK_NONE',
+                       args=(self.config_section, prev))
+            return False
+        self._point_to(prev)
+        shutil.copyfile(info_file, self._tree_info_file)
+        summary_file = self._generation_info_root + '/' + name + '_dir_summary.json'
+        if os.path.exists(summary_file):
+            shutil.copyfile(summary_file, self._dir_summary.summary_file)
+        else:
+            u.remove_if_exists(self._dir_summary.summary_file)
+        self.read_tree_info()
+        self._synced_tree_info = True
+        self._changed_dest_dirs = None
+        self.dirty_keys.update(self.tree_info.keys())
+        self._drop_generation(current[0][1])
+        Config.log("%s: now at '%s'", tag='FILE_DEST_ROLLBACK', args=(self.config_section, prev))
+        return True
 
     # sync our file tree to the file tree of an upstream dest_mgr (for now, must be another FileDest).
     # fixer is a function that will do any needed rewriting of the passed filename, in-place.
@@ -376,13 +728,18 @@ class FileDest(object):
         do_refresh = {'refresh_dest_meta': True}
         dont_refresh = {'refresh_dest_meta': False}
         smart_refresh = {'refresh_dest_meta': True, 'skip_refresh_if_tree_unchanged': True}
-        if refresh_me == 'full':
+        paranoid_refresh = {'refresh_dest_meta': True, 'paranoid': True}
+        if refresh_me == 'paranoid':
+            self.sync_tree_info(options=paranoid_refresh)
+        elif refresh_me == 'full':
             self.sync_tree_info(options=do_refresh)
         elif refresh_me == 'smart':
             self.sync_tree_info(options=smart_refresh)
         else:
             self.sync_tree_info(options=dont_refresh)
-        if refresh_upstream == 'full':
+        if refresh_upstream == 'paranoid':
+            upstream.sync_tree_info(options=paranoid_refresh)
+        elif refresh_upstream == 'full':
             upstream.sync_tree_info(options=do_refresh)
         elif refresh_upstream == 'smart':
             upstream.sync_tree_info(options=smart_refresh)
@@ -391,6 +748,8 @@ class FileDest(object):
 
         u.clear_folder(tmp_folder)
         start = u.timestamp_now()
+        # decide what to copy, then do the copies and fixups sync_workers at a time
+        jobs = []
         for key, finfo in upstream.tree_info_items():
             src = os.path.join(upstream._file_dest_root, key)
             if not os.path.exists(src):
@@ -399,23 +758,7 @@ class FileDest(object):
                 continue
             if self.config.is_template_type(finfo['name']) and fixer:
                 # copy and fix up
-                dest = os.path.join(tmp_folder, key)
-                u.ensure_path_for_file(dest)
-                shutil.copyfile(src, dest)
-                fixer(dest)
-                # make new metadata and copy to self
-                newfi = copy.deepcopy(finfo)
-                path, file = os.path.split(dest)
-                local_meta = u.local_metadata(path, file)
-                newfi['size'] = local_meta['size']
-                newfi['modified'] = local_meta['modified']
-                newfi['md5'] = u.md5(dest)
-                self.tree_info[key] = newfi
-                src = dest
-                dest = os.path.join(self._file_dest_root, key)
-                u.ensure_path_for_file(dest)
-                shutil.copyfile(src, dest)
-                # we could remove fixed-up file now, but clear_folder at end probably faster
+                jobs.append((key, src, finfo, True))
             else:
                 # file not subject to fixup. just copy if missing/older/diff size
                 copyit = False
@@ -429,23 +772,100 @@ class FileDest(object):
                 else:
                     copyit = True
                 if copyit:
-                    # REVIEW - deepcopy probably safe here because we're copying from
-                    # one dest mgr to another
-                    self.tree_info[key] = copy.deepcopy(finfo)
-                    dest = os.path.join(self._file_dest_root, key)
-                    u.ensure_path_for_file(dest)
-                    shutil.copyfile(src, dest)
+                    jobs.append((key, src, finfo, False))
+
+        # runs on a worker: returns copy mode used and md5 of what was written (None if linked)
+        def sync_one(job):
+            key, src, finfo, fixup = job
+            dest = os.path.join(self._file_dest_root, key)
+            u.ensure_path_for_file(dest)
+            if fixup:
+                fixed = os.path.join(tmp_folder, key)
+                u.ensure_path_for_file(fixed)
+                shutil.copyfile(src, fixed)
+                fixer(fixed)
+                # we could remove fixed-up file now, but clear_folder at end probably faster
+                return self._copy_into_place(fixed, dest, mode='copy', want_md5=True)
+            # same content as upstream, so it can share upstream's data if sync_copy_mode says so
+            return self._copy_into_place(src, dest, mode=self._sync_copy_mode, want_md5=True)
+
+        # runs on this thread, in order: tree_info is only changed here
+        def finish(job, mode, md5):
+            key, src, finfo, fixup = job
+            # copy, not deepcopy: values are replaced, never changed in place
+            newfi = FileInfo.of(finfo).copy()
+            # dest rule results are for upstream's rules run, not ours
+            newfi.pop('_dest_rules', None)
+            if fixup:
+                # make new metadata for the fixed-up file
+                st = os.stat(os.path.join(self._file_dest_root, key))
+                newfi['size'] = st.st_size
+                newfi['modified'] = int(st.st_mtime)
+                newfi['md5'] = md5
+            elif md5 and md5 != finfo['md5']:
+                msg = "key '%s', upstream says md5 '%s', copied '%s'" % (key, finfo['md5'], md5)
+                Config.log(msg, tag='FILE_DEST_SYNC_TO_UPSTREAM_MD5_MISMATCH')
+                newfi['md5'] = md5
+            self.tree_info[key] = newfi
+            # upstream's stat is for its own copy
+            self._note_dest_stat(key)
+            self.dirty_keys.add(key)
+            modes[mode] = modes.get(mode, 0) + 1
 
         # delete from me if not in upstream
-        to_delete = {}
-        for key, finfo in self.tree_info_items():
-            if key not in upstream.tree_info:
-                to_delete[key] = os.path.join(self._file_dest_root, finfo['key'])
-        for key, full in to_delete.items():
-            os.remove(full)
-            del self.tree_info[key]
+        to_delete = [key for key in self.tree_info if key not in upstream.tree_info]
+
+        # with publish_generations, the changes go into a new generation that is linked from the
+        # current one minus the files about to be replaced or deleted, and is published when done
+        live_root = self._file_dest_root
+        generation = None
+        if self._publish_generations > 0 and (jobs or to_delete):
+            generation = self._start_generation(skip=set(to_delete).union(job[0] for job in jobs))
+            self._file_dest_root = generation
+        try:
+            modes = {}
+            if self._sync_workers > 1 and len(jobs) > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self._sync_workers,
+                                                           thread_name_prefix='sync') as pool:
+                    for job, (mode, md5) in zip(jobs, pool.map(sync_one, jobs)):
+                        finish(job, mode, md5)
+            else:
+                for job in jobs:
+                    finish(job, *sync_one(job))
+            Config.log("%i files (%s)", tag='FILE_DEST_SYNC_TO_UPSTREAM_COPIED',
+                       args=(len(jobs), ', '.join('%s %i' % item for item in sorted(modes.items()))))
+
+            # deletions, as one batch. a new generation just doesn't have them
+            if to_delete:
+                def remove(key):
+                    u.remove_if_exists(os.path.join(self._file_dest_root, key))
+                if generation:
+                    pass
+                elif self._sync_workers > 1 and len(to_delete) > 1:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=self._sync_workers) as pool:
+                        list(pool.map(remove, to_delete))
+                else:
+                    for key in to_delete:
+                        remove(key)
+                for key in to_delete:
+                    del self.tree_info[key]
+                    self.dirty_keys.discard(key)
+                Config.log("%i files", tag='FILE_DEST_SYNC_TO_UPSTREAM_DELETED', args=(len(to_delete),))
+        except Exception:
+            if generation:
+                # the live tree wasn't touched; forget the half-made generation and its tree info
+                self._file_dest_root = live_root
+                shutil.rmtree(generation, ignore_errors=True)
+                self.read_tree_info()
+            raise
+        finally:
+            self._file_dest_root = live_root
 
+        if generation:
+            self._publish(generation)
         self.write_tree_info()
+        if generation:
+            self._save_generation_info(generation)
 
         # this is a space-saving move, but should be small, and might
         # be handy to have files around for debug. could be a config option.
@@ -0,0 +1,131 @@
+__author__ = 'dsteinkraus'
+
+import sys
+import copy
+from collections.abc import MutableMapping
+
+# metadata keys nearly every finfo has get a fixed slot; anything else is overflow
+_SLOT_KEYS = ('full', 'path', 'name', 'rel_path', 'key', 'md5', 'size', 'modified', 'rules_run')
+_SLOTS = frozenset(_SLOT_KEYS)
+# directory strings are shared by many files, so keep one copy of each
+_INTERNED = frozenset(('path', 'rel_path'))
+# overflow key tuples, shared by all FileInfos with the same overflow keys
+_key_sets = {(): ()}
+
+def _key_set(keys):
+    return _key_sets.setdefault(keys, keys)
+
+#===================== class FileInfo =========================================================
+
+# compact stand-in for the plain dicts we use for file metadata ("finfo"), for the big
+# tables: TreeProcessor.file_info and dest mgr tree_info. It behaves like a dict, so
+# plugins don't need to know. Common keys are stored in __slots__ rather than a hash
+# table, path components are interned, and md5 is stored as 16 bytes (still read back
+# as a hex string). Other keys are kept as a tuple of names, shared with every other
+# FileInfo that has the same ones, plus a list of values.
+# Unlike a dict it can't be passed straight to json.dumps - use dict(finfo).
+class FileInfo(MutableMapping):
+    __slots__ = _SLOT_KEYS + ('_xkeys', '_xvals')
+
+    def __init__(self, other=None):
+        self._xkeys = ()
+        self._xvals = None
+        if other:
+            for k, v in other.items():
+                self[k] = v
+
+    # return finfo if it's already a FileInfo, else a FileInfo copy of it
+    @classmethod
+    def of(cls, finfo):
+        if isinstance(finfo, cls):
+            return finfo
+        return cls(finfo)
+
+    def __getitem__(self, k):
+        if k in _SLOTS:
+            try:
+                v = getattr(self, k)
+            except AttributeError:
+                raise KeyError(k)
+            if k == 'md5' and type(v) is bytes:
+                return v.hex()
+            return v
+        try:
+            return self._xvals[self._xkeys.index(k)]
+        except ValueError:
+            raise KeyError(k)
+
+    def __setitem__(self, k, v):
+        if k in _SLOTS:
+            if k in _INTERNED and type(v) is str:
+                v = sys.intern(v)
+            elif k == 'md5' and type(v) is str and len(v) == 32:
+                try:
+                    v = bytes.fromhex(v)
+                except ValueError:
+                    pass  # keep whatever it is
+            setattr(self, k, v)
+            return
+        if k in self._xkeys:
+            self._xvals[self._xkeys.index(k)] = v
+            return
+        self._xkeys = _key_set(self._xkeys + (k,))
+        if self._xvals is None:
+            self._xvals = [v]
+        else:
+            self._xvals.append(v)
+
+    def __delitem__(self, k):
+        if k in _SLOTS:
+            try:
+                delattr(self, k)
+            except AttributeError:
+                raise KeyError(k)
+            return
+        try:
+            i = self._xkeys.index(k)
+        except ValueError:
+            raise KeyError(k)
+        self._xkeys = _key_set(self._xkeys[:i] + self._xkeys[i + 1:])
+        del self._xvals[i]
+        if not self._xvals:
+            self._xvals = None
+
+    def __contains__(self, k):
+        if k in _SLOTS:
+            return hasattr(self, k)
+        return k in self._xkeys
+
+    def __iter__(self):
+        for k in _SLOT_KEYS:
+            if hasattr(self, k):
+                yield k
+        yield from self._xkeys
+
+    def __len__(self):
+        return sum(1 for k in _SLOT_KEYS if hasattr(self, k)) + len(self._xkeys)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        ret = FileInfo()
+        for k in _SLOT_KEYS:
+            if hasattr(self, k):
+                setattr(ret, k, getattr(self, k))
+        ret._xkeys = self._xkeys
+        if self._xvals is not None:
+            ret._xvals = list(self._xvals)
+        return ret
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        # slot values are immutable (str, int, bool, bytes), so only overflow values need copying
+        ret = self.copy()
+        if self._xvals is not None:
+            ret._xvals = copy.deepcopy(self._xvals, memo)
+        return ret
+
+    def __reduce__(self):
+        return FileInfo, (dict(self),)
@@ -22,7 +22,7 @@ if len(sys.argv) > 2:
     config.set_special_mode(sys.argv[2:])
 
 try:
-    config.plugin = Plugin()
+    config.plugin = Plugin(cache_dir=config.admin)
     plugin_root = config.get('local', 'plugins', return_none=True)
     if plugin_root:
         logging.info("loading plugins from '%s'" % plugin_root)
@@ -99,6 +99,11 @@ try:
             sys.exit(1)
         if config.do('restore_from_archive'):
             tp.restore_from_archive(config.special_mode_args[1], options={'verbose': True})
+            config.write_caches()
+            sys.exit(1)
+        if config.do('plan'):
+            print(tp.plan())
+            config.write_caches()
             sys.exit(1)
         if config.do('test_deploy_test'):
             deploy_cycle = config.plugin.get('deploy_cycle')
@@ -106,6 +111,7 @@ try:
                 raise Exception("can't run test_deploy_test without both staging and production dest_mgrs")
             # run test/deployment cycle
             deploy_cycle(config, build_dest_mgr, staging_dest_mgr, production_dest_mgr, args=config.special_mode_args)
+            config.write_caches()
             sys.exit(2)
 
     # normal mode
@@ -151,10 +157,14 @@ try:
             tp.archive()
 
         build_dest_mgr.write_tree_info()
+        config.write_caches()
         tp.remove_unpacked_files()
         logging.info("completed iteration %i of %i" % (config.iteration, max_iter))
         config.iteration += 1
 
+    config.summarize_caches()
+    if config.profiler:
+        config.profiler.write()
     if config.final_summary:
         logging.info("Run summary:\n%s" % config.final_summary)
     logging.info("%s run complete." % config.display_times())
@@ -34,8 +34,12 @@ class FtpMgr(object):
         # this is used to store/persist metadata about directly downloaded files.
         # key has no path.
         self._local_files = {}
-        # this is populated by TreeProcessor
-        self.rules_run_files = []
+        # lines in metadata file, and whether it has everything in _local_files
+        # (if so, changes can just be appended to it)
+        self._dir_list_lines = 0
+        self._dir_list_synced = False
+        # this is populated by TreeProcessor (full paths of files processed this run)
+        self.rules_run_files = set()
 
         self._re_include = []
         self._re_exclude = []
@@ -130,6 +134,8 @@ class FtpMgr(object):
                 grabit = remotemod > localmod
             if grabit:
                 logging.info("grabbing new/changed file %s" % file_name)
+                # don't write through into hardlinked output copies
+                u.prepare_overwrite(local_full)
                 fh = open(local_full, "wb")
                 self._ftp.retrbinary('RETR ' + file_name, fh.write)
                 fh.close()
@@ -164,9 +170,12 @@ class FtpMgr(object):
     # test is a fn that returns bool based on finfo
     def read_metadata(self, test=None, action=None):
         self._local_files.clear()
+        self._dir_list_lines = 0
+        self._dir_list_synced = False
         try:
             with open(self._dir_list) as fh:
                 for line in fh:
+                    self._dir_list_lines += 1
                     line = line.rstrip()
                     finfo = json.loads(line)
                     if test:
@@ -180,6 +189,8 @@ class FtpMgr(object):
                         self._local_files[finfo['name']] = finfo
                     else:
                         self._local_files[finfo['name']] = finfo  # quiet
+            # later lines are updates to earlier ones (see _append_metadata)
+            self._dir_list_synced = not test
         except Exception as exc:
             logging.info("file '%s' not found/openable: '%s'" % (self._dir_list, str(exc)))
 
@@ -191,6 +202,19 @@ class FtpMgr(object):
         with open(self._dir_list, 'w') as fh:
             for fname, finfo in self._local_files.items():
                 fh.write(json.dumps(finfo, cls=u.DateTimeEncoder) + '\n')
+        self._dir_list_lines = len(self._local_files)
+        self._dir_list_synced = True
+
+    # persist just the given changed finfos, by appending them to the metadata file.
+    # rewrites the whole file instead if it's not in sync, or has too many stale lines.
+    def _append_metadata(self, finfos):
+        if not self._dir_list_synced or self._dir_list_lines + len(finfos) > 2 * len(self._local_files) + 100:
+            self.write_metadata()
+            return
+        with open(self._dir_list, 'a') as fh:
+            for finfo in finfos:
+                fh.write(json.dumps(finfo, cls=u.DateTimeEncoder) + '\n')
+        self._dir_list_lines += len(finfos)
 
     # update existing, or build a new metadata file from contents of input folder
     def metadata_from_local(self, clear_first=False):
@@ -209,19 +233,20 @@ class FtpMgr(object):
     # fix up loaded metadata (assumed current) by marking files with
     # 'rules_run', and write out to disk.
     def update_rules_run_files(self):
-        if len(self.rules_run_files):
-            for full in self.rules_run_files:
-                path, filename = os.path.split(full)
-                if filename not in self._local_files:
-                    err = "BUG: file '%s' is not in _local_files" % full
-                    Config.log(err, tag='FTP_INVALID_RULES_RUN_FILE')
-                    continue
-                finfo = self._local_files[filename]
-                if 'rules_run' not in finfo or not finfo['rules_run']:
-                    finfo['rules_run'] = True
-            del self.rules_run_files[:]
-        # have to do this every time, metadata may have been out of date already
-        self.write_metadata()
+        changed = []
+        for full in self.rules_run_files:
+            path, filename = os.path.split(full)
+            if filename not in self._local_files:
+                err = "BUG: file '%s' is not in _local_files" % full
+                Config.log(err, tag='FTP_INVALID_RULES_RUN_FILE')
+                continue
+            finfo = self._local_files[filename]
+            if 'rules_run' not in finfo or not finfo['rules_run']:
+                finfo['rules_run'] = True
+                changed.append(finfo)
+        self.rules_run_files.clear()
+        # metadata may have been out of date already; if so this writes all of it
+        self._append_metadata(changed)
 
     def get_downloaded_finfo(self, full):
         path, filename = os.path.split(full)
@@ -0,0 +1,102 @@
+__author__ = 'dsteinkraus'
+
+import os
+import json
+import logging
+import threading
+
+import util as u
+
+#===================== class HashCache =========================================================
+
+# persistent cache of file content hashes. An entry is keyed by the file's stat
+# signature (device, inode, size, mtime_ns), so a file is only re-read if one of those
+# has changed. Keying by signature rather than by path means hardlinked copies share
+# an entry. Entries not used for hash_cache_max_age_days are dropped when written.
+# NOTE: this can't import Config (Config owns the instance), so it logs directly.
+class HashCache(object):
+    def __init__(self, config):
+        self.config = config
+        self._cache_file = config.admin + '/_hash_cache.txt'
+        self._max_age_days = config.get_int('local', 'hash_cache_max_age_days', default=30)
+        # key is signature tuple, value is [md5, daynum when last used]
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._daynum = u.daynum_now()
+        self._changed = False
+        self.hits = 0
+        self.misses = 0
+        self.read()
+
+    @staticmethod
+    def signature(st):
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+    # return md5 of file, reading it only if its signature isn't cached
+    def md5(self, full):
+        sig = self.signature(os.stat(full))
+        with self._lock:
+            entry = self._entries.get(sig)
+            if entry:
+                self.hits += 1
+                if entry[1] != self._daynum:
+                    entry[1] = self._daynum
+                    self._changed = True
+                return entry[0]
+            self.misses += 1
+        ret = u.md5_file(full)
+        # store under signature taken before the read; if file changed while
+        # we were reading it, next stat won't match and it will be re-read.
+        with self._lock:
+            self._entries[sig] = [ret, self._daynum]
+            self._changed = True
+        return ret
+
+    # record a hash the caller already knows (e.g. computed while copying)
+    def put(self, full, md5):
+        sig = self.signature(os.stat(full))
+        with self._lock:
+            self._entries[sig] = [md5, self._daynum]
+            self._changed = True
+
+    # return cached md5 for file without computing it, or None
+    def peek(self, full, st=None):
+        if st is None:
+            try:
+                st = os.stat(full)
+            except OSError:
+                return None
+        entry = self._entries.get(self.signature(st))
+        if entry:
+            return entry[0]
+        return None
+
+    def read(self):
+        self._entries.clear()
+        try:
+            with open(self._cache_file) as fh:
+                for line in fh:
+                    dev, ino, size, mtime_ns, md5, daynum = json.loads(line)
+                    self._entries[(dev, ino, size, mtime_ns)] = [md5, daynum]
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            # cache is disposable, so just start over
+            logging.warning("ignoring error '%s' reading hash cache '%s'" % (str(exc), self._cache_file))
+            self._entries.clear()
+        self._changed = False
+
+    def write(self):
+        if not self._changed:
+            return
+        min_daynum = self._daynum - self._max_age_days
+        tmp_file = self._cache_file + '.tmp'
+        with self._lock:
+            with open(tmp_file, 'w') as fh:
+                for sig, (md5, daynum) in self._entries.items():
+                    if daynum < min_daynum:
+                        continue
+                    fh.write(json.dumps(list(sig) + [md5, daynum]) + '\n')
+            os.replace(tmp_file, self._cache_file)
+            self._changed = False
+        logging.info("hash cache written, %i hits, %i misses this run" % (self.hits, self.misses))
@@ -1,48 +1,137 @@
-import importlib.machinery
+import importlib.util
+import threading
+import logging
+import json
+import sys
+import ast
 import os
+import re
 
 class Plugin(object):
-    def __init__(self):
+    # cache_dir: where to keep the manifest import_folder makes (none if not given)
+    def __init__(self, cache_dir=None):
         self._registry = {}
+        # method name -> file of a module found by import_folder but not loaded yet
+        self._lazy = {}
+        self._manifest_file = cache_dir + '/_plugin_manifest.json' if cache_dir else None
+        self._lock = threading.RLock()
 
     # import methods from a .py file (which must have a register function)
-    # the file can be located anywhere
-    # note: this technique is nominally deprecated in python 3.4, but see
-    # https://bugs.python.org/issue21436 for why that isn't a big concern
-    # (and how to do it in 3.5+)
+    # the file can be located anywhere. Each file gets its own module name, so
+    # modules don't replace each other in sys.modules.
     def import_module(self, mod_file):
-        loader = importlib.machinery.SourceFileLoader("module.name", mod_file)
-        the_module = loader.load_module("module.name")
-        # mod = import_module(mod_name)
-        register_method = getattr(the_module, 'register')
-        for key, value in register_method().items():
-            if key in self._registry:
-                raise Exception("duplicate plugin method name '%s'" % key)
-            self._registry[key] = value
+        with self._lock:
+            name = 'floe_plugin_' + re.sub(r'\W', '_', os.path.abspath(mod_file)[:-len('.py')].lstrip('/'))
+            if name in sys.modules:
+                return  # already loaded
+            spec = importlib.util.spec_from_file_location(name, mod_file)
+            the_module = importlib.util.module_from_spec(spec)
+            sys.modules[name] = the_module
+            try:
+                spec.loader.exec_module(the_module)
+            except Exception:
+                del sys.modules[name]
+                raise
+            register_method = getattr(the_module, 'register')
+            for key, value in register_method().items():
+                if key in self._registry:
+                    raise Exception("duplicate plugin method name '%s'" % key)
+                self._registry[key] = value
+                self._lazy.pop(key, None)
 
     def call(self, method_name, *args, **kwargs):
-        if not method_name in self._registry:
+        if not self.have(method_name):
             raise Exception("no plugin method '%s' is registered" % method_name)
-        return self._registry[method_name](*args, **kwargs)
+        return self.get(method_name)(*args, **kwargs)
 
     def have(self, method_name):
-        return method_name in self._registry
+        return method_name in self._registry or method_name in self._lazy
 
+    # the module a method comes from is imported the first time it's asked for
     def get(self, method_name):
-        if self.have(method_name):
+        if method_name not in self._registry and method_name in self._lazy:
+            mod_file = self._lazy[method_name]
+            self.import_module(mod_file)
+            if method_name not in self._registry:
+                raise Exception("plugin '%s' did not register '%s' after all" % (mod_file, method_name))
+        if method_name in self._registry:
             return self._registry[method_name]
 
     def list(self, pretty=False):
+        names = list(self._registry.keys()) + list(self._lazy.keys())
         if pretty:
-            return "\n".join(self._registry.keys())
-        return self._registry.keys()
+            return "\n".join(names)
+        return names
 
-    # find all .py files in the path and load them
+    # find all .py files in the path and make their methods available. A module is
+    # only imported when one of its methods is first asked for (see get), so runs
+    # don't pay for plugins, and their dependencies, that they don't use. Which
+    # methods a file has is read from its register function without running it
+    # (see _registered_names), and kept in the manifest while the file is unchanged.
     def import_folder(self, path):
+        manifest = self._read_manifest()
+        new_manifest = {}
         for dir_name, subdirs, files in os.walk(path):
-            for file_name in files:
+            for file_name in sorted(files):
                 if not file_name.endswith('.py'):
                     continue
                 if file_name == '__init__.py':
                     continue # only there for static loading
-                self.import_module(dir_name + '/' + file_name)
+                mod_file = dir_name + '/' + file_name
+                st = os.stat(mod_file)
+                stamp = [st.st_size, st.st_mtime_ns]
+                entry = manifest.get(mod_file)
+                if not entry or entry['stamp'] != stamp:
+                    entry = {'stamp': stamp, 'names': self._registered_names(mod_file)}
+                new_manifest[mod_file] = entry
+                if entry['names'] is None:
+                    # can't tell without running it
+                    self.import_module(mod_file)
+                    continue
+                for key in entry['names']:
+                    if key in self._registry or key in self._lazy:
+                        raise Exception("duplicate plugin method name '%s'" % key)
+                    self._lazy[key] = mod_file
+        if new_manifest != manifest:
+            self._write_manifest(new_manifest)
+
+    # names in the dict literal that mod_file's register() returns, or None if it
+    # doesn't just return a dict literal with string keys
+    @staticmethod
+    def _registered_names(mod_file):
+        with open(mod_file) as fh:
+            tree = ast.parse(fh.read(), mod_file)
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef) and node.name == 'register':
+                if len(node.body) != 1 or not isinstance(node.body[0], ast.Return):
+                    return None
+                value = node.body[0].value
+                if not isinstance(value, ast.Dict):
+                    return None
+                names = []
+                for key in value.keys:
+                    if not isinstance(key, ast.Constant) or not isinstance(key.value, str):
+                        return None
+                    names.append(key.value)
+                return names
+        return None
+
+    def _read_manifest(self):
+        if not self._manifest_file:
+            return {}
+        try:
+            with open(self._manifest_file) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except Exception as exc:
+            logging.warning("ignoring bad plugin manifest '%s': %s" % (self._manifest_file, str(exc)))
+            return {}
+
+    def _write_manifest(self, manifest):
+        if not self._manifest_file:
+            return
+        tmp_file = self._manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump(manifest, fh, indent=1)
+        os.replace(tmp_file, self._manifest_file)
@@ -17,7 +17,8 @@ def web_handle(tp, finfo, argstr):
     argstr = u.debracket(argstr, tp.interpret, finfo=finfo)
     # logging.info("web_handle called, args = '%s'" % argstr)
     Config.log("args = '%s'" % argstr, tag='WEB_HANDLE_CALLED')
-    tp.web_maker.add_file(finfo, argstr)
+    # worklist order matters, so this is done on the main thread in parallel mode
+    tp.on_main(tp.web_maker.add_file, finfo, argstr)
 
 def is_protected_metadata(key):
     if key == 'full' or key == 'path' or key == 'name' or key == 'rules_run' or key == 'stop':
@@ -46,3 +47,7 @@ def set_file_info(tp, finfo, argstr):
                 finfo[key] = value
     except Exception as exc:
         logging.error("set_file_info exception '%s'" % str(exc))
+
+# only changes the finfo it's given, so TreeProcessor.dest_process needn't re-apply it
+# to dest keys that haven't changed (the result is persisted with the dest metadata)
+set_file_info.metadata_only = True
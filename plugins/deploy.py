@@ -60,6 +60,8 @@ def deploy_cycle(
             msg = "staging tests failed, won't deploy. %s" % str(results)
             Config.log(msg, tag='TDT_STAGING_TEST_FAIL')
             if not force_deploy:
+                # put staging back as it was, if it keeps generations
+                staging_dest_mgr.rollback()
                 return
 
         if no_deploy:
@@ -88,6 +90,9 @@ def deploy_cycle(
         if not ok:
             msg = "PRODUCTION TESTS FAILED, DEPLOYMENT IS BAD! %s" % str(results)
             Config.log(msg, tag='TDT_PRODUCTION_TEST_FAIL')
+            # if production keeps generations, go back to the last one published
+            if production_dest_mgr.rollback():
+                Config.log('', tag='TDT_PRODUCTION_ROLLED_BACK')
             return
         Config.log(str(results), tag='TDT_PRODUCTION_TEST_OK')
         Config.log('', tag='TDT_COMPLETE')
@@ -5,6 +5,9 @@ import copy
 import util as u
 from config import Config
 
+# bump when a change here changes output for the same args, to invalidate action cache entries
+ACTION_CACHE_VERSION = 1
+
 def register():
     return {
         'get_frame_count': get_frame_count,
@@ -73,13 +76,25 @@ def _extract_frames(src, dest_dir):
 def combine_frames(frame_list, dest_dir, dest_name, delay=None):
     try:
         u.ensure_path(dest_dir)
+        dest = dest_dir + '/' + dest_name
+        cache = Config.main.action_cache
+        if cache:
+            frames = [line.strip() for line in open(frame_list) if line.strip()]
+            cache_key = cache.key('combine_frames', ACTION_CACHE_VERSION, {'delay': delay},
+                                  [u.md5(frame) for frame in frames])
+            if cache.fetch(cache_key, dest) is not None:
+                Config.log(dest, tag='IM_COMBINE_FRAMES_CACHED')
+                return True
         runargs = ['convert']
         if delay is not None:
             runargs = runargs + ['-delay', delay]
-        runargs = runargs + ['@' + frame_list, '-loop', '0', dest_dir + '/' + dest_name]
+        runargs = runargs + ['@' + frame_list, '-loop', '0', dest]
+        u.prepare_overwrite(dest)
         (returncode, stdout, stderr) = u.run_command(runargs)
         logging.debug("convert returncode: %s\nstdout: %s\nstderr: %s" % (returncode, stdout, stderr))
         if returncode == 0:
+            if cache:
+                cache.store(cache_key, dest)
             return True
         else:
             logging.error("combine_frames failed with rc %i, stderr = '%s'" % (returncode, stderr))
@@ -109,24 +124,37 @@ def scale_and_copy(interp, finfo, argstr):
         ### TODO more copied stuff from copy_with_metadata!
         (dest_dir, dest_file) = os.path.split(dest)
         u.ensure_path(dest_dir)
-        call_args = ['convert', src, '-resize', size_str, dest]
-        (returncode, stdout, stderr) = u.run_command(call_args)
-        # logging.debug("returncode: %s\nstdout: %s\nstderr: %s" % (returncode, stdout, stderr))
-        if returncode == 0:
-            # we know the file that was created, so make its metadata now
-            newfi = {}
-            newfi['parent_full'] = finfo['full'] # provenance
-            newfi['name'] = dest_file
-            newfi['path'] = dest_dir
-            newfi['full'] = dest
-            newfi['rules_run'] = False
-            newfi.pop('groups', None)
-            # add thumb dimensions to metadata
-            newfi['width'], newfi['height'] = get_image_size(dest)
-            return {'new_finfo': newfi}
-        else:
-            logging.error("scale_and_copy failed with rc %i, stderr = '%s'" % (returncode, stderr))
-            return {}
+        cache = Config.main.action_cache
+        meta = None
+        if cache:
+            cache_args = dict(args)
+            del cache_args['dest']
+            cache_key = cache.key('scale_and_copy', ACTION_CACHE_VERSION, cache_args, [u.finfo_md5(finfo)])
+            meta = cache.fetch(cache_key, dest)
+        if meta is None:
+            # dest may be a hardlinked copy (see u.copy_file)
+            u.prepare_overwrite(dest, keep_content=(dest == src))
+            call_args = ['convert', src, '-resize', size_str, dest]
+            (returncode, stdout, stderr) = u.run_command(call_args)
+            # logging.debug("returncode: %s\nstdout: %s\nstderr: %s" % (returncode, stdout, stderr))
+            if returncode != 0:
+                logging.error("scale_and_copy failed with rc %i, stderr = '%s'" % (returncode, stderr))
+                return {}
+            meta = {}
+            meta['width'], meta['height'] = get_image_size(dest)
+            if cache:
+                cache.store(cache_key, dest, meta)
+        # we know the file that was created, so make its metadata now
+        newfi = {}
+        newfi['parent_full'] = finfo['full'] # provenance
+        newfi['name'] = dest_file
+        newfi['path'] = dest_dir
+        newfi['full'] = dest
+        newfi['rules_run'] = False
+        newfi.pop('groups', None)
+        # add thumb dimensions to metadata
+        newfi['width'], newfi['height'] = meta['width'], meta['height']
+        return {'new_finfo': newfi}
     except Exception as exc:
         logging.error("scale_and_copy exception '%s'" % str(exc))
         return {}
@@ -245,9 +273,22 @@ def captionize(interp, finfo, argstr):
         fixed_text = args['text'].replace("'", "\\'")
         params.append('"' + fixed_text + '"')
 
-        call_args = ['convert', src] + params + [ dest]
-        (returncode, stdout, stderr) = u.run_command(call_args)
-        # logging.debug("returncode: %s\nstdout: %s\nstderr: %s" % (returncode, stdout, stderr))
+        # no caching if captioning in place; the cached result can't be told from the input
+        cache = Config.main.action_cache if dest != src else None
+        cached = False
+        if cache:
+            cache_args = dict(args)
+            del cache_args['dest']
+            cache_key = cache.key('captionize', ACTION_CACHE_VERSION, cache_args, [u.finfo_md5(finfo)])
+            cached = cache.fetch(cache_key, dest) is not None
+        returncode = 0
+        if not cached:
+            u.prepare_overwrite(dest, keep_content=(dest == src))
+            call_args = ['convert', src] + params + [ dest]
+            (returncode, stdout, stderr) = u.run_command(call_args)
+            # logging.debug("returncode: %s\nstdout: %s\nstderr: %s" % (returncode, stdout, stderr))
+            if returncode == 0 and cache:
+                cache.store(cache_key, dest)
         if returncode == 0:
             # we know the file that was created, so make its metadata now
             newfi = {}
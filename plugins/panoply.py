@@ -1,10 +1,14 @@
 import logging
 import os
 import copy
+import threading
 
 import util as u
 from config import Config
 
+# bump when a change here changes output for the same args, to invalidate action cache entries
+ACTION_CACHE_VERSION = 1
+
 def register():
     return {'panoply': panoply}
 
@@ -77,7 +81,8 @@ def panoply(interp, finfo, argstr):
         script = u.debracket(template, interpret, symbols=symbols)
         script_path = Config.main.output + '/tmp'
         u.ensure_path(script_path)
-        script_file = script_path + '/' + action + '.pcl'
+        # one script per thread, as actions may run in parallel (see action_workers)
+        script_file = script_path + '/%s_%i.pcl' % (action, threading.get_ident())
         open(script_file, 'w').write(script)
 
         working_dir = Config.main.get('tools', 'panoply_workdir')
@@ -86,10 +91,24 @@ def panoply(interp, finfo, argstr):
             logging.error(err)
             raise Exception(err)
 
-        call_args = ['java', '-jar', jar, script_file]
-        (returncode, stdout, stderr) = u.run_command(call_args, working_dir)
-        logging.debug("returncode: %s\nstdout: %s\nstderr: %s" %
-                      (returncode, stdout, stderr))
+        cache = Config.main.action_cache
+        cached = False
+        if cache:
+            # the template is an input too
+            cache_args = dict(args)
+            del cache_args['dest']
+            cache_key = cache.key('panoply', ACTION_CACHE_VERSION, cache_args,
+                                  [u.finfo_md5(finfo), u.md5(template_file)])
+            cached = cache.fetch(cache_key, dest) is not None
+        returncode = 0
+        if not cached:
+            u.prepare_overwrite(dest)
+            call_args = ['java', '-jar', jar, script_file]
+            (returncode, stdout, stderr) = u.run_command(call_args, working_dir)
+            logging.debug("returncode: %s\nstdout: %s\nstderr: %s" %
+                          (returncode, stdout, stderr))
+            if returncode == 0 and cache:
+                cache.store(cache_key, dest)
         if returncode == 0:
             # we know the file that was created, so make its metadata now
             newfi = {}
@@ -1,6 +1,7 @@
 import logging
 import os
 import copy
+import threading
 
 import util as u
 from config import Config
@@ -38,7 +39,8 @@ def get_screenshot(interp, finfo, argstr):
         script = u.debracket(template, interpret, symbols=symbols)
         script_path = Config.main.output + '/tmp'
         u.ensure_path(script_path)
-        script_file = script_path + '/get_screenshot.js'
+        # one script per thread, as actions may run in parallel (see action_workers)
+        script_file = script_path + '/get_screenshot_%i.js' % threading.get_ident()
         open(script_file, 'w').write(script)
 
         working_dir = Config.main.get('tools', 'node_workdir')
@@ -47,6 +49,7 @@ def get_screenshot(interp, finfo, argstr):
             logging.error(err)
             raise Exception(err)
 
+        u.prepare_overwrite(dest)
         call_args = ['node', script_file]
         (returncode, stdout, stderr) = u.run_command(
             call_args, working_dir)
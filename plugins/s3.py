@@ -11,6 +11,7 @@ import calendar
 import mimetypes
 
 from config import Config
+from file_info import FileInfo
 import util as u
 
 # destination manager using Amazon S3. impleented as a plugin primarily so that
@@ -34,6 +35,8 @@ class S3(object):
         self.region = self.config.get(config_section, 'region')
         self.bucket = None
         self.tree_info = {}
+        # keys whose info changed since TreeProcessor.dest_process last looked (it clears this)
+        self.dirty_keys = set()
         self._tree_info_file = config.admin + '/' + '_s3_tree_info.txt'
         self._synced_tree_info = False
         self._max_upload_size = 1024 * 1024 * self.config.get_int(config_section, 'max_upload_size', default=-1)
@@ -166,7 +169,8 @@ class S3(object):
                         if local_tree_meta and local_file in local_tree_meta:
                             self.transfer_metadata(local_tree_meta[local_file], local_root=self.local_root, dest=info)
 
-                        self.tree_info[key] = info
+                        self.tree_info[key] = FileInfo(info)
+                        self.dirty_keys.add(key)
                         self._upload_count += 1
                     else:
                         logging.debug("S3 object not uploaded, key = '%s'" % key)
@@ -214,7 +218,7 @@ class S3(object):
             self.tree_info.clear()
             for obj in bucket.objects.all():
                 info = self.get_object_info(obj, bucket)
-                self.tree_info[info['key']] = info
+                self.tree_info[info['key']] = FileInfo(info)
 
     # return iterator for current tree_info
     def tree_info_items(self):
@@ -230,7 +234,7 @@ class S3(object):
         try:
             with open(self._tree_info_file, 'w') as fh:
                 for key in self.tree_info:
-                    fh.write(json.dumps(self.tree_info[key], cls=u.DateTimeEncoder) + '\n')
+                    fh.write(json.dumps(dict(self.tree_info[key]), cls=u.DateTimeEncoder) + '\n')
         except Exception as exc:
             logging.info("writing file '%s, error %s" % (self._tree_info_file, str(exc)))
             raise
@@ -244,7 +248,7 @@ class S3(object):
                 for line in fh:
                     line = line.rstrip()
                     info = json.loads(line, cls=u.DateTimeDecoder)
-                    dest[info['key']] = info
+                    dest[info['key']] = FileInfo(info)
         except Exception as exc:
             msg = "reading file '%s, error '%s'" % (self._tree_info_file, str(exc))
             Config.log(msg, tag='S3_DEST_META_FILE_ERROR')
@@ -295,8 +299,12 @@ class S3(object):
         # don't overwrite info about non-pending (physically present) dest file.
         # exception is metadata, which might be new
         if key in self.tree_info and not self.is_pending(key):
+            before = dict(self.tree_info[key])
             self.transfer_metadata(finfo, local_root=self.local_root, dest=self.tree_info[key])
+            if dict(self.tree_info[key]) != before:
+                self.dirty_keys.add(key)
             return
+        self.dirty_keys.add(key)
         if 'md5' not in finfo:
             msg = "logic error in FileDest.track_file, no md5 for key '%s'" % finfo['key']
             logging.exception(msg)
@@ -312,7 +320,7 @@ class S3(object):
             'md5': finfo['md5']
         }
         self.transfer_metadata(finfo, local_root=self.local_root, dest=info)
-        self.tree_info[key] = info
+        self.tree_info[key] = FileInfo(info)
 
     def transfer_metadata(self, finfo, local_root, dest):
         # TODO this can't be hard-coded for thumbs! generalize
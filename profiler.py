@@ -0,0 +1,132 @@
+__author__ = 'dsteinkraus'
+
+import json
+import time
+import logging
+import threading
+import contextlib
+
+import util as u
+
+# stats kept for each (rule label, action op)
+_ZERO = {
+    'count': 0,          # times the action ran
+    'wall': 0.0,         # seconds
+    'cpu': 0.0,          # seconds, of the thread running the action
+    'subprocesses': 0,   # started through u.run_command
+    'child_user': 0.0,   # seconds
+    'child_sys': 0.0,    # seconds
+    'child_max_rss': 0,  # KB, largest of any one subprocess
+    'bytes_written': 0   # size of the files the action made
+}
+
+#===================== class Profiler =========================================================
+
+# per-rule and per-action resource use for the whole run, turned on by [local] profile.
+# TreeProcessor counts each rule it applies and runs each action inside measure(); while
+# an action runs, subprocesses it starts through u.run_command add their rusage to it,
+# and it adds the size of files it makes (add_bytes). Measurements are kept per thread
+# until the action is done, so this works with action_workers.
+# At the end of the run, write() saves profile.json and a top-N table, profile.txt,
+# in admin/logs.
+# NOTE: installed in util by Config (like HashCache), so it logs directly.
+# Subprocess rusage comes from os.wait4, so is only available on Unix.
+class Profiler(object):
+    def __init__(self, config):
+        self.config = config
+        self._top_n = config.get_int('local', 'profile_top_n', default=20)
+        self._matches = {}  # label -> times a rule was applied
+        self._actions = {}  # (label, op) -> stats, see _ZERO
+        self._current = threading.local()
+        self._lock = threading.Lock()
+
+    def note_match(self, label):
+        with self._lock:
+            self._matches[label] = self._matches.get(label, 0) + 1
+
+    # time an action. the body sets 'ran' in the yielded dict to False if the action
+    # turned out not to run (e.g. an earlier 'stop', or skipped in incremental mode), so it
+    # isn't counted.
+    @contextlib.contextmanager
+    def measure(self, label, op):
+        stats = dict(_ZERO)
+        outer = getattr(self._current, 'stats', None)
+        self._current.stats = stats
+        status = {'ran': True}
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield status
+        finally:
+            stats['wall'] = time.perf_counter() - wall
+            stats['cpu'] = time.thread_time() - cpu
+            self._current.stats = outer
+            if status['ran']:
+                stats['count'] = 1
+                self._add((label, op), stats)
+
+    def _add(self, key, stats):
+        with self._lock:
+            total = self._actions.setdefault(key, dict(_ZERO))
+            for name, value in stats.items():
+                if name == 'child_max_rss':
+                    total[name] = max(total[name], value)
+                else:
+                    total[name] += value
+
+    # called by u.run_command with the rusage of a finished subprocess
+    def add_rusage(self, rusage):
+        stats = getattr(self._current, 'stats', None)
+        outside = stats is None
+        if outside:
+            stats = dict(_ZERO, count=1)
+        stats['subprocesses'] += 1
+        stats['child_user'] += rusage.ru_utime
+        stats['child_sys'] += rusage.ru_stime
+        stats['child_max_rss'] = max(stats['child_max_rss'], rusage.ru_maxrss)
+        if outside:
+            # not started by an action
+            self._add(('(none)', 'run_command'), stats)
+
+    def add_bytes(self, count):
+        stats = getattr(self._current, 'stats', None)
+        if stats is not None:
+            stats['bytes_written'] += count
+
+    def report(self):
+        with self._lock:
+            actions = [dict(stats, label=label, op=op) for (label, op), stats in self._actions.items()]
+            rules = {}
+            for label, matches in self._matches.items():
+                rules[label] = dict(_ZERO, label=label, matches=matches, count=0)
+            for stats in actions:
+                rule = rules.setdefault(stats['label'], dict(_ZERO, label=stats['label'], matches=0))
+                for name in _ZERO:
+                    if name == 'child_max_rss':
+                        rule[name] = max(rule[name], stats[name])
+                    else:
+                        rule[name] += stats[name]
+        by_wall = lambda stats: -stats['wall']
+        return {'rules': sorted(rules.values(), key=by_wall), 'actions': sorted(actions, key=by_wall)}
+
+    def write(self):
+        log_dir = self.config.admin + '/logs'
+        u.ensure_path(log_dir)
+        report = self.report()
+        with open(log_dir + '/profile.json', 'w') as fh:
+            json.dump(report, fh, indent=1)
+        lines = []
+        header = "%-24s %-16s %8s %8s %9s %9s %9s %9s %8s %10s" % (
+            'rule', 'action', 'matches', 'count', 'wall s', 'cpu s', 'child u s', 'child s s', 'max MB', 'MB written')
+        for title, rows in (('rules', report['rules']), ('actions', report['actions'])):
+            lines.append("top %i %s by wall time:" % (self._top_n, title))
+            lines.append(header)
+            for stats in rows[:self._top_n]:
+                lines.append("%-24s %-16s %8s %8i %9.2f %9.2f %9.2f %9.2f %8.1f %10.1f" % (
+                    str(stats['label'])[:24], stats.get('op', '')[:16], stats.get('matches', ''),
+                    stats['count'], stats['wall'], stats['cpu'], stats['child_user'], stats['child_sys'],
+                    stats['child_max_rss'] / 1024.0, stats['bytes_written'] / 1024.0 / 1024.0))
+            lines.append('')
+        with open(log_dir + '/profile.txt', 'w') as fh:
+            fh.write('\n'.join(lines))
+        logging.info("profile written to %s/profile.txt:\n%s" % (log_dir, '\n'.join(lines)))
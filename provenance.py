@@ -0,0 +1,195 @@
+__author__ = 'dsteinkraus'
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from config import Config
+import util as u
+
+#===================== class Provenance =========================================================
+
+# records, for each rule action that produced output files, a fingerprint of what went
+# into it (rule label, action text, input file path and md5, expanded args) and what came out
+# (finfos of the output files, plus any changes the action made to the input finfo).
+# In incremental mode, TreeProcessor looks up an action's fingerprint before running it;
+# if the recorded outputs are still there and unchanged, the action is skipped and its
+# results are restored from the record.
+# Each record also has a root: the input file (or archive, for unpacked files) its
+# source was ultimately made from. Records are kept across runs until the same action
+# runs again on the same source with a different fingerprint, or the root goes away;
+# then their outputs are removed (see prune), along with anything made from them.
+class Provenance(object):
+    def __init__(self, config):
+        self.config = config
+        self._file = config.admin + '/_provenance.txt'
+        # fingerprint -> record, from last run and this run
+        self._previous = {}
+        self._current = {}
+        # output full path -> record, for the same
+        self._previous_outputs = {}
+        self._current_outputs = {}
+        # unpack dir -> archive it was unpacked from
+        self._unpacked_from = {}
+        self.skipped = 0
+        self.recorded = 0
+        # lookups can come from action worker threads
+        self._lock = threading.Lock()
+        self.read()
+
+    @staticmethod
+    def fingerprint(label, action_text, finfo, argstr):
+        text = json.dumps([label, action_text, finfo['full'], u.finfo_md5(finfo), argstr])
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    # call at start of tree processing
+    def begin(self):
+        self._current = {}
+        self._current_outputs = {}
+        self._unpacked_from = {}
+        self.skipped = 0
+        self.recorded = 0
+
+    def note_unpacked(self, unpack_dir, archive_full):
+        self._unpacked_from[unpack_dir.rstrip('/') + '/'] = archive_full
+
+    # the input file that full was ultimately made from
+    def root_of(self, full):
+        for _ in range(100):  # guard against cycles
+            rec = self._current_outputs.get(full) or self._previous_outputs.get(full)
+            if rec:
+                return rec['root']
+            for unpack_dir, archive_full in self._unpacked_from.items():
+                if full.startswith(unpack_dir):
+                    full = archive_full
+                    break
+            else:
+                return full
+        return full
+
+    # true if the record for fp was already used (looked up or recorded) this run
+    def used(self, fp):
+        with self._lock:
+            return fp in self._current
+
+    # return the record for fp if its outputs are all still intact, else None.
+    # a returned record counts as used this run.
+    def lookup(self, fp):
+        rec = self._current.get(fp) or self._previous.get(fp)
+        if not rec:
+            return None
+        for out in rec['outputs']:
+            if not os.path.isfile(out['full']):
+                return None
+            if 'md5' in out and u.md5(out['full']) != out['md5']:
+                return None
+        with self._lock:
+            self._use(rec)
+            self.skipped += 1
+        Config.log("%s (%s)" % (rec['source'], rec['label']), tag='PROVENANCE_SKIP')
+        return rec
+
+    # remember what an action that ran this time produced
+    def record(self, fp, label, action_text, finfo, outputs, source_updates, source_changed):
+        if not outputs:
+            return  # nothing to check next time, so always rerun
+        rec = {
+            'fp': fp,
+            'label': label,
+            'action': action_text,
+            'source': finfo['full'],
+            'root': self.root_of(finfo['full']),
+            'outputs': [self._clean(out) for out in outputs],
+            'source_updates': source_updates,
+            'source_changed': source_changed
+        }
+        with self._lock:
+            self._use(rec)
+            self.recorded += 1
+
+    def _use(self, rec):
+        self._current[rec['fp']] = rec
+        for out in rec['outputs']:
+            self._current_outputs[out['full']] = rec
+
+    @staticmethod
+    def _clean(finfo):
+        ret = dict(finfo)
+        for key in ('groups', 'stop', 'source_im'):
+            ret.pop(key, None)
+        ret['rules_run'] = False
+        return ret
+
+    # true for a file made by an action in an earlier run, whose root is gone.
+    # such files will be pruned, so rules shouldn't be run on them.
+    def is_orphan(self, full):
+        if full in self._current_outputs or full not in self._previous_outputs:
+            return False
+        return not os.path.exists(self._previous_outputs[full]['root'])
+
+    # call at end of a complete run. keeps records from earlier runs that weren't used
+    # (their sources weren't processed this time) unless they were superseded or their
+    # root is gone; deletes output files of the ones dropped, recursively.
+    def prune(self):
+        ran = set((rec['source'], rec['label'], rec['action']) for rec in self._current.values())
+        doomed = set()
+        for fp, rec in self._previous.items():
+            if fp in self._current:
+                continue
+            if (rec['source'], rec['label'], rec['action']) in ran or not os.path.exists(rec['root']):
+                doomed.update(out['full'] for out in rec['outputs'])
+            else:
+                self._use(rec)
+        doomed -= set(self._current_outputs)
+        while doomed:
+            dropped = [rec for rec in self._current.values() if rec['source'] in doomed]
+            more = set()
+            for rec in dropped:
+                del self._current[rec['fp']]
+                for out in rec['outputs']:
+                    self._current_outputs.pop(out['full'], None)
+                    more.add(out['full'])
+            more -= doomed
+            if not more:
+                break
+            doomed |= more
+        for full in sorted(doomed):
+            if os.path.isfile(full):
+                Config.log(full, tag='PROVENANCE_PRUNE')
+                os.remove(full)
+        msg = "%i actions skipped, %i recorded, %i outputs pruned" % (self.skipped, self.recorded, len(doomed))
+        Config.log(msg, tag='PROVENANCE')
+        return doomed
+
+    def read(self):
+        self._previous = {}
+        self._previous_outputs = {}
+        try:
+            with open(self._file) as fh:
+                for line in fh:
+                    rec = json.loads(line)
+                    self._previous[rec['fp']] = rec
+                    for out in rec['outputs']:
+                        self._previous_outputs[out['full']] = rec
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            # without a record, everything is just rebuilt
+            msg = "ignoring error '%s' reading '%s'" % (str(exc), self._file)
+            Config.log(msg, tag='PROVENANCE_READ_ERROR')
+            self._previous = {}
+            self._previous_outputs = {}
+
+    # persist records; they become the previous records for the next run
+    def write(self):
+        tmp_file = self._file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            for rec in self._current.values():
+                fh.write(json.dumps(rec) + '\n')
+        os.replace(tmp_file, self._file)
+        self._previous = self._current
+        self._previous_outputs = self._current_outputs
+        self.begin()
+        logging.info("provenance written, %i records" % len(self._previous))
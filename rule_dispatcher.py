@@ -0,0 +1,135 @@
+__author__ = 'dsteinkraus'
+
+from config import Config
+import util as u
+
+#===================== class LiteralMatcher =========================================================
+
+# finds every occurrence of a set of literal strings in one pass over a target string
+# (Aho-Corasick). Transitions are precomputed with failure links folded in, so the scan
+# is a single dict lookup per character.
+class LiteralMatcher(object):
+    def __init__(self, literals):
+        self.literals = list(literals)
+        goto = [{}]
+        out = [[]]
+        for i_lit, literal in enumerate(self.literals):
+            state = 0
+            for ch in literal:
+                if ch not in goto[state]:
+                    goto.append({})
+                    out.append([])
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            out[state].append(i_lit)
+        # breadth-first, so a state's failure state is always finished before it
+        fail = [0] * len(goto)
+        self._delta = [None] * len(goto)
+        self._delta[0] = dict(goto[0])
+        queue = list(goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            delta = dict(self._delta[fail[state]])
+            delta.update(goto[state])
+            self._delta[state] = delta
+            for ch, child in goto[state].items():
+                fail[child] = self._delta[fail[state]].get(ch, 0)
+                out[child] = out[child] + out[fail[child]]
+                queue.append(child)
+        self._out = out
+
+    # return list of (literal index, index of last char of occurrence)
+    def scan(self, text):
+        ret = []
+        delta = self._delta
+        out = self._out
+        state = 0
+        for i, ch in enumerate(text):
+            state = delta[state].get(ch, 0)
+            if out[state]:
+                for i_lit in out[state]:
+                    ret.append((i_lit, i))
+        return ret
+
+#===================== class RuleDispatcher =========================================================
+
+# picks out, for a given finfo, the rules whose regex could possibly match it, without
+# running every rule's regex. Each rule's regex is reduced to the literal text any match
+# must start/end with (see u.regex_literal_affixes), and the longer of the two is used
+# to index the rule. Rules are grouped by literal, all literals are found with one scan
+# of the target, and only rules whose literal was found (or that have no literal) are
+# returned, in original order, so first-match and 'stop' semantics are unchanged.
+class RuleDispatcher(object):
+    def __init__(self, config, rules):
+        self.config = config
+        # rules disabled via rules_to_run can be dropped once, here
+        self._rules = [rule for rule in rules if config.run_rule(rule)]
+        # per target name: bitmask of rules without a usable literal, and
+        # literal -> list of (kind, bitmask of rules needing that literal/kind)
+        self._always = {}
+        self._by_literal = {}
+        for i_rule, rule in enumerate(self._rules):
+            bit = 1 << i_rule
+            target_name = rule['target_name']
+            self._always.setdefault(target_name, 0)
+            by_literal = self._by_literal.setdefault(target_name, {})
+            prefix, prefix_anchored, suffix, suffix_anchored = u.regex_literal_affixes(rule['regex'].pattern)
+            if not prefix and not suffix:
+                self._always[target_name] |= bit
+                continue
+            if len(suffix) > len(prefix):
+                literal, kind = suffix, 'ends' if suffix_anchored else 'contains'
+            else:
+                literal, kind = prefix, 'starts' if prefix_anchored else 'contains'
+            kinds = by_literal.setdefault(literal, {})
+            kinds[kind] = kinds.get(kind, 0) | bit
+        self._matchers = {}
+        for target_name, by_literal in self._by_literal.items():
+            literals = list(by_literal.keys())
+            self._matchers[target_name] = (LiteralMatcher(literals), [by_literal[lit] for lit in literals])
+        msg = "%i rules, %i distinct literals" % (
+            len(self._rules), sum(len(x) for x in self._by_literal.values()))
+        Config.log(msg, tag='RULE_DISPATCHER')
+
+    # bitmask of rules of one target name that might match target
+    def _candidate_mask(self, target_name, target):
+        mask = self._always[target_name]
+        matcher, kinds_list = self._matchers[target_name]
+        last = len(target) - 1
+        for i_lit, end in matcher.scan(target):
+            kinds = kinds_list[i_lit]
+            for kind, bits in kinds.items():
+                if kind == 'contains':
+                    mask |= bits
+                elif kind == 'starts':
+                    if end == len(matcher.literals[i_lit]) - 1:
+                        mask |= bits
+                elif end == last or (end == last - 1 and target.endswith('\n')):
+                    # 'ends': $ also matches just before a trailing newline
+                    mask |= bits
+        return mask
+
+    # generate (rule, target) pairs, in rule order, for rules that might match finfo.
+    # target is the normalized string the rule's regex should be run against.
+    def candidates(self, finfo, target_func):
+        targets = {}
+        mask = 0
+        for target_name in self._always:
+            try:
+                target = targets[target_name] = target_func(finfo, target_name)
+            except Exception:
+                # leave it to the rule's own test to report the problem, if reached
+                targets[target_name] = None
+                for i_rule, rule in enumerate(self._rules):
+                    if rule['target_name'] == target_name:
+                        mask |= 1 << i_rule
+                continue
+            mask |= self._candidate_mask(target_name, target)
+        while mask:
+            low = mask & -mask
+            rule = self._rules[low.bit_length() - 1]
+            target = targets[rule['target_name']]
+            if target is None:
+                target = target_func(finfo, rule['target_name'])
+            yield rule, target
+            mask ^= low
@@ -0,0 +1,67 @@
+__author__ = 'dsteinkraus'
+
+import gc
+import os
+import json
+import pickle
+import hashlib
+import logging
+import threading
+
+import util as u
+
+# bump if the form of anything snapshotted changes
+_VERSION = 1
+
+#===================== class SnapshotCache =========================================================
+
+# parsed forms of files read at startup (symbol files, the rule file), pickled in
+# admin/_snapshots so the next run can load them in one go instead of parsing again.
+# A snapshot is keyed by the md5s of the files it was made from, includes and all;
+# with the hash cache those are just a stat per file while the files are unchanged.
+# NOTE: like HashCache, this is owned by Config so it logs directly.
+class SnapshotCache(object):
+    def __init__(self, config):
+        self.config = config
+        self.root = config.admin + '/_snapshots'
+        u.ensure_path(self.root)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(name, sources):
+        text = json.dumps([_VERSION, name, [(source, u.md5(source)) for source in sources]])
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    # return the value build() made from the files in sources, from the snapshot
+    # called name if it's current, else by calling build() and saving a snapshot.
+    # the value must be picklable, and callers get their own copy of it.
+    def get(self, name, sources, build):
+        key = self._key(name, sources)
+        snap_file = self.root + '/' + name + '.pickle'
+        try:
+            # a big snapshot is lots of small objects; don't let the cyclic GC
+            # scan them over and over as they're made
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                with open(snap_file, 'rb') as fh:
+                    snap_key, value = pickle.load(fh)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            if snap_key == key:
+                self.hits += 1
+                return value
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            logging.warning("ignoring bad snapshot '%s': %s" % (snap_file, str(exc)))
+        self.misses += 1
+        value = build()
+        tmp_file = snap_file + '.tmp%i' % threading.get_ident()
+        with open(tmp_file, 'wb') as fh:
+            pickle.dump((key, value), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, snap_file)
+        logging.info("snapshot '%s' saved" % name)
+        return value
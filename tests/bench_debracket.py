@@ -0,0 +1,63 @@
+import sys
+import time
+
+if __name__ == '__main__' and __package__ is None:
+    from os import path
+    sys.path.append(path.abspath(path.join(path.dirname(__file__), '..')))
+
+import util as u
+
+# speed benchmark: debracket with compiled, cached templates vs the old parse-every-call
+# implementation (reproduced below).
+# usage: python bench_debracket.py [count]
+
+def old_fill_brackets(ar, interp, finfo=None, symbols=None, options=None):
+    if options is None:
+        options = {'allow_verbatim': True}
+    ret = ''
+    interpret = u.interpret_method(interp)
+    for item in ar:
+        val = item['value']
+        if item['is_symbol']:
+            newval = interpret(val, finfo=finfo, symbols=symbols, options=options)
+            if newval is not None:
+                ret += newval
+            else:
+                ret += '[' + val + ']'
+        else:
+            ret += val
+    return ret
+
+def old_debracket(st, interpret, finfo=None, symbols=None, options=None):
+    return old_fill_brackets(u.bracket_parse(st), interpret, finfo, symbols, options)
+
+SYMBOLS = {'output_root': '/data/floe/output', 'input_root': '/data/floe/input', '$1': '2018',
+           '$2': '03', '$3': '28', 'name': 'image_0001.gif', 'title': 'Sea surface temperature'}
+
+def interpret(val, finfo=None, symbols=None, options=None):
+    return SYMBOLS.get(val)
+
+CASES = {
+    # a 'copy to' dest, as in most rules
+    'copy dest': 'dest: [output_root]/static/[$1]/[$2][$3]_[name]',
+    # plugin args with no symbols left
+    'literal args': 'size: 200x200, quality: 85, format: gif',
+    # a page part: mostly literal html with a few symbols
+    'html part': ('<div class="item">\n  <a href="/static/[$1]/[name]">\n' +
+                  '    <img src="/static/[$1]/thumbs/[name]" alt="[title]"/>\n' +
+                  '  </a>\n  <span>[title] [$1]-[$2]-[$3]</span>\n</div>\n') * 4,
+}
+
+def measure(func, st, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func(st, interpret)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for label, st in CASES.items():
+        assert old_debracket(st, interpret) == u.debracket(st, interpret)
+        old = measure(old_debracket, st, count)
+        new = measure(u.debracket, st, count)
+        print("%-12s %i calls: old %.3fs, compiled %.3fs, %.1fx" % (label, count, old, new, old / new))
@@ -0,0 +1,59 @@
+import sys
+import gc
+import time
+import tracemalloc
+
+if __name__ == '__main__' and __package__ is None:
+    from os import path
+    sys.path.append(path.abspath(path.join(path.dirname(__file__), '..')))
+
+from file_info import FileInfo
+
+# memory benchmark: plain dict finfos vs FileInfo, for a file_info-like table.
+# usage: python bench_file_info.py [count]
+
+def make_finfo(i):
+    # roughly what track_file leaves for an output file: many files per directory
+    path = '/data/floe/output/static/%i/%02i' % (2000 + i % 20, i % 12)
+    name = 'image_%08i.gif' % i
+    rel_path = path[len('/data/floe/output'):].lstrip('/')
+    return {
+        'full': path + '/' + name,
+        'path': path,
+        'name': name,
+        'rel_path': rel_path,
+        'key': rel_path + '/' + name,
+        'md5': '%032x' % (i * 2654435761),
+        'size': 10000 + i,
+        'modified': 1500000000 + i,
+        'rules_run': True,
+        'thumb_full': path + '/thumbs/' + name
+    }
+
+def measure(count, convert):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    table = {}
+    for i in range(count):
+        finfo = make_finfo(i)
+        if convert:
+            finfo = FileInfo(finfo)
+        table[finfo['full']] = finfo
+    elapsed = time.time() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # read access, as rules and dest mgrs do
+    start = time.time()
+    for finfo in table.values():
+        _ = finfo['full'], finfo['md5'], 'thumb_full' in finfo
+    read_elapsed = time.time() - start
+    del table
+    return current, elapsed, read_elapsed
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    for label, convert in (('dict', False), ('FileInfo', True)):
+        mem, elapsed, read_elapsed = measure(count, convert)
+        print("%-8s %i entries: %7.1f MB, build %.2fs, read %.2fs" %
+              (label, count, mem / 1024.0 / 1024.0, elapsed, read_elapsed))
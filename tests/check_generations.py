@@ -0,0 +1,98 @@
+import sys
+import os
+import shutil
+import tempfile
+
+if __name__ == '__main__' and __package__ is None:
+    from os import path
+    sys.path.append(path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config import Config
+from file_dest import FileDest
+import util as u
+
+# check FileDest generation publishing (publish_generations) and rollback in a scratch
+# folder: publish, roll back (including to the g000000 made from the original tree),
+# publish again, and confirm the live tree always matches its tree info.
+# usage: python check_generations.py
+
+CONFIG = '''[actions]
+[input]
+[local]
+input = %(root)s/input
+output = %(root)s/output
+admin = %(root)s/admin
+archive = %(root)s/archive
+plugins = %(root)s/plugins
+logfile = check.log
+debug_tags = ALL
+[process]
+[symbols]
+[tools]
+[build]
+file_dest_root = %(root)s/build
+ignore_missing_persist_file = true
+refresh_dest_meta = true
+[staging]
+file_dest_root = %(root)s/staging
+ignore_missing_persist_file = true
+publish_generations = 3
+'''
+
+def live_files(root):
+    ret = {}
+    for dir_name, subdirs, files in os.walk(root):
+        rel_path = u.make_rel_path(root, dir_name, no_leading_slash=True)
+        for file_name in files:
+            ret[u.make_key(rel_path, file_name)] = u.md5_file(dir_name + '/' + file_name)
+    return ret
+
+def check(config, root, label, expect_keys):
+    staging = FileDest(config, 'staging')
+    staging.sync_tree_info(options={'refresh_dest_meta': False})
+    files = live_files(root + '/staging')
+    info = {key: finfo['md5'] for key, finfo in staging.tree_info.items()}
+    assert files == info, "%s: live tree %s doesn't match tree info %s" % (label, files, info)
+    assert sorted(files) == sorted(expect_keys), "%s: expected %s, have %s" % (label, expect_keys, sorted(files))
+    print("%-24s -> %-30s %s" % (label, os.readlink(root + '/staging'), sorted(files)))
+
+def publish(config, root):
+    staging = FileDest(config, 'staging')
+    staging.sync_to_upstream_dest_mgr(FileDest(config, 'build'), 'full', 'full', root + '/tmp')
+
+def rollback(config):
+    staging = FileDest(config, 'staging')
+    staging.sync_tree_info(options={'refresh_dest_meta': False})
+    return staging.rollback()
+
+if __name__ == '__main__':
+    root = tempfile.mkdtemp(prefix='floe_generations_')
+    try:
+        for folder in ('input', 'output', 'admin', 'archive', 'plugins', 'build', 'staging', 'tmp'):
+            os.makedirs(root + '/' + folder)
+        with open(root + '/check.config', 'w') as fh:
+            fh.write(CONFIG % {'root': root})
+        config = Config(root + '/check.config')
+        with open(root + '/staging/original.txt', 'w') as fh:
+            fh.write('original')
+        with open(root + '/build/a.txt', 'w') as fh:
+            fh.write('a')
+
+        publish(config, root)
+        check(config, root, 'publish', ['a.txt'])
+        # back to the tree that was there before generations (g000000)
+        assert rollback(config)
+        check(config, root, 'rollback to g000000', ['original.txt'])
+        publish(config, root)
+        check(config, root, 'publish after rollback', ['a.txt'])
+        with open(root + '/build/b.txt', 'w') as fh:
+            fh.write('b')
+        publish(config, root)
+        check(config, root, 'publish b', ['a.txt', 'b.txt'])
+        assert rollback(config)
+        check(config, root, 'rollback', ['a.txt'])
+        publish(config, root)
+        check(config, root, 'publish again', ['a.txt', 'b.txt'])
+        print('ok')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,76 @@
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+
+# check incremental mode in a scratch folder: a first run with clear_first = false and
+# incremental = true, with a rule whose output it also matches, must finish, and a
+# second run must skip the copy and leave the same output.
+# usage: python check_incremental.py
+
+FLOE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'floe.py'))
+
+CONFIG = '''[actions]
+max_iterations = 1
+archive = false
+[input]
+[local]
+input = %(root)s/input
+output = %(root)s/output
+admin = %(root)s/admin
+archive = %(root)s/archive
+plugins = %(root)s/plugins
+logfile = check.log
+debug_tags = ALL
+[process]
+rule_file = %(root)s/rules.config
+clear_first = false
+incremental = true
+[symbols]
+[tools]
+[build]
+file_dest_root = %(root)s/build
+ignore_missing_persist_file = true
+'''
+
+# the output, dat/x.dat, matches the rule too
+RULES = '''[label: cp2]
+if [full] like (.*)\\.dat$:
+    copy to [output_root]/dat/x.dat
+'''
+
+def run(root, label):
+    log_file = root + '/admin/logs/check.log'
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    proc = subprocess.run([sys.executable, FLOE, root + '/check.config'], cwd=root,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    with open(log_file) as fh:
+        log = fh.read()
+    assert 'FLOE_OUTER_EXCEPTION' not in log, "%s: run failed:\n%s" % (label, log)
+    assert proc.returncode == 0, "%s: exit code %i:\n%s" % (label, proc.returncode, proc.stdout)
+    with open(root + '/output/dat/x.dat') as fh:
+        assert fh.read() == 'a', "%s: wrong output" % label
+    skips = log.count('<PROVENANCE_SKIP>')
+    print("%-12s -> %i provenance skips" % (label, skips))
+    return skips
+
+if __name__ == '__main__':
+    root = tempfile.mkdtemp(prefix='floe_incremental_')
+    try:
+        for folder in ('input', 'output', 'admin', 'archive', 'plugins', 'build'):
+            os.makedirs(root + '/' + folder)
+        shutil.copy(os.path.join(os.path.dirname(FLOE), 'plugins', 'core.py'), root + '/plugins')
+        with open(root + '/check.config', 'w') as fh:
+            fh.write(CONFIG % {'root': root})
+        with open(root + '/rules.config', 'w') as fh:
+            fh.write(RULES)
+        with open(root + '/input/a.dat', 'w') as fh:
+            fh.write('a')
+
+        assert run(root, 'first run') == 0
+        assert run(root, 'second run') == 1
+        print('ok')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -4,11 +4,25 @@ import os
 import re
 import logging
 import copy
+import json
+import time
 import shutil
+import hashlib
+import threading
+import contextlib
+import concurrent.futures
 from config import Config
 
 import util as u
+from file_info import FileInfo
+from rule_dispatcher import RuleDispatcher
+from provenance import Provenance
+import unpacker
+from archive_manifest import ArchiveManifest
 
+# returned by a rule action that was skipped (incremental mode) rather than run: later
+# actions still run, but it isn't timed or profiled
+_SKIPPED = 'skipped'
 
 # =================================== class TreeProcessor ========================================
 
@@ -50,72 +64,153 @@ class TreeProcessor(object):
             self._re['unpack_files_wanted'] = re.compile(unpack_filter)
 
         self._always_unpack = self.config.is_true('process', 'always_unpack', absent_means_yes=True)
+        # which archive formats (file name suffixes, comma-separated) are unpacked: .tar.gz
+        # if not given, or 'all' for every format unpacker has. With 'all', plain .gz/.bz2/.xz
+        # files are only unpacked if unpack_single_files is on.
+        formats = config.get('process', 'unpack_formats', return_none=True) or '.tar.gz'
+        self._unpack_formats = None
+        if formats.strip() != 'all':
+            self._unpack_formats = set(fmt.strip() for fmt in formats.split(',') if fmt.strip())
+            unknown = self._unpack_formats - set(unpacker.suffixes())
+            if unknown:
+                raise Exception("unsupported unpack_formats '%s', must be 'all' or some of %s" %
+                                (', '.join(sorted(unknown)), ', '.join(unpacker.suffixes())))
+        self._unpack_single_files = self.config.is_true('process', 'unpack_single_files', absent_means_no=True)
+        # with unpack_workers > 1, archives are unpacked in the background while the walk
+        # goes on, and their files are walked once the walk is done (see _collect_unpacks)
+        self._unpack_workers = config.get_int('process', 'unpack_workers', default=0)
+        self._unpack_pool = None
+        self._unpacks = []  # (future, archive finfo) in submission order
+        # extract only archive members that some rule would act on (see _wants_member)
+        self._lazy_unpack = self.config.is_true('process', 'lazy_unpack', absent_means_no=True)
         self.unpack_root = self.config.input + u.unpack_marker()
         u.ensure_path(self.unpack_root)
         self.clear_first = self.config.is_true('process', 'clear_first',
                                                absent_means_yes=True)
         self.make_md5 = self.config.is_true('process', 'make_md5',
                                             absent_means_no=True)
+        # frontier mode: instead of re-walking the whole output tree on every pass,
+        # only visit files that were reported as new (via track_file, copy_with_metadata
+        # or plugin new_finfo returns). A full walk is still done once the queue runs dry,
+        # to catch files that plugins wrote without reporting them.
+        self._frontier_mode = self.config.is_true('process', 'frontier_mode', absent_means_no=True)
+        self._frontier = []
+        self._frontier_set = set()
+        # rule dispatch: 'compiled' (default) prefilters rules on literal text from their
+        # regexes; 'linear' tests every rule; 'compare' behaves like 'linear' but logs any
+        # match the compiled prefilter would have missed.
+        self._rule_dispatch = self.config.get('process', 'rule_dispatch', return_none=True)
+        if not self._rule_dispatch:
+            self._rule_dispatch = 'compiled'
+        if self._rule_dispatch not in ('compiled', 'linear', 'compare'):
+            raise Exception("unsupported rule_dispatch '%s'" % self._rule_dispatch)
+        self._dispatchers = {}
+        # parallel actions: with action_workers > 1, the actions of rules matched by
+        # different files run in a thread pool. Matching stays on the main thread, and
+        # changes actions make to shared state (see on_main) are applied on the main
+        # thread when each job is collected, in the order the files were visited.
+        self._action_workers = config.get_int('process', 'action_workers', default=0)
+        # how 'copy to' makes its copies (see u.copy_file). Linked copies are unshared
+        # before anything overwrites them, so they can be treated like real copies.
+        self._copy_mode = config.get('process', 'copy_mode', return_none=True) or 'copy'
+        if self._copy_mode not in u.COPY_MODES:
+            raise Exception("bad copy_mode '%s', must be one of %s" % (self._copy_mode, ', '.join(u.COPY_MODES)))
+        # how archive() works: rsync the output tree, or native (see _archive_native)
+        self._archiver = config.get('process', 'archiver', return_none=True) or 'rsync'
+        if self._archiver not in ('rsync', 'native'):
+            raise Exception("unsupported archiver '%s'" % self._archiver)
+        self._manifest = None  # ArchiveManifest, made when first needed
+        self._pool = None
+        self._jobs = []  # (future, effects) in submission order
+        self._thread_state = threading.local()
+        # incremental mode: skip actions whose input, args and outputs haven't changed
+        # since the last run (see Provenance). Only useful with clear_first off.
+        self._provenance = None
+        if self.config.is_true('process', 'incremental', absent_means_no=True):
+            if self.clear_first:
+                logging.warning("incremental mode has no effect with clear_first on")
+            self._provenance = Provenance(self.config)
+        # op -> [count, seconds] of actions that ran, over recent runs (see plan)
+        self._action_times_file = self.config.admin + '/_action_timings.json'
+        self._action_times = {}
+        self._read_action_times()
         self._parse_rules()
 
     # parse the rules config file into multi-line rules
     def _get_rules(self):
         try:
-            rules = []
-            cur_rule = {'condition': {}, 'actions': []}
             rule_file = self.config.get('process', 'rule_file', return_none=True)
-            if rule_file:
-                tmp_fh = u.process_includes(rule_file)
-                rule_lines = tmp_fh.read().splitlines()
-                tmp_fh.close()
-                logging.info("using rules from file %s" % rule_file)
-            else:
+            if not rule_file:
                 raise Exception("required config value 'rule_file' is missing")
-
-            # TODO add support for reformatting split lines
-
-            for line in rule_lines:
-                match = re.search(self._re['define'], line)
-                if match:
-                    key = match.group(1)
-                    val = u.debracket(match.group(2), self.interpret)
+            if self.config.snapshots:
+                steps = self.config.snapshots.get('rules', u.include_files(rule_file),
+                                                  lambda: self._read_rule_file(rule_file))
+            else:
+                steps = self._read_rule_file(rule_file)
+            logging.info("using rules from file %s" % rule_file)
+            rules = []
+            for step in steps:
+                if step[0] == 'define':
+                    # defines can refer to symbols, so are expanded each run
+                    key = step[1]
+                    val = u.debracket(step[2], self.interpret)
                     Config.log("'%s' = '%s'" % (key, val), tag='RULE_DEFINE')
                     self.symbols[key] = val
-                    continue
-                if re.search(self._re['comment'], line):
-                    continue  # allow commented or blank lines
-                match = self._re['header'].search(line)
-                if match:
-                    if cur_rule['condition']:
-                        rules.append(cur_rule)
-                        cur_rule = {'condition': {}, 'actions': []}
-                    cur_rule['props'] = u.comma_split(match.group(2))
-                    continue
-                match = self._re['cond'].search(line)
-                if match:
-                    if cur_rule['condition']:
-                        rules.append(cur_rule)
-                        cur_rule = {'condition': {}, 'actions': []}
-                    indent = match.group(1)  # not used at present
-                    cur_rule['condition']['text'] = match.group(2)
-                    continue
-                match = self._re['action'].search(line)
-                if match:
-                    if not cur_rule['condition']:
-                        raise Exception("Logic error 1  in rule line '%s'" % line)
-                    cur_rule['actions'].append({'text': match.group(2)})
-                    continue
-                raise Exception("Logic error 2 in rule line '%s'" % line)
-            if cur_rule['condition']:
-                if not cur_rule['actions']:
-                    err = "Rule has condition '%s' but no actions" % cur_rule['condition']['text']
-                    raise Exception(err)
-                rules.append(cur_rule)
+                else:
+                    rules.append(step[1])
             return rules
         except Exception as exc:
             Config.log(str(exc), tag='TP_RULES')
             raise
 
+    # the rule file as a list of ('define', name, unexpanded value) and ('rule', rule)
+    # steps, in file order. depends only on the file (and includes), so can be
+    # snapshotted.
+    def _read_rule_file(self, rule_file):
+        steps = []
+        cur_rule = {'condition': {}, 'actions': []}
+        tmp_fh = u.process_includes(rule_file)
+        rule_lines = tmp_fh.read().splitlines()
+        tmp_fh.close()
+
+        # TODO add support for reformatting split lines
+
+        for line in rule_lines:
+            match = re.search(self._re['define'], line)
+            if match:
+                steps.append(('define', match.group(1), match.group(2)))
+                continue
+            if re.search(self._re['comment'], line):
+                continue  # allow commented or blank lines
+            match = self._re['header'].search(line)
+            if match:
+                if cur_rule['condition']:
+                    steps.append(('rule', cur_rule))
+                    cur_rule = {'condition': {}, 'actions': []}
+                cur_rule['props'] = u.comma_split(match.group(2))
+                continue
+            match = self._re['cond'].search(line)
+            if match:
+                if cur_rule['condition']:
+                    steps.append(('rule', cur_rule))
+                    cur_rule = {'condition': {}, 'actions': []}
+                indent = match.group(1)  # not used at present
+                cur_rule['condition']['text'] = match.group(2)
+                continue
+            match = self._re['action'].search(line)
+            if match:
+                if not cur_rule['condition']:
+                    raise Exception("Logic error 1  in rule line '%s'" % line)
+                cur_rule['actions'].append({'text': match.group(2)})
+                continue
+            raise Exception("Logic error 2 in rule line '%s'" % line)
+        if cur_rule['condition']:
+            if not cur_rule['actions']:
+                err = "Rule has condition '%s' but no actions" % cur_rule['condition']['text']
+                raise Exception(err)
+            steps.append(('rule', cur_rule))
+        return steps
+
     # read rules and build a function to apply them in order
     def _parse_rules(self):
         del self._rule_funcs['self_tree'][:]
@@ -126,6 +221,7 @@ class TreeProcessor(object):
         for rule in rules:
             rule['label'] = None # ensure key exists
             rule['run_by_default'] = True
+            rule['serial'] = False
             rule_type = 'self_tree'  # the default
             if 'props' in rule:
                 for prop in rule['props']:
@@ -144,6 +240,10 @@ class TreeProcessor(object):
                     elif key == 'run_by_default':
                         if vals[0].lower() == 'false':
                             rule['run_by_default'] = False
+                    elif key == 'serial':
+                        # keep this rule's actions on the main thread, in file order
+                        if vals[0].lower() == 'true':
+                            rule['serial'] = True
                     else:
                         raise Exception("unsupported rule property key '%s'" % key)
             cond = rule['condition']['text']
@@ -177,56 +277,53 @@ class TreeProcessor(object):
                         continue
                 raise Exception("bad rule action specification '%s'" % action['text'])
             self._rule_funcs[rule_type].append(self._make_rule_impl(rule))
+        for rule_funcs in self._rule_funcs.values():
+            for i_rule, rule in enumerate(rule_funcs):
+                rule['index'] = i_rule
+        self._dest_rules_sig = None
+        self._dispatchers.clear()
+        if self._rule_dispatch != 'linear':
+            for rule_type, rule_funcs in self._rule_funcs.items():
+                self._dispatchers[rule_type] = RuleDispatcher(self.config, rule_funcs)
 
     def _make_rule_impl(self, rule):
         regex = None
         testrule = None
         tp = self
         label = rule['label']
+        match_tag = 'RULE_MATCH_%s' % label
+        action_tag = 'RULE_ACTION_%s' % label
 
         def test_regex_wrapper(target_name, regex):
-            def test_regex(finfo):
-                # local and dest finfos have different props. 'full', the full local path,
-                # should only be present in local finfos. 'key', a relative path to a content
-                # item, should only exist in dest finfos.
-                if target_name == 'full':
-                    if 'full' not in finfo:
-                        raise Exception("test_regex: target_name 'full' not available, finfo = %s" % str(finfo))
-                    target = finfo['full']
-                    # for easier rule-writing, get rid of unpacked suffix
-                    if u.unpack_marker() in target:
-                        target = target.replace(u.unpack_marker(), '', 1)
-                elif target_name == 'key':
-                    if 'key' not in finfo:
-                        raise Exception("test_regex: target_name 'key' not available, finfo = %s" % str(finfo))
-                    target = finfo['key']
-                else:
-                    raise Exception("invalid target_name '%s'" % target_name)
+            # test against an already-normalized target (see rule_target)
+            def match_target(finfo, target):
                 _ = label   # for conditional breakpoint
-                match = re.search(regex, target)
+                match = regex.search(target)
                 if match:
                     _ = label  # for conditional breakpoint
-                    msg = "target '%s', groups '%s'" % (target, str(match.groups()))
-                    Config.log(msg, tag='RULE_MATCH_' + label)
-                    finfo['groups'] = match.groups()
+                    groups = match.groups()
+                    Config.log("target '%s', groups '%s'", tag=match_tag, args=(target, groups))
+                    finfo['groups'] = groups
                     return True
                 return False
 
-            return test_regex
+            def test_regex(finfo):
+                return match_target(finfo, tp.rule_target(finfo, target_name))
+
+            return test_regex, match_target
 
         def apply_stop(finfo):
             # logging.info("stop, file %s in dir %s" % (finfo['name'], finfo['path']))
             if 'key' in finfo:
-                msg = "stop, key %s" % finfo['key']
+                Config.log("stop, key %s", tag='RULE_STOP', args=(finfo['key'],))
             else:
-                msg = "stop, file %s" % finfo['full']
-            Config.log(msg, tag='RULE_STOP')
+                Config.log("stop, file %s", tag='RULE_STOP', args=(finfo['full'],))
             # returning false means don't continue with more actions.
             # setting finfo prevents later rules from firing.
             finfo['stop'] = True
             return False
 
-        def apply_copy_wrapper(more):
+        def apply_copy_wrapper(more, action_text):
             def apply_copy(finfo):
                 if 'stop' in finfo:
                     del finfo['stop']
@@ -234,41 +331,85 @@ class TreeProcessor(object):
                 # source is assumed to be [full]
                 # more is assumed for now to only contain dest expr
                 dest = u.debracket(more, tp, finfo=finfo)
+                fp = None
+                # (copy_with_metadata refuses a self-copy; don't restore one either)
+                if tp._provenance and dest != finfo['full']:
+                    fp = Provenance.fingerprint(label, action_text, finfo, dest)
+                    used = tp._provenance.used(fp)
+                    rec = tp._provenance.lookup(fp)
+                    if rec:
+                        # if the record was already used this run, its output was restored
+                        # then, and queueing it again would only repeat that every pass
+                        if not used:
+                            newfi = FileInfo(rec['outputs'][0])
+                            tp.on_main(self.file_info.__setitem__, dest, newfi)
+                            tp.on_main(self._push_frontier, dest)
+                        return _SKIPPED
 
                 newfi = self.copy_with_metadata(finfo, dest)
                 if newfi:
+                    tp._profile_output(newfi)
                     # note that full path is the key here, not bare filename
-                    self.file_info[dest] = newfi
+                    tp.on_main(self.file_info.__setitem__, dest, newfi)
+                    if fp:
+                        tp.on_main(tp._provenance.record, fp, label, action_text, finfo, [newfi], {}, False)
                 return True
 
             return apply_copy
 
-        def apply_delete(finfo):
-            if 'stop' in finfo:
-                del finfo['stop']
-                return False
-            full = finfo['full']
+        def delete_file(full):
             if not full in self.file_info:
                 logging.warning("can't delete file '%s', not in output tree!" % full)
-                return True
+                return
             logging.info("deleting file '%s'" % full)
             os.remove(full)
             del self.file_info[full]
+
+        def apply_delete(finfo):
+            if 'stop' in finfo:
+                del finfo['stop']
+                return False
+            tp.on_main(delete_file, finfo['full'])
             return True
 
-        def apply_other_wrapper(other_func, more):
+        def apply_other_wrapper(other_func, more, action_text):
             def apply_other(finfo):
                 if 'stop' in finfo:
                     del finfo['stop']
                     return False
+                fp = None
+                # (dest rules' finfos have a key but no file, so nothing to fingerprint)
+                if tp._provenance and 'full' in finfo:
+                    fp = Provenance.fingerprint(label, action_text, finfo, tp._expand_args(more, finfo))
+                    used = tp._provenance.used(fp)
+                    rec = tp._provenance.lookup(fp)
+                    if rec:
+                        # (see apply_copy)
+                        if not used:
+                            for out in rec['outputs']:
+                                tp.on_main(self.track_file, dict(out))
+                        finfo.update(rec['source_updates'])
+                        if rec['source_changed']:
+                            tp.on_main(self.track_file, finfo)
+                        return _SKIPPED
+                    before = dict(finfo)
                 ret = other_func(tp, finfo, more)
-                msg = "func '%s' finfo '%s'" % (str(other_func), finfo['name'])
-                Config.log(msg, tag='RULE_ACTION_' + label)
+                Config.log("func '%s' finfo '%s'", tag=action_tag, args=(other_func, finfo['name']))
                 if ret is not None and type(ret) is dict:
                     if 'new_finfo' in ret:
-                        self.track_file(ret['new_finfo'])
+                        tp._profile_output(ret['new_finfo'])
+                        tp.on_main(self.track_file, ret['new_finfo'])
                     if 'source_changed' in ret:
-                        self.track_file(finfo)
+                        tp.on_main(self.track_file, finfo)
+                    if fp and 'new_finfo' in ret:
+                        updates = {}
+                        for key, value in finfo.items():
+                            if key in ('groups', 'stop', 'rules_run'):
+                                continue
+                            if key not in before or before[key] != value:
+                                updates[key] = value
+                        tp.on_main(tp._provenance.record, fp, label, action_text, finfo,
+                                   [ret['new_finfo']], updates, 'source_changed' in ret)
                 return True
 
             return apply_other
@@ -279,40 +420,190 @@ class TreeProcessor(object):
             if t != '[full]' and t != '[key]':
                 raise Exception("can't handle target expression '%s'" % t)
             target_name = t.lstrip('[').rstrip(']')
-            ar = u.bracket_parse(rule['condition']['regex'])
-            fixed_re = u.fill_brackets(ar, self.interpret)
+            fixed_re = u.debracket(rule['condition']['regex'], self.interpret)
             regex = re.compile(fixed_re)
-            testrule = test_regex_wrapper(target_name, regex)
+            testrule, match_target = test_regex_wrapper(target_name, regex)
         else:
             raise Exception("can't handle non-regex condition '%s'" % rule['condition']['text'])
 
         # parse action(s):
         funcs = []
+        stops = False
+        stop_only = True
+        # true if the rule's only effects are on the finfo it's applied to (see dest_process)
+        metadata_only = True
         for action in rule['actions']:
+            if action['op'] != 'stop':
+                stop_only = False
+                if not getattr(action.get('other_func'), 'metadata_only', False):
+                    metadata_only = False
             # internally implemented:
             if action['op'] == 'copy':
-                funcs.append(apply_copy_wrapper(action['more']))
+                func = apply_copy_wrapper(action['more'], action['text'])
             elif action['op'] == 'stop':
-                funcs.append(apply_stop)
+                func = apply_stop
+                stops = True
             elif action['op'] == 'delete':
-                funcs.append(apply_delete)
+                func = apply_delete
             else:
                 # external tools: (name is vetted later)
-                funcs.append(
-                    apply_other_wrapper(action['other_func'], action['more']))
+                func = apply_other_wrapper(action['other_func'], action['more'], action['text'])
+            funcs.append((action['op'], func))
 
         def apply_funcs(finfo):
-            for f in funcs:
-                if not f(finfo):
+            profiler = tp.config.profiler
+            if profiler:
+                profiler.note_match(label)
+            for op, f in funcs:
+                start = time.perf_counter()
+                with profiler.measure(label, op) if profiler else contextlib.nullcontext({}) as status:
+                    result = f(finfo)
+                    status['ran'] = result is True
+                if not result:
                     break
+                if result is True:
+                    # (an action that ran; see plan)
+                    tp.on_main(tp._note_action_time, op, time.perf_counter() - start)
 
         return {
             'label': rule['label'],
             'test': testrule,
+            'match': match_target,
+            'target_name': target_name,
+            'regex': regex,
             'apply': apply_funcs,
-            'run_by_default': rule['run_by_default']
+            'run_by_default': rule['run_by_default'],
+            'serial': rule['serial'],
+            'stops': stops,
+            'stop_only': stop_only,
+            'metadata_only': metadata_only,
+            'actions': [(action['op'], action.get('more'), action['text']) for action in rule['actions']],
+            # everything that determines what the rule does, for dest_process
+            'text': json.dumps([label, rule['condition']['text'], [action['text'] for action in rule['actions']],
+                                rule['run_by_default'], rule['serial']])
         }
 
+    # action args as the action will see them, for fingerprinting. some actions
+    # have their own syntax, so fall back to the raw text.
+    def _expand_args(self, argstr, finfo):
+        try:
+            return u.debracket(argstr, self.interpret, finfo=finfo)
+        except Exception:
+            return argstr
+
+    # get the string a rule condition is tested against.
+    # local and dest finfos have different props. 'full', the full local path,
+    # should only be present in local finfos. 'key', a relative path to a content
+    # item, should only exist in dest finfos.
+    def rule_target(self, finfo, target_name):
+        if target_name == 'full':
+            if 'full' not in finfo:
+                raise Exception("test_regex: target_name 'full' not available, finfo = %s" % str(finfo))
+            target = finfo['full']
+            # for easier rule-writing, get rid of unpacked suffix
+            if u.unpack_marker() in target:
+                target = target.replace(u.unpack_marker(), '', 1)
+            return target
+        if target_name == 'key':
+            if 'key' not in finfo:
+                raise Exception("test_regex: target_name 'key' not available, finfo = %s" % str(finfo))
+            return finfo['key']
+        raise Exception("invalid target_name '%s'" % target_name)
+
+    # generate the rules of rule_type that match finfo, in order, until a 'stop'.
+    # the caller applies each rule before asking for the next one.
+    def _matching_rules(self, rule_type, finfo):
+        if self._rule_dispatch == 'compiled':
+            for rule, target in self._dispatchers[rule_type].candidates(finfo, self.rule_target):
+                if 'stop' in finfo:
+                    return
+                if rule['match'](finfo, target):
+                    yield rule
+            return
+        candidates = None
+        if self._rule_dispatch == 'compare':
+            candidates = set(id(rule) for rule, _ in
+                             self._dispatchers[rule_type].candidates(finfo, self.rule_target))
+        for rule in self._rule_funcs[rule_type]:
+            if not self.config.run_rule(rule):
+                continue
+            if 'stop' in finfo:
+                return
+            if rule['test'](finfo):
+                if candidates is not None and id(rule) not in candidates:
+                    msg = "rule '%s' matched '%s' but was not a compiled candidate" % (
+                        rule['label'], self.rule_target(finfo, rule['target_name']))
+                    Config.log(msg, tag='TP_RULE_DISPATCH_MISMATCH')
+                yield rule
+
+    # run rules of rule_type against finfo, in order, until a 'stop'
+    def _run_rules(self, rule_type, finfo):
+        if self._pool and rule_type == 'self_tree':
+            return self._submit_rules(finfo)
+        matched = False
+        for rule in self._matching_rules(rule_type, finfo):
+            matched = True
+            rule['apply'](finfo)
+        return matched
+
+    # parallel version of _run_rules: match here, then hand all the matched rules to
+    # the pool as one job, so a file's actions still run in rule order.
+    def _submit_rules(self, finfo):
+        plan = []
+        serial = False
+        for rule in self._matching_rules('self_tree', finfo):
+            # actions run later, so remember the groups from this match
+            plan.append((rule, finfo['groups']))
+            serial = serial or rule['serial']
+            if rule['stops']:
+                break
+        if not plan:
+            return False
+        if serial:
+            # everything visited earlier must be done first
+            self._collect_jobs()
+            self._run_plan(finfo, plan)
+            return True
+        effects = []
+        future = self._pool.submit(self._run_job, finfo, plan, effects)
+        self._jobs.append((future, effects))
+        # don't get too far ahead of the workers
+        if len(self._jobs) >= self._action_workers * 4:
+            self._collect_jobs(limit=self._action_workers * 2)
+        return True
+
+    def _run_plan(self, finfo, plan):
+        for rule, groups in plan:
+            finfo['groups'] = groups
+            rule['apply'](finfo)
+
+    # runs on a pool thread
+    def _run_job(self, finfo, plan, effects):
+        self._thread_state.effects = effects
+        try:
+            self._run_plan(finfo, plan)
+        finally:
+            self._thread_state.effects = None
+
+    # wait for submitted jobs, oldest first, until no more than limit are pending,
+    # applying each one's effects. an exception in an action is re-raised here.
+    def _collect_jobs(self, limit=0):
+        while len(self._jobs) > limit:
+            future, effects = self._jobs.pop(0)
+            future.result()
+            for func, args, kwargs in effects:
+                func(*args, **kwargs)
+
+    # call func now if on the main thread. on a pool thread, queue the call to be made
+    # on the main thread when the job is collected. use for anything that changes
+    # shared state (file_info, dest mgr, web maker, ...). return value is not available.
+    def on_main(self, func, *args, **kwargs):
+        effects = getattr(self._thread_state, 'effects', None)
+        if effects is None:
+            return func(*args, **kwargs)
+        effects.append((func, args, kwargs))
+        return None
+
     # symbols for bracket interpolation, mostly in rules. add others as needed
     def make_symbols(self):
         self.symbols['input_root'] = self.config.input
@@ -321,81 +612,186 @@ class TreeProcessor(object):
         self.symbols['archive_root'] = self.config.archive + '/output'
 
     def _walk_files(self, root_name):
-        rule_type = 'self_tree'
-        for dir_name, subdirs, files in os.walk(root_name):
+        walk = os.walk(root_name)
+        if self._pool:
+            # list the tree first, so we don't visit files being written by pool threads.
+            # new files are picked up by the next pass.
+            walk = list(walk)
+        # unpacked files are walked from _unpack_if_archive/_collect_unpacks, once they're
+        # all there; skip them when walking the input tree
+        skip_unpacked = not root_name.startswith(self.unpack_root)
+        for dir_name, subdirs, files in walk:
+            if skip_unpacked and (dir_name + '/').startswith(self.unpack_root + '/'):
+                continue
             for file_name in files:
                 if self.config.signalled():
                     logging.info("signal set, leaving tp._walk_files")
                     return
-                done_with_file = False
-                finfo = None
-                processed_im_root_file = False
-                full = dir_name + '/' + file_name
-                if self._pass == 0:
-                    # might have metadata from an input mgr download
-                    if not dir_name.startswith(self.config.input):
-                        raise Exception("logic error pass 0")
-                    i_im = 0
-                    for im in self.input_mgrs:
-                        finfo = im.get_downloaded_finfo(full)
-                        if finfo:
-                            if 'rules_run' in finfo and finfo['rules_run']:
-                                done_with_file = True
-                            else:
-                                processed_im_root_file = True
-                                finfo['source_im'] = i_im
-                                self.track_file(finfo)
-                            break
-                        i_im += 1
-                    if not finfo:
-                        # this should be a file unpacked from a downloaded file
-                        if full in self.file_info:
-                            finfo = self.file_info[full]
-                        else:
-                            finfo = u.local_metadata(dir_name, file_name)
-                            self.track_file(finfo)
-                elif full in self.file_info:
+                if self._visit_file(dir_name, file_name):
+                    return
+
+    # visit only the output files queued since the last pass (see frontier_mode)
+    def _walk_frontier(self):
+        work = self._frontier
+        self._frontier = []
+        self._frontier_set = set()
+        Config.log("%i queued files" % len(work), tag='TP_FRONTIER_PASS_%i' % self._pass)
+        for full in work:
+            if self.config.signalled():
+                logging.info("signal set, leaving tp._walk_frontier")
+                return
+            if full not in self.file_info and not os.path.isfile(full):
+                continue  # removed by a later action
+            dir_name, file_name = os.path.split(full)
+            if self._visit_file(dir_name, file_name):
+                return
+
+    # queue a new output file for the next pass (no-op unless in frontier mode)
+    def _push_frontier(self, full):
+        if not self._frontier_mode or full in self._frontier_set:
+            return
+        if not full.startswith(self.config.output + '/'):
+            return
+        self._frontier_set.add(full)
+        self._frontier.append(full)
+
+    # find or make metadata for one file, and apply rules to it.
+    # returns True if the caller should stop visiting files.
+    def _visit_file(self, dir_name, file_name):
+        rule_type = 'self_tree'
+        done_with_file = False
+        finfo = None
+        processed_im_root_file = False
+        full = dir_name + '/' + file_name
+        if self._pass == 0:
+            # might have metadata from an input mgr download
+            if not dir_name.startswith(self.config.input):
+                raise Exception("logic error pass 0")
+            i_im = 0
+            for im in self.input_mgrs:
+                finfo = im.get_downloaded_finfo(full)
+                if finfo:
+                    if 'rules_run' in finfo and finfo['rules_run']:
+                        done_with_file = True
+                    else:
+                        processed_im_root_file = True
+                        finfo = self.track_file(finfo)
+                        # a new download, so run its rules even if the content was seen before
+                        finfo['rules_run'] = False
+                        # only on our copy; the input mgr persists its own finfo
+                        finfo['source_im'] = i_im
+                    break
+                i_im += 1
+            if not finfo:
+                # this should be a file unpacked from a downloaded file
+                if full in self.file_info:
                     finfo = self.file_info[full]
                 else:
-                    # new file in output, created by an action
                     finfo = u.local_metadata(dir_name, file_name)
-                    self.track_file(finfo)
-                if self._always_unpack:
-                    self._unpack_if_archive(finfo)
-                self._file_action(rule_type, finfo)
-                if processed_im_root_file:
-                    Config.log(finfo['full'], tag='TP_IM_ROOT_FILE_PROCESSED')
-                    self._root_files_processed += 1
-                    if self._root_files_processed >= self._root_file_limit:
-                        msg = "limit on root files processed per run (%i) reached." % self._root_file_limit
-                        logging.info(msg)
-                        self.config.add_to_final_summary(msg)
-                        return
+                    finfo = self.track_file(finfo)
+        elif full in self.file_info:
+            finfo = self.file_info[full]
+        elif self._provenance and self._provenance.is_orphan(full):
+            # made by an earlier run from an input that's gone; will be pruned
+            return False
+        else:
+            # new file in output, created by an action
+            finfo = u.local_metadata(dir_name, file_name)
+            finfo = self.track_file(finfo)
+        if self._always_unpack:
+            self._unpack_if_archive(finfo)
+        self._file_action(rule_type, finfo)
+        if processed_im_root_file:
+            Config.log(finfo['full'], tag='TP_IM_ROOT_FILE_PROCESSED')
+            self._root_files_processed += 1
+            if self._root_files_processed >= self._root_file_limit:
+                msg = "limit on root files processed per run (%i) reached." % self._root_file_limit
+                logging.info(msg)
+                self.config.add_to_final_summary(msg)
+                return True
+        return False
 
     def _unpack_if_archive(self, finfo):
         if 'rules_run' in finfo and finfo['rules_run']:
             return
-        if finfo['full'].endswith('.tar.gz'):
-            src_path = finfo['path']
-            name = finfo['name']
-            if self.unpack_root in src_path:
-                rel_path = u.make_rel_path(self.unpack_root, src_path)
-            else:
-                rel_path = u.make_rel_path(self.config.input, src_path)
-            dest_path = self.unpack_root + rel_path
-            msg = "unpacking '%s' to '%s" % (name, dest_path)
-            regex = None
-            if 'unpack_files_wanted' in self._re:
-                regex = self._re['unpack_files_wanted']
-                msg = "selectively " + msg + " (unpack_files_wanted = '%s')" % regex.pattern
-            logging.info(msg)
-            self._files_processed += 1 # this counts
-            unpack_dir = u.unpack_file(src_path, dest_path, name, regex_wanted=regex)
-            self.file_info[finfo['full']]['rules_run'] = True
-            if not unpack_dir:
-                Config.log(finfo['full'], tag='TP_IGNORE_BAD_ARCHIVE')
-                return
-            self._walk_files(unpack_dir)
+        if not unpacker.is_archive(finfo['name'], self._unpack_single_files, self._unpack_formats):
+            return
+        src_path = finfo['path']
+        name = finfo['name']
+        if self.unpack_root in src_path:
+            rel_path = u.make_rel_path(self.unpack_root, src_path)
+        else:
+            rel_path = u.make_rel_path(self.config.input, src_path)
+        dest_path = self.unpack_root + rel_path
+        msg = "unpacking '%s' to '%s" % (name, dest_path)
+        regex = None
+        if 'unpack_files_wanted' in self._re:
+            regex = self._re['unpack_files_wanted']
+            msg = "selectively " + msg + " (unpack_files_wanted = '%s')" % regex.pattern
+        logging.info(msg)
+        self._files_processed += 1 # this counts
+        self.file_info[finfo['full']]['rules_run'] = True
+        self._note_rules_run(self.file_info[finfo['full']])
+        if self._unpack_pool:
+            future = self._unpack_pool.submit(self._unpack_archive, finfo, src_path, dest_path, regex)
+            self._unpacks.append((future, finfo))
+            return
+        unpack_dir, finfos = self._unpack_archive(finfo, src_path, dest_path, regex)
+        self._finish_unpack(finfo, unpack_dir, finfos)
+
+    # may run on an unpack pool thread
+    def _unpack_archive(self, finfo, src_path, dest_path, regex):
+        if not self._lazy_unpack:
+            return unpacker.unpack(src_path, dest_path, finfo['name'], regex_wanted=regex,
+                                   single_files=self._unpack_single_files, formats=self._unpack_formats)
+        counts = {'seen': 0, 'wanted': 0}
+
+        def member_filter(member):
+            counts['seen'] += 1
+            if self._wants_member(member):
+                counts['wanted'] += 1
+                return True
+            return False
+
+        ret = unpacker.unpack(src_path, dest_path, finfo['name'], regex_wanted=regex,
+                              single_files=self._unpack_single_files, member_filter=member_filter,
+                              formats=self._unpack_formats)
+        msg = "%s: extracted %i of %i members" % (finfo['full'], counts['wanted'], counts['seen'])
+        Config.log(msg, tag='TP_LAZY_UNPACK')
+        return ret
+
+    # for lazy_unpack: would any rule act on an archive member, if it were unpacked?
+    # member is a finfo for where it would be. True if the first self_tree rule it
+    # matches does more than stop. archives in archives are always wanted.
+    def _wants_member(self, member):
+        if unpacker.is_archive(member['name'], self._unpack_single_files, self._unpack_formats):
+            return True
+        for rule in self._matching_rules('self_tree', member):
+            return not rule['stop_only']
+        return False
+
+    # track the files unpacked from an archive, then visit them. the unpacker gave us
+    # their metadata, so the walk won't need to stat or hash them.
+    def _finish_unpack(self, finfo, unpack_dir, finfos):
+        if not unpack_dir:
+            Config.log(finfo['full'], tag='TP_IGNORE_BAD_ARCHIVE')
+            return
+        if self._provenance:
+            self._provenance.note_unpacked(unpack_dir, finfo['full'])
+        for unpacked in finfos:
+            if unpacked['full'] not in self.file_info:
+                self.file_info[unpacked['full']] = FileInfo(unpacked)
+        self._walk_files(unpack_dir)
+
+    # wait for background unpacks, oldest first, and visit their files. that can
+    # start more unpacks (archives in archives), so keep going until there are none.
+    def _collect_unpacks(self):
+        while self._unpacks:
+            future, finfo = self._unpacks.pop(0)
+            unpack_dir, finfos = future.result()
+            if self.config.signalled():
+                continue
+            self._finish_unpack(finfo, unpack_dir, finfos)
 
     def _file_action(self, rule_type, finfo):
         if ('rules_run' in finfo) and finfo['rules_run']:
@@ -405,22 +801,45 @@ class TreeProcessor(object):
         self._apply_file_rules(rule_type, finfo)
 
     def _apply_file_rules(self, rule_type, finfo):
-        matched = False
-        for rule in self._rule_funcs[rule_type]:
-            if not self.config.run_rule(rule):
-                continue
-            if 'stop' in finfo:
-                break
-            if rule['test'](finfo):
-                matched = True
-                rule['apply'](finfo)
+        if self._pool:
+            # set this before a pool thread can have finfo, not while it's using it
+            finfo['rules_run'] = True
+        self._run_rules(rule_type, finfo)
         finfo['rules_run'] = True
+        self._note_rules_run(finfo)
         # NOTE: we did work even if we matched no rules, or only 'ignore' or 'stop' rules,
         # because setting 'rules_run' will prevent us from looking at this file again.
         self._files_processed += 1
         Config.log(finfo['full'], tag='WORK_DONE_TP')
 
+    # if finfo is for a file an input mgr downloaded, queue it to be marked as
+    # processed in the input mgr's metadata at end of run
+    def _note_rules_run(self, finfo):
+        if 'source_im' in finfo:
+            # need to pass full name for disambiguation
+            self.input_mgrs[finfo['source_im']].rules_run_files.add(finfo['full'])
+
     def process(self, do_clear_info=True):
+        if self._action_workers > 1:
+            Config.log('%i workers' % self._action_workers, tag='TP_ACTION_WORKERS')
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._action_workers)
+        if self._unpack_workers > 1:
+            Config.log('%i workers' % self._unpack_workers, tag='TP_UNPACK_WORKERS')
+            self._unpack_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._unpack_workers)
+        try:
+            return self._process(do_clear_info)
+        finally:
+            if self._unpack_pool:
+                del self._unpacks[:]
+                self._unpack_pool.shutdown()
+                self._unpack_pool = None
+            if self._pool:
+                # on the normal path all jobs were collected; this is for exceptions
+                del self._jobs[:]
+                self._pool.shutdown()
+                self._pool = None
+
+    def _process(self, do_clear_info):
         logging.info("starting tree processing")
         start = u.timestamp_now()
         u.ensure_path(self.config.output)
@@ -431,11 +850,17 @@ class TreeProcessor(object):
         self.remove_unpacked_files()
         if do_clear_info:
             self.file_info.clear()
+        del self._frontier[:]
+        self._frontier_set.clear()
+        if self._provenance:
+            self._provenance.begin()
         self._pass = 0  # pass number
         self._files_processed = 0
         # make one pass over the input files. if you need to know whether this is
         # the input pass, check for self._pass == 0.
         self._walk_files(self.config.input)
+        self._collect_unpacks()
+        self._collect_jobs()
         if self.config.signalled():
             logging.info("signal set, leaving tp.process")
             return False
@@ -447,7 +872,16 @@ class TreeProcessor(object):
         while self._pass < self.PASSES:
             self._files_processed = 0
             self._pass += 1
-            self._walk_files(self.config.output)
+            # in frontier mode, a full walk is only needed to reconcile once the queue is empty
+            full_walk = not self._frontier_mode or not self._frontier
+            if full_walk:
+                if self._frontier_mode:
+                    Config.log('', tag='TP_FRONTIER_RECONCILE_PASS_%i' % self._pass)
+                self._walk_files(self.config.output)
+            else:
+                self._walk_frontier()
+            self._collect_unpacks()
+            self._collect_jobs()
             if self.config.signalled():
                 logging.info("signal set, leaving tp.process after pass %i" % self._pass)
                 work_done = False
@@ -455,32 +889,253 @@ class TreeProcessor(object):
             Config.log('tp._files_processed = %i' % self._files_processed, tag='WORK_DONE_PASS_%i' % self._pass)
             if self._files_processed > 0:
                 work_done = True
-            else:
+            elif full_walk:
                 break
         if self._pass >= self.PASSES:
             raise Exception("completed %i passes and still not done. failing" % self.PASSES)
+        if self._provenance and not self.config.signalled():
+            # only a complete run knows which outputs are no longer made
+            self._provenance.prune()
+            self._provenance.write()
         self.update_input_mgr_metadata()
+        self._write_action_times()
         elapsed = u.timestamp_now() - start
         Config.log("tp completed in %i passes, %f seconds, work_done %s" % (self._pass, elapsed, work_done), tag='WORK_DONE')
         return work_done
 
+    # for the profiler: count the size of a file an action made
+    def _profile_output(self, finfo):
+        if not self.config.profiler:
+            return
+        size = finfo.get('size')
+        if size is None:
+            try:
+                size = os.path.getsize(finfo['full'])
+            except OSError:
+                return
+        self.config.profiler.add_bytes(size)
+
+    def _note_action_time(self, op, seconds):
+        times = self._action_times.setdefault(op, [0, 0.0])
+        times[0] += 1
+        times[1] += seconds
+
+    def _read_action_times(self):
+        try:
+            with open(self._action_times_file) as fh:
+                self._action_times = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            logging.warning("ignoring error '%s' reading '%s'" % (str(exc), self._action_times_file))
+
+    def _write_action_times(self):
+        for times in self._action_times.values():
+            # halve old history now and then, so recent runs count most
+            if times[0] > 10000:
+                times[0] //= 2
+                times[1] /= 2
+        tmp_file = self._action_times_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump(self._action_times, fh, indent=1, sort_keys=True)
+        os.replace(tmp_file, self._action_times_file)
+
+    # 'plan' special mode: report what processing would do, without doing it. Files in
+    # the input tree (less those input mgrs have marked processed) are matched against
+    # the rules as in process(), and archives are listed for their members, but no action
+    # runs. Outputs are predicted: 'copy to' dest, a plugin's dest arg, or, in incremental
+    # mode, the recorded outputs of an action that would be skipped. Predicted outputs
+    # are matched in the next pass, like new files. Action times are estimated from the
+    # averages process() keeps in admin/_action_timings.json.
+    # Nothing is downloaded or uploaded. Returns the report text, also written to
+    # admin/_plan.txt.
+    def plan(self):
+        output = self.config.output + '/'
+        regex = self._re.get('unpack_files_wanted')
+        report = []
+        by_rule = {}  # label -> list of report lines
+        actions = {}  # op -> [would run, would skip]
+        seen = set()
+        existing = set()
+        if not self.clear_first:
+            for dir_name, subdirs, files in os.walk(self.config.output):
+                existing.update(dir_name + '/' + file_name for file_name in files)
+        files = []
+        for dir_name, subdirs, file_names in os.walk(self.config.input):
+            if (dir_name + '/').startswith(self.unpack_root + '/'):
+                continue
+            for file_name in file_names:
+                full = dir_name + '/' + file_name
+                im_finfo = None
+                for im in self.input_mgrs:
+                    im_finfo = im.get_downloaded_finfo(full)
+                    if im_finfo:
+                        break
+                if im_finfo and im_finfo.get('rules_run'):
+                    continue
+                files.append(u.local_metadata(dir_name, file_name))
+        for pass_num in range(self.PASSES):
+            if not files:
+                break
+            matched = 0
+            outputs = []
+            while files:
+                finfo = files.pop(0)
+                seen.add(finfo['full'])
+                if self.config.is_special_file(finfo['name']):
+                    continue
+                if pass_num == 0 and self._always_unpack and \
+                        unpacker.is_archive(finfo['name'], self._unpack_single_files, self._unpack_formats):
+                    files.extend(self._plan_archive(finfo, regex))
+                    continue
+                file_outputs = self._plan_file(finfo, by_rule, actions)
+                if file_outputs is not None:
+                    matched += 1
+                    outputs.extend(file_outputs)
+            new = [full for full in outputs if full not in existing]
+            report.append("pass %i: %i files matched rules, %i outputs (%i new)" %
+                          (pass_num, matched, len(outputs), len(new)))
+            # files for the next pass: what would be made, plus on the first output
+            # pass, what's already in output
+            next_fulls = set(full for full in outputs if full.startswith(output))
+            if pass_num == 0:
+                next_fulls.update(existing)
+            files = [u.local_metadata(*os.path.split(full)) if full in existing else
+                     {'full': full, 'path': os.path.dirname(full), 'name': os.path.basename(full)}
+                     for full in sorted(next_fulls - seen)]
+        report.append('')
+        total = 0.0
+        unknown = []
+        for op, (run, skip) in sorted(actions.items()):
+            times = self._action_times.get(op)
+            if times and times[0]:
+                estimate = run * times[1] / times[0]
+                total += estimate
+                report.append("action %s: %i to run, %i skipped, ~%.1f seconds (%.3g each)" %
+                              (op, run, skip, estimate, times[1] / times[0]))
+            else:
+                unknown.append(op)
+                report.append("action %s: %i to run, %i skipped, no timing history" % (op, run, skip))
+        workers = max(self._action_workers, 1)
+        report.append("estimated action time ~%.1f seconds (~%.1f with %i action workers)%s" %
+                      (total, total / workers, workers,
+                       ", not counting " + ', '.join(unknown) if unknown else ''))
+        report.append('')
+        for label, lines in by_rule.items():
+            report.append("rule %s: %i files" % (label, len(lines)))
+            report.extend('    ' + line for line in lines)
+        text = '\n'.join(report) + '\n'
+        with open(self.config.admin + '/_plan.txt', 'w') as fh:
+            fh.write(text)
+        for line in report[:report.index('')]:
+            Config.log(line, tag='TP_PLAN')
+        return text
+
+    # finfos of the members an archive would be unpacked into. they're listed but not
+    # extracted (the member filter turns every one down).
+    def _plan_archive(self, finfo, regex):
+        members = []
+
+        def member_filter(member):
+            members.append(member)
+            return False
+
+        rel_path = u.make_rel_path(self.config.input, finfo['path'])
+        unpacker.unpack(finfo['path'], self.unpack_root + rel_path, finfo['name'], regex_wanted=regex,
+                        single_files=self._unpack_single_files, member_filter=member_filter,
+                        formats=self._unpack_formats)
+        return members
+
+    # match finfo against the self_tree rules, counting the actions that would run, and
+    # return the full paths of the files they'd make (None if no rule matched)
+    def _plan_file(self, finfo, by_rule, actions):
+        ret = None
+        exists = os.path.isfile(finfo['full'])
+        for rule in self._matching_rules('self_tree', finfo):
+            ret = ret or []
+            made = []
+            for op, more, action_text in rule['actions']:
+                if op == 'stop':
+                    break
+                counts = actions.setdefault(op, [0, 0])
+                if op == 'delete':
+                    counts[0] += 1
+                    continue
+                argstr = u.debracket(more, self, finfo=finfo) if op == 'copy' else self._expand_args(more, finfo)
+                rec = None
+                if self._provenance and exists:
+                    fp = Provenance.fingerprint(rule['label'], action_text, finfo, argstr)
+                    rec = self._provenance.lookup(fp)
+                if rec:
+                    counts[1] += 1
+                    made.extend(out['full'] for out in rec['outputs'])
+                    continue
+                counts[0] += 1
+                if op == 'copy':
+                    made.append(argstr)
+                else:
+                    args = u.parse_arg_string(argstr) or {}
+                    if type(args.get('dest')) is str:
+                        made.append(args['dest'])
+            by_rule.setdefault(rule['label'], []).append(
+                "%s -> %s" % (finfo['full'], ', '.join(made) if made else '(no new files)'))
+            ret.extend(made)
+            if rule['stops']:
+                break
+        return ret
+
     # walk the tree of dest metadata and apply the set of applicable rules to each file.
     # unlike local processing, this is inherently single-pass and does not support
     # creating any new files (we don't even have access to the dest file content at this
     # point, only metadata). So less to keep track of.
     # also adds tp's file metadata to dest's.
+    # dest rules only look at the key, so which rules matched a key (and their groups)
+    # is kept in its finfo, as '_dest_rules', and persisted with it. Keys the dest mgr
+    # hasn't marked dirty, and that have a plan made with the current rules, aren't
+    # matched again: rules that only change the finfo already did that (and it was
+    # persisted), so only the others, like web_handle, are re-applied from the plan.
     def dest_process(self):
         rule_type = 'dest'
         logging.debug("dest_process: %i rules of type dest" % len(self._rule_funcs[rule_type]))
+        sig = self._dest_rules_signature()
+        rules = self._rule_funcs[rule_type]
+        dirty = self._dest_mgr.dirty_keys
+        evaluated = 0
+        replayed = 0
         for key, finfo in self._dest_mgr.tree_info_items():
-            self.copy_metadata(finfo)
-            for rule in self._rule_funcs[rule_type]:
-                if not self.config.run_rule(rule):
-                    continue
-                if 'stop' in finfo:
-                    break
-                if rule['test'](finfo):
+            plan = finfo.get('_dest_rules')
+            if key in dirty or not plan or plan[0] != sig:
+                self.copy_metadata(finfo)
+                plan = [sig]
+                for rule in self._matching_rules(rule_type, finfo):
+                    plan.append([rule['index'], finfo['groups']])
                     rule['apply'](finfo)
+                finfo['_dest_rules'] = plan
+                evaluated += 1
+                continue
+            if 'stop' in finfo:
+                continue  # as _matching_rules would
+            for i_rule, groups in plan[1:]:
+                rule = rules[i_rule]
+                if not rule['metadata_only']:
+                    finfo['groups'] = groups
+                    rule['apply'](finfo)
+                    replayed += 1
+        dirty.clear()
+        msg = "%i keys evaluated, %i rule applications replayed" % (evaluated, replayed)
+        Config.log(msg, tag='TP_DEST_PROCESS')
+
+    # changes if anything that could change dest rule results, other than the key and
+    # the finfo, does
+    def _dest_rules_signature(self):
+        if not self._dest_rules_sig:
+            text = json.dumps([
+                [rule['text'] for rule in self._rule_funcs['dest'] if self.config.run_rule(rule)],
+                self.symbols,
+                self.config.symbols
+            ], sort_keys=True, default=str)
+            self._dest_rules_sig = hashlib.md5(text.encode('utf-8')).hexdigest()[:12]
+        return self._dest_rules_sig
 
     # copy our metadata to dest finfo, but don't overwrite any values.
     # TODO: need a more sophisticated, configurable system for metadata copying
@@ -509,19 +1164,33 @@ class TreeProcessor(object):
         rel_path = u.make_rel_path(self.config.output, path, strict=False)
         return rel_path is not None and not rel_path.startswith('/tmp')
 
-    # modifies new or changed file info
+    # modifies new or changed file info. file_info holds FileInfo objects, so this
+    # returns finfo as one, and callers that keep using finfo should use the return value.
     def track_file(self, finfo):
         full = finfo['full']
         Config.log(full, tag='TP_TRACK_FILE')
         if 'md5' not in finfo:
             finfo['md5'] = u.md5(finfo['full'])
+        finfo = FileInfo.of(finfo)
         if full in self.file_info:
             # don't replace finfo unless file has actually changed
             old_finfo = self.file_info[full]
             if finfo['md5'] == old_finfo['md5']:
                 Config.log(full, tag='TP_TRACK_FILE_UNCHANGED')
-                return
+                # keep the stored entry, with the new metadata, and return it, so the
+                # caller and file_info have the same one. rules_run isn't taken from the
+                # new finfo: an action that remade a file as it was doesn't need its
+                # rules run again.
+                if finfo is not old_finfo:
+                    for k, v in finfo.items():
+                        if k != 'rules_run':
+                            old_finfo[k] = v
+                # its metadata may have changed, so dest should copy it again
+                if self._dest_mgr and 'key' in old_finfo:
+                    self._dest_mgr.dirty_keys.add(old_finfo['key'])
+                return old_finfo
         self.file_info[full] = finfo
+        self._push_frontier(full)
         if self._track_file_callback and self.will_upload(finfo['full']):
             if 'rel_path' not in finfo:
                 finfo['rel_path'] = u.make_rel_path(self.config.output, finfo['path'], no_leading_slash=True)
@@ -533,6 +1202,7 @@ class TreeProcessor(object):
                 finfo['size'] = tmp['size']
                 finfo['modified'] = tmp['modified']
             self._track_file_callback(finfo)
+        return finfo
 
     def interpret(self, val, finfo=None, symbols=None, options=None):
         if symbols is None:
@@ -565,35 +1235,40 @@ class TreeProcessor(object):
             logging.warning("not copying file '%s' onto itself!" % dest)
             return None
         u.ensure_path(dest_dir)
-        Config.log("%s to %s" % (finfo['full'], dest), tag='COPY_WITH_METADATA')
+        Config.log("%s to %s", tag='COPY_WITH_METADATA', args=(finfo['full'], dest))
         if not os.path.exists(finfo['full']):
             msg = "file '%s' does not exist" % finfo['full']
             Config.log(msg, tag='COPY_WITH_METADATA_ERROR')
             return None
-        shutil.copyfile(finfo['full'], dest)
-        # set metadata for new file
-        local = u.local_metadata(dest_dir, dest_file)
-        newfi = copy.deepcopy(finfo) # TODO replace with unified metadata-copy system
+        mode = u.copy_file(finfo['full'], dest, self._copy_mode)
+        if mode != self._copy_mode and self._copy_mode != 'auto':
+            Config.log("%s: %s" % (dest, mode), tag='COPY_WITH_METADATA_FALLBACK')
+        # set metadata for new file. content is the same, so md5 (if known) and size carry over.
+        newfi = copy.deepcopy(FileInfo.of(finfo)) # TODO replace with unified metadata-copy system
         newfi['name'] = dest_file
         newfi['path'] = dest_dir
         newfi['full'] = dest
-        newfi['size'] = local['size']
-        newfi['modified'] = local['modified']
+        st = os.stat(dest)
+        newfi['modified'] = int(st.st_mtime)
+        if 'size' not in newfi:
+            newfi['size'] = st.st_size
+        # a hardlink already shares the source's hash cache entry
+        if 'md5' in newfi and mode != 'hardlink':
+            u.remember_md5(dest, newfi['md5'])
         # clear transient metadata not applicable to new file
         u.remove_no_copy_metadata(newfi)
         newfi['rules_run'] = False
+        self.on_main(self._push_frontier, dest)
         return newfi
 
     # at end of run, call this to tell any input mgr objects that we ran rules
-    # against their downloadable files, so they can persist that. TODO horrible inefficiency
+    # against their downloadable files, so they can persist that. the files were
+    # queued by _note_rules_run as they were processed.
     def update_input_mgr_metadata(self):
-        for full, finfo in self.file_info.items():
-            if 'source_im' in finfo and 'rules_run' in finfo and finfo['rules_run']:
-                im = self.input_mgrs[finfo['source_im']]
-                # need to pass full name for disambiguation
-                im.rules_run_files.append(finfo['full'])
-                del finfo['source_im'] # don't persist this flag
         for im in self.input_mgrs:
+            for full in im.rules_run_files:
+                if full in self.file_info:
+                    self.file_info[full].pop('source_im', None) # don't persist this flag
             im.update_rules_run_files()
 
     def remove_unpacked_files(self):
@@ -608,6 +1283,10 @@ class TreeProcessor(object):
         if not self.config.archive:
             logging.error("can't archive, no archive_root configured")
             return
+        if self._archiver == 'native':
+            self._archive_native(options)
+            Config.log('', tag='TP_ARCHIVE_COMPLETE')
+            return
         try:
             u.ensure_path(self.config.archive + '/output')
             u.deploy_tree(self.config.output, self.config.archive + '/output', options=options)
@@ -615,27 +1294,119 @@ class TreeProcessor(object):
             err = "archive: exception '%s' running rsync" % str(exc)
             logging.error(err)
             raise
+        manifest = self._archive_manifest()
+        if 'delete' in options:
+            manifest.rebuild()
+        else:
+            manifest.add_tree(self.config.output)
         Config.log('', tag='TP_ARCHIVE_COMPLETE')
 
+    # archive without rsync: compare the md5s of the files in the output tree with the
+    # archive manifest, and archive only new or changed files. Content is stored once, in
+    # the manifest's objects folder, and archive paths are hardlinks to it, so the same
+    # image under several dated paths takes the space of one. Like rsync, this looks at
+    # every file in the output tree, not just the ones in file_info. md5s come from the
+    # hash cache, so an unchanged file only costs a stat (finfo md5s aren't used: they
+    # don't say whether the file was rewritten since).
+    # Like rsync, this doesn't delete from the archive unless options has 'delete'.
+    def _archive_native(self, options):
+        manifest = self._archive_manifest()
+        output = self.config.output + '/'
+        current = {}  # archive path -> full
+        for dir_name, subdirs, files in os.walk(self.config.output):
+            for file_name in files:
+                full = dir_name + '/' + file_name
+                current[full[len(output):]] = full
+        stored = 0
+        linked = 0
+        for path, full in current.items():
+            if path.startswith('tmp/'):
+                continue
+            try:
+                md5 = u.md5(full)
+                if manifest.md5(path) == md5:
+                    continue
+                obj = manifest.object_file(md5)
+                if not os.path.isfile(obj):
+                    u.ensure_path_for_file(obj)
+                    tmp = obj + '.tmp'
+                    # a reflink shares blocks copy-on-write, so is as safe as a copy
+                    u.copy_file(full, tmp, 'reflink')
+                    shutil.copystat(full, tmp)
+                    os.replace(tmp, obj)
+                    stored += 1
+            except FileNotFoundError:
+                logging.warning("archive: '%s' is gone, not archived" % full)
+                continue
+            dest = manifest.root + '/' + path
+            u.ensure_path_for_file(dest)
+            # (falls back to a copy if the object has reached the link limit)
+            u.copy_file(obj, dest, 'hardlink')
+            manifest.set(path, md5)
+            linked += 1
+        removed = 0
+        if 'delete' in options:
+            gone = set(manifest.paths()) - set(current)
+            for path in gone:
+                u.remove_if_exists(manifest.root + '/' + path)
+            manifest.remove(gone)
+            removed = len(gone)
+            # objects no archive path refers to any more. (not by link count: a path
+            # copied from its object at the link limit leaves it with a count of 1.)
+            used = manifest.md5s()
+            for dir_name, subdirs, files in os.walk(manifest.objects):
+                for file_name in files:
+                    if file_name not in used:
+                        os.remove(dir_name + '/' + file_name)
+        manifest.write()
+        Config.log("%i paths archived, %i new objects, %i removed" % (linked, stored, removed),
+                   tag='TP_ARCHIVE_NATIVE')
+
+    def _archive_manifest(self):
+        if not self._manifest:
+            self._manifest = ArchiveManifest(self.config, self.config.archive + '/output')
+        return self._manifest
+
     # given a regex, copy all archive files that match it back into the output
     # directory. used with clear_first turned off to reprocess some output files
-    # that were there in a past run.
+    # that were there in a past run. Candidates come from the archive manifest rather
+    # than a walk of the archive, and are copied by a pool of restore_workers threads,
+    # using restore_copy_mode (see u.copy_file). That's reflink by default, which shares
+    # data copy-on-write where the filesystem can, and copies otherwise. hardlink (or
+    # auto) must be asked for: a restored file is then the archived one (with the native
+    # archiver, the object every dated path with that content links to), so anything
+    # that rewrites it in place without u.prepare_overwrite changes the archive too.
     def restore_from_archive(self, wanted, options=None):
         if options is None:
             options = {}
-        if 'verbose' in options and options['verbose']:
+        verbose = 'verbose' in options and options['verbose']
+        if verbose:
             logging.info("restore_from_archive starting")
         re_wanted = re.compile(wanted)
         archive_root = self.config.archive + '/output'
-        for dir_name, subdirs, files in os.walk(archive_root):
-            for file_name in files:
-                full_src = dir_name + '/' + file_name
-                if re.search(re_wanted, full_src):
-                    full_dest = u.reroot_file(full_src, archive_root, self.config.output)
-                    (dest_full_path, dest_name) = os.path.split(full_dest)
-                    u.ensure_path(dest_full_path)
-                    shutil.copyfile(full_src, full_dest)
-                    if 'verbose' in options and options['verbose']:
-                        logging.info("restore_from_archive %s -> %s" % (full_src, full_dest))
-        if 'verbose' in options and options['verbose']:
+        mode = self.config.get('process', 'restore_copy_mode', return_none=True) or 'reflink'
+        if mode not in u.COPY_MODES:
+            raise Exception("bad restore_copy_mode '%s', must be one of %s" % (mode, ', '.join(u.COPY_MODES)))
+        workers = self.config.get_int('process', 'restore_workers', default=4)
+
+        def restore_one(full_src):
+            full_dest = u.reroot_file(full_src, archive_root, self.config.output)
+            u.ensure_path_for_file(full_dest)
+            try:
+                used = u.copy_file(full_src, full_dest, mode)
+            except FileNotFoundError:
+                logging.warning("restore_from_archive: '%s' is in manifest but not in archive" % full_src)
+                return False
+            if verbose:
+                logging.info("restore_from_archive %s -> %s (%s)" % (full_src, full_dest, used))
+            return True
+
+        found = list(self._archive_manifest().query(re_wanted))
+        if workers > 1 and len(found) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                restored = sum(pool.map(restore_one, found))
+        else:
+            restored = sum(map(restore_one, found))
+        Config.log("%i of %i matching files restored" % (restored, len(found)), tag='TP_RESTORE_FROM_ARCHIVE')
+        if verbose:
             logging.info("restore_from_archive completed")
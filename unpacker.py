@@ -0,0 +1,202 @@
+__author__ = 'dsteinkraus'
+
+import os
+import re
+import bz2
+import gzip
+import lzma
+import time
+import shutil
+import tarfile
+import zipfile
+import hashlib
+import logging
+
+import util as u
+
+# unpacking of downloaded archives. Each format has an unpacker function, registered
+# by file name suffix, that reads the archive in one sequential pass and writes the
+# wanted members under a dest folder. As each member is written its md5 is computed,
+# and a finfo (full, path, name, size, modified, md5) is returned for it, so callers
+# don't have to stat or re-read the files.
+# NOTE: no Config here (util-level module), so this logs directly.
+
+# list of (suffix, func, single_file). func(src_full, dest_dir, wanted) returns list
+# of finfos, where wanted(member_name, size, mtime) says whether to extract a member.
+_unpackers = []
+
+_BUF_SIZE = 1024 * 1024
+
+# add an unpacker for files ending with suffix. single_file formats (plain .gz etc.)
+# are only used if the caller asks for them, since such files aren't necessarily
+# meant to be unpacked.
+def register_unpacker(suffix, func, single_file=False):
+    _unpackers.append((suffix, func, single_file))
+    # longest suffix first, so .tar.gz wins over .gz
+    _unpackers.sort(key=lambda x: -len(x[0]))
+
+# suffixes there are unpackers for
+def suffixes():
+    return [suffix for suffix, func, single_file in _unpackers]
+
+# return (suffix, func) of the unpacker for file_name, or None. If formats (a set of
+# suffixes) is given, only unpackers for those are used, single_file or not.
+def find_unpacker(file_name, single_files=False, formats=None):
+    for suffix, func, single_file in _unpackers:
+        if formats is not None:
+            if suffix not in formats:
+                continue
+        elif single_file and not single_files:
+            continue
+        if file_name.endswith(suffix):
+            return suffix, func
+    return None
+
+def is_archive(file_name, single_files=False, formats=None):
+    return find_unpacker(file_name, single_files, formats) is not None
+
+# unpack src_path/file_name into a folder under dest_path named for the archive minus
+# its suffix. only members whose names are in files_wanted, or match regex_wanted,
+# are extracted (all if neither is given). If given, member_filter(finfo) is also
+# asked about each member, as it's reached; finfo has the full, path, name, size
+# and modified the file would have. returns (dest folder, finfos of extracted
+# files), or (None, None) if the archive couldn't be unpacked.
+def unpack(src_path, dest_path, file_name, files_wanted=None, regex_wanted=None, single_files=False,
+           member_filter=None, formats=None):
+    found = find_unpacker(file_name, single_files, formats)
+    if not found:
+        logging.error("can't unpack '%s' - no unpacker for its type" % file_name)
+        return None, None
+    suffix, func = found
+    src_full = src_path.rstrip('/') + '/' + file_name
+    dest = dest_path.rstrip('/') + '/' + file_name[:-len(suffix)]
+    if files_wanted:
+        files_wanted = set(files_wanted)
+        name_wanted = lambda name: name in files_wanted
+    elif regex_wanted:
+        regex = re.compile(regex_wanted)
+        name_wanted = lambda name: regex.search(name) is not None
+    else:
+        name_wanted = lambda name: True
+
+    def wanted(name, size, mtime):
+        if not name_wanted(name):
+            return False
+        if not member_filter:
+            return True
+        full = _member_dest(dest, name, quiet=True)
+        if not full:
+            return True  # let the unpacker reject it
+        path, base = os.path.split(full)
+        return member_filter({'full': full, 'path': path, 'name': base, 'size': size, 'modified': int(mtime)})
+
+    try:
+        u.ensure_path(dest)
+        finfos = func(src_full, dest, wanted)
+    except Exception as exc:
+        msg = "unpack of %s failed with exc '%s'" % (src_full, str(exc))
+        logging.error(msg)
+        return None, None
+    logging.info("unpacked %i files from '%s'" % (len(finfos), src_full))
+    return dest, finfos
+
+# where member name should go under dest_dir, or None if it would land outside it
+def _member_dest(dest_dir, name, quiet=False):
+    parts = [part for part in name.split('/') if part and part != '.']
+    if not parts or name.startswith('/') or '..' in parts:
+        if not quiet:
+            logging.warning("unpack: skipping member '%s', bad path" % name)
+        return None
+    return dest_dir + '/' + '/'.join(parts)
+
+# copy stream fsrc to new file full, hashing as we go; return its finfo
+def _write_member(fsrc, full, mtime=None):
+    u.ensure_path_for_file(full)
+    u.remove_if_exists(full)
+    hash_md5 = hashlib.md5()
+    size = 0
+    with open(full, 'wb') as fdest:
+        for chunk in iter(lambda: fsrc.read(_BUF_SIZE), b''):
+            hash_md5.update(chunk)
+            fdest.write(chunk)
+            size += len(chunk)
+    if mtime is not None:
+        os.utime(full, (mtime, mtime))
+    else:
+        mtime = os.stat(full).st_mtime
+    md5 = hash_md5.hexdigest()
+    u.remember_md5(full, md5)
+    path, name = os.path.split(full)
+    return {'full': full, 'path': path, 'name': name, 'size': size, 'modified': int(mtime), 'md5': md5}
+
+# any tar, compressed or not. 'r|*' reads it as a stream, never seeking or building
+# a member list.
+def unpack_tar(src_full, dest_dir, wanted):
+    ret = []
+    written = {}  # member name -> finfo, for hard links to earlier members
+    with tarfile.open(src_full, 'r|*') as tar:
+        for member in tar:
+            if not (member.isfile() or member.islnk()):
+                continue
+            if not wanted(member.name, member.size, member.mtime):
+                continue
+            full = _member_dest(dest_dir, member.name)
+            if not full:
+                continue
+            if member.islnk():
+                target = written.get(member.linkname)
+                if not target:
+                    logging.warning("unpack: skipping link '%s', target not extracted" % member.name)
+                    continue
+                u.ensure_path_for_file(full)
+                u.remove_if_exists(full)
+                shutil.copyfile(target['full'], full)
+                os.utime(full, (member.mtime, member.mtime))
+                finfo = dict(target)
+                path, name = os.path.split(full)
+                finfo.update({'full': full, 'path': path, 'name': name, 'modified': int(member.mtime)})
+                u.remember_md5(full, finfo['md5'])
+            else:
+                fsrc = tar.extractfile(member)
+                finfo = _write_member(fsrc, full, member.mtime)
+            written[member.name] = finfo
+            ret.append(finfo)
+    return ret
+
+# zip members are read one at a time, in archive order. (the central directory at
+# the end has to be read first, but that's just the index, not the data.)
+def unpack_zip(src_full, dest_dir, wanted):
+    ret = []
+    with zipfile.ZipFile(src_full) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            # zip times are local, with no zone
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            if not wanted(info.filename, info.file_size, mtime):
+                continue
+            full = _member_dest(dest_dir, info.filename)
+            if not full:
+                continue
+            with zf.open(info) as fsrc:
+                ret.append(_write_member(fsrc, full, mtime))
+    return ret
+
+# single compressed file; the member is named for the file minus the suffix
+def _single_file_unpacker(open_func, suffix):
+    def unpack_single(src_full, dest_dir, wanted):
+        name = os.path.basename(src_full)[:-len(suffix)]
+        mtime = os.stat(src_full).st_mtime
+        # size isn't known without decompressing
+        if not wanted(name, None, mtime):
+            return []
+        with open_func(src_full, 'rb') as fsrc:
+            return [_write_member(fsrc, dest_dir + '/' + name, mtime)]
+    return unpack_single
+
+for _suffix in ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.tar'):
+    register_unpacker(_suffix, unpack_tar)
+register_unpacker('.zip', unpack_zip)
+register_unpacker('.gz', _single_file_unpacker(gzip.open, '.gz'), single_file=True)
+register_unpacker('.bz2', _single_file_unpacker(bz2.open, '.bz2'), single_file=True)
+register_unpacker('.xz', _single_file_unpacker(lzma.open, '.xz'), single_file=True)
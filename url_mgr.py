@@ -34,8 +34,12 @@ class UrlMgr(object):
 
         # this is used to store/persist metadata about directly downloaded files.
         self._local_files = {}
-        # this is populated by TreeProcessor
-        self.rules_run_files = []
+        # lines in metadata file, and whether it has everything in _local_files
+        # (if so, changes can just be appended to it)
+        self._list_file_lines = 0
+        self._list_file_synced = False
+        # this is populated by TreeProcessor (full paths of files processed this run)
+        self.rules_run_files = set()
 
     # allow url patterns to be multi-line by recombining here
     def _assemble_url_patterns(self):
@@ -186,6 +190,8 @@ class UrlMgr(object):
                     try:
                         status, length, message, content, content_type, meta = u.fetch_page(url)
                         if status == 200:
+                            # don't write through into hardlinked output copies
+                            u.prepare_overwrite(full)
                             with open(full, 'wb') as fh:
                                 fh.write(content)
                             self._local_files[file_key] = {
@@ -227,9 +233,12 @@ class UrlMgr(object):
     # test is a fn that returns bool based on finfo
     def read_metadata(self, test=None, action=None):
         self._local_files.clear()
+        self._list_file_lines = 0
+        self._list_file_synced = False
         try:
             with open(self._list_file) as fh:
                 for line in fh:
+                    self._list_file_lines += 1
                     line = line.rstrip()
                     finfo = json.loads(line)
                     if test:
@@ -243,6 +252,8 @@ class UrlMgr(object):
                         self._local_files[finfo['name']] = finfo
                     else:
                         self._local_files[finfo['file_key']] = finfo
+            # later lines are updates to earlier ones (see _append_metadata)
+            self._list_file_synced = not test
         except Exception as exc:
             msg = "file '%s' not found/openable: '%s'" % (self._list_file, str(exc))
             Config.log(msg, tag='URL_INVALID_METADATA')
@@ -256,6 +267,19 @@ class UrlMgr(object):
         with open(self._list_file, 'w') as fh:
             for fname, finfo in self._local_files.items():
                 fh.write(json.dumps(finfo, cls=u.DateTimeEncoder) + '\n')
+        self._list_file_lines = len(self._local_files)
+        self._list_file_synced = True
+
+    # persist just the given changed finfos, by appending them to the metadata file.
+    # rewrites the whole file instead if it's not in sync, or has too many stale lines.
+    def _append_metadata(self, finfos):
+        if not self._list_file_synced or self._list_file_lines + len(finfos) > 2 * len(self._local_files) + 100:
+            self.write_metadata()
+            return
+        with open(self._list_file, 'a') as fh:
+            for finfo in finfos:
+                fh.write(json.dumps(finfo, cls=u.DateTimeEncoder) + '\n')
+        self._list_file_lines += len(finfos)
 
     # update existing, or build a new metadata file from contents of input folder.
     # with url_mgr, files can be downloaded to arbitrary subpaths, so have to walk whole tree.
@@ -279,19 +303,20 @@ class UrlMgr(object):
     # fix up loaded metadata (assumed current) by marking files with
     # 'rules_run', and write out to disk.
     def update_rules_run_files(self):
-        if len(self.rules_run_files):
-            for full in self.rules_run_files:
-                file_key = self._full_to_file_key(full)
-                if file_key not in self._local_files:
-                    err = "BUG: file '%s' is not in metadata" % full
-                    Config.log(err, tag='URL_INVALID_RULES_RUN_FILE')
-                    continue
-                finfo = self._local_files[file_key]
-                if 'rules_run' not in finfo or not finfo['rules_run']:
-                    finfo['rules_run'] = True
-            del self.rules_run_files[:]
-        # have to do this every time, metadata may have been out of date already
-        self.write_metadata()
+        changed = []
+        for full in self.rules_run_files:
+            file_key = self._full_to_file_key(full)
+            if file_key not in self._local_files:
+                err = "BUG: file '%s' is not in metadata" % full
+                Config.log(err, tag='URL_INVALID_RULES_RUN_FILE')
+                continue
+            finfo = self._local_files[file_key]
+            if 'rules_run' not in finfo or not finfo['rules_run']:
+                finfo['rules_run'] = True
+                changed.append(finfo)
+        self.rules_run_files.clear()
+        # metadata may have been out of date already; if so this writes all of it
+        self._append_metadata(changed)
 
     def get_downloaded_finfo(self, full):
         path, filename = os.path.split(full)
@@ -2,7 +2,6 @@ import os
 import errno
 import re
 import shutil
-import tarfile
 import logging
 import hashlib
 import math
@@ -13,9 +12,15 @@ import json
 import subprocess
 import inspect
 import tempfile
+import threading
+import functools
 # import urllib - this is unstable, machine-dependent, see e.g.:
 # https://stackoverflow.com/questions/37042152/python-3-5-1-urllib-has-no-attribute-request
 import urllib.request
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 _re = {}
 _re['split_white'] = re.compile(r'\s+')
@@ -33,9 +38,34 @@ def run_command(args, working_dir='.', **kwargs):
         stderr=subprocess.PIPE,
         cwd=working_dir,
         **kwargs)
-    stdout, stderr = proc.communicate()
+    if _profiler and hasattr(os, 'wait4'):
+        stdout, stderr = _communicate_wait4(proc)
+    else:
+        stdout, stderr = proc.communicate()
     return proc.returncode, stdout, stderr
 
+# like proc.communicate(), but reap the process with wait4 to get its rusage for
+# the profiler
+def _communicate_wait4(proc):
+    err = []
+    reader = threading.Thread(target=lambda: err.append(proc.stderr.read()))
+    reader.start()
+    stdout = proc.stdout.read()
+    reader.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    _profiler.add_rusage(rusage)
+    return stdout, err[0]
+
+# optional per-action profiler (see profiler.py), installed by Config
+_profiler = None
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
 def unpack_marker():
     return str('/__UNPACKED__')
 
@@ -52,6 +82,92 @@ def ensure_path_for_file(full):
     path, _ = os.path.split(full)
     ensure_path(path)
 
+def remove_if_exists(full):
+    try:
+        os.remove(full)
+    except FileNotFoundError:
+        pass
+
+# ways copy_file can make dest. hardlink and reflink share data with the source, so
+# they fall back to a real copy where the filesystem can't do them.
+COPY_MODES = ('hardlink', 'reflink', 'copy', 'auto')
+_FICLONE = 0x40049409  # from linux/fs.h
+
+def _reflink(src, dest):
+    if not fcntl:
+        raise OSError(errno.ENOTSUP, "reflink not supported")
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdest.close()
+            os.remove(dest)
+            raise
+
+# in-kernel copy where possible (copy_file_range), so data doesn't pass through us
+def _copy_data(src, dest):
+    if not hasattr(os, 'copy_file_range'):
+        shutil.copyfile(src, dest)
+        return
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), remaining)
+                if not copied:
+                    break
+                remaining -= copied
+            return
+        except OSError:
+            pass  # e.g. EXDEV on older kernels; start over the ordinary way
+    shutil.copyfile(src, dest)
+
+# copy file src to dest according to mode (see COPY_MODES); auto tries reflink, then
+# hardlink, then copy. Any existing dest is removed first, so we never write through
+# a link into some other file. Returns the mode actually used.
+def copy_file(src, dest, mode='copy'):
+    remove_if_exists(dest)
+    ret = link_file(src, dest, mode)
+    if ret:
+        return ret
+    _copy_data(src, dest)
+    return 'copy'
+
+# the sharing part of copy_file: make dest (which mustn't exist) by reflink or hardlink
+# as mode allows, returning the one used, or None if neither worked (or mode is 'copy')
+def link_file(src, dest, mode):
+    if mode in ('reflink', 'auto'):
+        try:
+            _reflink(src, dest)
+            return 'reflink'
+        except OSError:
+            pass
+    if mode in ('hardlink', 'auto'):
+        try:
+            os.link(src, dest)
+            return 'hardlink'
+        except OSError:
+            pass
+    return None
+
+# call before writing a file that might be hardlinked to another one (see copy_file),
+# so the write doesn't show up in the other file too. If keep_content is set (the file
+# will be modified in place) it gets a private copy of its data, otherwise it's just
+# removed, to be written from scratch.
+def prepare_overwrite(full, keep_content=False):
+    try:
+        st = os.stat(full)
+    except FileNotFoundError:
+        return
+    if st.st_nlink < 2:
+        return
+    if not keep_content:
+        os.remove(full)
+        return
+    tmp = full + '.unshare%i' % os.getpid()
+    shutil.copy2(full, tmp)
+    os.replace(tmp, full)
+
 # safely join items into a path regardless of forward slashes already present.
 # os.path.join is almost what we want, but if it encounters a leading slash on
 # a component, it treats it as an absolute path and throws away all preceding
@@ -82,6 +198,12 @@ def clear_folder(path):
         elif os.path.isdir(file_path):
             shutil.rmtree(file_path)
 
+# md5 of a local file's content, from its finfo if already known
+def finfo_md5(finfo):
+    if 'md5' in finfo:
+        return finfo['md5']
+    return md5(finfo['full'])
+
 # remove metadata from a finfo that should not be blindly copied
 # TODO maintain, unify with tp.copy_metadata
 def remove_no_copy_metadata(finfo):
@@ -91,9 +213,10 @@ def remove_no_copy_metadata(finfo):
 
 # get UTC unix timestamp and other facts about local file
 # TODO should accept either path + name, or full
-def local_metadata(path, name):
+def local_metadata(path, name, st=None):
     full = path + '/' + name
-    st = os.stat(full)
+    if st is None:
+        st = os.stat(full)
     ret = {'size': st.st_size,
            'name': name,
            'path': path,
@@ -115,13 +238,57 @@ def ftp_metadata(entry):
     ret['isdir'] = ret['perms'][0] == 'd'
     return ret
 
-# get md5 hash of file (used to avoid redundant uploads)
-# todo: why such small chunk? any effect on perf?
-def md5(fname):
+# optional persistent hash cache (see hash_cache.py), installed by Config
+_hash_cache = None
+
+def set_hash_cache(cache):
+    global _hash_cache
+    _hash_cache = cache
+
+# get md5 hash of file (used to avoid redundant uploads). uses the hash cache
+# if there is one, so unchanged files aren't re-read.
+def md5(fname, use_cache=True):
+    if use_cache and _hash_cache:
+        return _hash_cache.md5(fname)
+    return md5_file(fname)
+
+# tell the hash cache the md5 of a file we just made, so it won't be read to get it
+def remember_md5(full, md5):
+    if _hash_cache:
+        _hash_cache.put(full, md5)
+
+# always reads the file. Reads in big chunks into one reused buffer: far fewer
+# syscalls than 4k reads, and hashlib drops the GIL for chunks this size, so
+# several threads can hash at once.
+_MD5_CHUNK = 1024 * 1024
+
+def md5_file(fname):
     hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    buf = bytearray(_MD5_CHUNK)
+    view = memoryview(buf)
+    with open(fname, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hash_md5.update(view[:n])
+    return hash_md5.hexdigest()
+
+# copy src to dest (which is overwritten) through one buffer, returning the md5 of the
+# data copied, so the copy can be checked without reading either file again
+def copy_file_md5(src, dest):
+    hash_md5 = hashlib.md5()
+    buf = bytearray(_MD5_CHUNK)
+    view = memoryview(buf)
+    with open(src, "rb", buffering=0) as fsrc, open(dest, "wb", buffering=0) as fdest:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            hash_md5.update(view[:n])
+            written = 0
+            while written < n:
+                written += fdest.write(view[written:n])
     return hash_md5.hexdigest()
 
 # if passed a bound method, just return it. Otherwise, assume
@@ -242,30 +409,165 @@ def bracket_parse(st):
 def fill_brackets(ar, interp, finfo=None, symbols=None, options=None):
     if options is None:
         options = {'allow_verbatim': True}
-    ret = ''
+    ret = []
     interpret = interpret_method(interp)
     for item in ar:
         val = item['value']
         if item['is_symbol']:
-            newval = interpret(val, finfo=finfo, symbols=symbols, options=options)
-            # note that empty string is a valid return, but return of None means
-            # that the interpret function found no replacement value (in which case
-            # the original text is left intact).
-            if newval is not None:
-                ret += newval
-            else:
-                if 'allow_verbatim' in options:
-                    ret += '[' + val + ']'  # failsafe if square brackets used literally
-                else:
-                    err = "symbol '%s' not found" % val
-                    logging.error(err)
-                    raise Exception(err)
+            ret.append(_fill_symbol(val, interpret, finfo, symbols, options))
         else:
-            ret += val
-    return ret
+            ret.append(val)
+    return ''.join(ret)
+
+def _fill_symbol(val, interpret, finfo, symbols, options):
+    newval = interpret(val, finfo=finfo, symbols=symbols, options=options)
+    # note that empty string is a valid return, but return of None means
+    # that the interpret function found no replacement value (in which case
+    # the original text is left intact).
+    if newval is not None:
+        return newval
+    if 'allow_verbatim' in options:
+        return '[' + val + ']'  # failsafe if square brackets used literally
+    err = "symbol '%s' not found" % val
+    logging.error(err)
+    raise Exception(err)
+
+#===================== class BracketTemplate =========================================================
+
+# a string with bracketed symbols, parsed once (see compile_brackets). The literal
+# segments are kept in a list with a None slot for each symbol, so rendering just
+# fills the slots and joins.
+class BracketTemplate(object):
+    __slots__ = ('_parts', '_symbols', 'literal')
+
+    def __init__(self, st):
+        ar = bracket_parse(st)
+        self._parts = [None if item['is_symbol'] else item['value'] for item in ar]
+        # (slot, symbol name)
+        self._symbols = tuple((i, item['value']) for i, item in enumerate(ar) if item['is_symbol'])
+        # the whole result, if there are no symbols
+        self.literal = None if self._symbols else ''.join(self._parts)
+
+    def render(self, interp, finfo=None, symbols=None, options=None):
+        if self.literal is not None:
+            return self.literal
+        if options is None:
+            options = {'allow_verbatim': True}
+        interpret = interpret_method(interp)
+        parts = self._parts[:]
+        for i, val in self._symbols:
+            parts[i] = _fill_symbol(val, interpret, finfo, symbols, options)
+        return ''.join(parts)
+
+# compiled template for st. the same few strings (rule actions, plugin args, page
+# templates) are debracketed for every file, so they're cached.
+@functools.lru_cache(maxsize=4096)
+def compile_brackets(st):
+    return BracketTemplate(st)
 
 def debracket(st, interpret, finfo=None, symbols=None, options=None):
-    return fill_brackets(bracket_parse(st), interpret, finfo, symbols, options)
+    return compile_brackets(st).render(interpret, finfo, symbols, options)
+
+# given a regex, find literal text that any match must start or end with, so
+# callers can cheaply rule out strings before running the regex. returns
+# (prefix, prefix_anchored, suffix, suffix_anchored); anchored means the regex
+# begins with ^ (or ends with $), so the literal must be at the start (end) of the
+# string rather than merely somewhere in it. empty literals mean nothing is known.
+# deliberately conservative: anything it doesn't fully understand is treated as
+# a non-literal.
+def regex_literal_affixes(pattern):
+    nothing = ('', False, '', False)
+    tokens = []  # literal characters, or None for anything else
+    prefix_anchored = False
+    suffix_anchored = False
+    i = 0
+    n = len(pattern)
+    if pattern.startswith('^'):
+        prefix_anchored = True
+        i = 1
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 >= n:
+                return nothing
+            # escaped punctuation is literal; \d, \b, \1 etc. are not
+            tokens.append(None if pattern[i + 1].isalnum() else pattern[i + 1])
+            i += 2
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] == '^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                if pattern[j] == '\\':
+                    j += 1
+                j += 1
+            tokens.append(None)
+            i = j + 1
+        elif c == '(':
+            if pattern.startswith('(?', i) and i + 2 < n and pattern[i + 2] in 'aiLmsux-':
+                return nothing  # inline flags change how the whole pattern matches
+            # skip the group, which is treated as a single non-literal
+            depth = 0
+            j = i
+            while j < n:
+                if pattern[j] == '\\':
+                    j += 2
+                    continue
+                if pattern[j] == '[':
+                    j += 1
+                    if j < n and pattern[j] == '^':
+                        j += 1
+                    if j < n and pattern[j] == ']':
+                        j += 1
+                    while j < n and pattern[j] != ']':
+                        if pattern[j] == '\\':
+                            j += 1
+                        j += 1
+                elif pattern[j] == '(':
+                    depth += 1
+                elif pattern[j] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                j += 1
+            if depth != 0:
+                return nothing
+            tokens.append(None)
+            i = j + 1
+        elif c == '|':
+            return nothing  # top-level alternation
+        elif c in '*?{':
+            # previous item might match zero times
+            if tokens:
+                tokens[-1] = None
+            if c == '{':
+                j = pattern.find('}', i)
+                if j < 0:
+                    return nothing
+                i = j
+            i += 1
+        elif c == '$' and i == n - 1:
+            suffix_anchored = True
+            i += 1
+        elif c in '.^$+)':
+            tokens.append(None)
+            i += 1
+        else:
+            tokens.append(c)
+            i += 1
+    prefix = ''
+    for tok in tokens:
+        if tok is None:
+            break
+        prefix += tok
+    suffix = ''
+    for tok in reversed(tokens):
+        if tok is None:
+            break
+        suffix = tok + suffix
+    return prefix, prefix_anchored, suffix, suffix_anchored
 
 def parens_to_brackets(st):
     return st.replace('(', '[').replace(')', ']')
@@ -460,35 +762,12 @@ def daynum_to_ymd(daynum):
         raise Exception("can't parse datestr '%s'" % datestr)
     return match.group(1), match.group(2), match.group(3)
 
-# unpack a compressed archive. files_wanted should be a dict whose keys are
-# pathed file names wanted (if omitted, keep all). Or pass a regex, matching
-# pathed file names will be extracted.
+# unpack an archive to a folder under dest_path named for it minus its suffix, and
+# return that folder, or None on failure. see unpacker.py for formats.
 def unpack_file(src_path, dest_path, file_name, files_wanted=None, regex_wanted=None):
-    # this should be a .tar.gz file, make dest folder that is the
-    # same name minus .tar.gz (TODO adapt to handle zips as well)
-    if not file_name.endswith('.tar.gz'):
-        err = "can't unpack - doesn't end with .tar.gz"
-        logging.error(err)
-        raise Exception(err)
-    try:
-        if not dest_path.endswith('/'):
-            dest_path += '/'
-        dest = dest_path + file_name[:-7]
-        ensure_path(dest)
-        tar = tarfile.open(src_path + '/' + file_name)
-        members = tar.getmembers()
-        if files_wanted:
-            # this syntax avoids making a copy of the list
-            members[:] = [x for x in members if x.name in files_wanted]
-        elif regex_wanted:
-            regex = re.compile(regex_wanted)
-            members[:] = [x for x in members if re.search(regex, x.name)]
-        tar.extractall(path=dest, members=members)
-        tar.close()
-    except Exception as exc:
-        msg = "unpack of %s/%s failed with exc '%s'" % (src_path, file_name, str(exc))
-        logging.error(msg)
-        return None
+    import unpacker  # it imports us
+    dest, _ = unpacker.unpack(src_path, dest_path, file_name, files_wanted=files_wanted,
+                              regex_wanted=regex_wanted)
     return dest
 
 # given a regex with a single group, search search_path for .tar.gz files
@@ -590,6 +869,16 @@ def process_includes(src):
     ret.seek(0) # ready to read from BOF
     return ret
 
+# src and the files it includes (see process_includes)
+def include_files(src):
+    ret = [src]
+    with open(src) as fh:
+        for line in fh:
+            match = _reInclude.search(line.rstrip('\n'))
+            if match:
+                ret.append(match.group(1))
+    return ret
+
 # rsync one tree with another. TODO: currently assumes local (no-compress);
 # also doesn't delete from dest. add options
 def deploy_tree(src, dest, options=None):
@@ -621,16 +910,16 @@ def file_search_replace(full, search_regex, replacement, options=None):
         options = {}
     if 'encoding' not in options:
         options['encoding'] = None
-    with open(full, mode='r+', encoding=options['encoding']) as fh:
+    with open(full, encoding=options['encoding']) as fh:
         contents = fh.read()
-        if re.search(search_regex, contents):
-            modified = search_regex.sub(replacement, contents)
-            fh.seek(0)
-            fh.write(modified)
-            # without this, if file got shorter it will have old data at the end:
-            fh.truncate()
-            return True
+    if not re.search(search_regex, contents):
         return False
+    modified = search_regex.sub(replacement, contents)
+    # file may be a hardlink (see copy_file); don't change the other copies
+    prepare_overwrite(full)
+    with open(full, mode='w', encoding=options['encoding']) as fh:
+        fh.write(modified)
+    return True
 
 # perform a global regex search & replace on all files in a folder.
 # optional file_filter is a function that is passed each file name, and returns True
@@ -31,6 +31,8 @@ class WebMaker(object):
         self.page_context = None
         self._default_worklist = None
         self._mode_plugins = {}
+        # part file -> (mtime, compiled template); parts are rendered for every item
+        self._parts = {}
 
     def ensure_worklist(self, worklist_name):
         if not worklist_name:
@@ -62,7 +64,7 @@ class WebMaker(object):
                 key = finfo['full']
         if not key:
             raise Exception("no dest_key available")
-        Config.log("key '%s' worklist '%s'" % (key, worklist_name), tag='WEBMAKER_WL_ADD')
+        Config.log("key '%s' worklist '%s'", tag='WEBMAKER_WL_ADD', args=(key, worklist_name))
 
         if not key in the_list:
             the_list[key] = {
@@ -215,8 +217,12 @@ class WebMaker(object):
         if not 'name' in args:
             raise Exception("name not specified in args '%s'" % str(args))
         part_file = self.config.template_root + '/parts/' + args['name'] + '.html'
-        part = open(part_file).read()
-        return u.debracket(part, self.interpret, symbols=args)
+        mtime = os.stat(part_file).st_mtime
+        cached = self._parts.get(part_file)
+        if not cached or cached[0] != mtime:
+            cached = (mtime, u.BracketTemplate(open(part_file).read()))
+            self._parts[part_file] = cached
+        return cached[1].render(self.interpret, symbols=args)
 
     def interpret(self, val, finfo=None, symbols=None, worklist=None, options=None):
         if val == 'update_time':
@@ -285,6 +291,7 @@ class WebMaker(object):
             template = open(template_full).read()
             output = u.debracket(template, self.interpret)
             if not self.config.is_special_file(info['key']):
+                u.prepare_overwrite(dest_full)
                 open(dest_full, 'w').write(output)
                 local = u.local_metadata(dest_path, dest_name)
                 info['size'] = local['size']
@@ -292,6 +299,7 @@ class WebMaker(object):
                 info['md5'] = u.md5(dest_full)
                 self.track_file(info)
         else:
+            u.prepare_overwrite(dest_full)
             shutil.copyfile(template_full, dest_full)
             local = u.local_metadata(dest_path, dest_name)
             info['size'] = local['size']